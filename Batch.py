@@ -0,0 +1,237 @@
+# coding: utf8
+
+import json
+import os
+
+from argparse import ArgumentParser
+from collections import namedtuple
+from itertools import product
+from time import perf_counter
+
+import numpy
+
+from Config import RAY_COUNT, RAY_BOUNCE_COUNT, RAY_INIT_DX, RAY_INIT_DY, RANDOM_SEED, WORLD_LINE_COUNT, \
+    WORLD_INT_Y_JITTER, WORLD_INT_IOR, VARIANT_COUNT
+
+
+BATCH_FRAME_WIDTH = 64
+BATCH_FRAME_HEIGHT = 64
+
+# Spec keys and their value when a spec leaves them out, runs are every combination in this order
+SWEEP_AXES = (
+    ("world_int_iors", WORLD_INT_IOR),
+    ("world_int_y_jitters", WORLD_INT_Y_JITTER),
+    ("ray_init_dxs", RAY_INIT_DX),
+    ("ray_init_dys", RAY_INIT_DY),
+    ("ray_bounce_counts", RAY_BOUNCE_COUNT),
+    ("ray_counts", RAY_COUNT),
+    ("random_seeds", RANDOM_SEED)
+)
+
+Run = namedtuple("Run", (
+    "index",
+    "world_int_ior",
+    "world_int_y_jitter",
+    "ray_init_dx",
+    "ray_init_dy",
+    "ray_bounce_count",
+    "ray_count",
+    "random_seed"
+))
+
+
+def prepare_runs(spec):
+
+    unknown_keys = set(spec) - {key for key, _ in SWEEP_AXES}
+    if unknown_keys:
+        raise ValueError("Unknown sweep keys (%s)" % ", ".join(sorted(unknown_keys)))
+
+    axes = [spec.get(key, [default]) for key, default in SWEEP_AXES]
+    return [
+        Run(index, tuple(world_int_ior), *values)
+        for index, (world_int_ior, *values) in enumerate(product(*axes))
+    ]
+
+
+def _get_shape_key(run):
+
+    return run.ray_count, run.ray_bounce_count
+
+
+def _get_world_key(run):
+
+    return run.world_int_ior, run.world_int_y_jitter
+
+
+def _get_ray_key(run):
+
+    return run.ray_init_dx, run.ray_init_dy
+
+
+def schedule_runs(runs):
+
+    # Runs sharing a shape share buffers and programs, then worlds and emitted rays are only uploaded when they change
+    return sorted(runs, key=lambda run: (_get_shape_key(run), _get_world_key(run), _get_ray_key(run), run.index))
+
+
+def _prepare_parameters(args, run):
+
+    import Pipeline
+
+    return Pipeline.prepare_parameters(
+        ray_count=run.ray_count, ray_bounce_count=run.ray_bounce_count, world_line_count=args.world_line_count,
+        world_bvh=not args.brute_force, random_counter=args.counter_random
+    )
+
+
+def schedule_chunks(runs, variant_count):
+
+    # Every chunk is traced by a single dispatch, its runs share a shape and fill the variants in order
+    chunks = []
+    for run in schedule_runs(runs):
+        if not chunks or len(chunks[-1]) == variant_count or _get_shape_key(chunks[-1][0]) != _get_shape_key(run):
+            chunks.append([])
+        chunks[-1].append(run)
+    return chunks
+
+
+def _run_frames(variants, random_seeds, frame_count):
+
+    from OpenGL.GL import glFinish
+
+    import Variant
+
+    # Directions are accumulated through frames the same way as progressive display
+    Variant.init_random(variants, random_seeds)
+    Variant.reset_directions(variants)
+    glFinish()
+
+    frame_times = []
+    for frame in range(frame_count):
+        start_time = perf_counter()
+        if frame > 0:
+            Variant.advance_random(variants)
+        Variant.trace_paths(variants)
+        Variant.accumulate_path_directions(variants)
+        glFinish()
+        frame_times.append(perf_counter() - start_time)
+
+    return Variant.read_directions(variants), frame_times
+
+
+def _run_batch(args, runs):
+
+    import Headless
+    import Pipeline
+    import Variant
+
+    from Shader import ProgramCache
+
+    headless = Headless.Resources()
+    headless.initialize(BATCH_FRAME_WIDTH, BATCH_FRAME_HEIGHT)
+    renderer, version = Headless.get_renderer()
+
+    program_cache = ProgramCache()
+    program_cache.initialize()
+    variants = Variant.Resources()
+
+    results = [None] * len(runs)
+    world_keys = ray_keys = None
+    for chunk_index, chunk in enumerate(schedule_chunks(runs, args.variants)):
+        parameters = _prepare_parameters(args, chunk[0])
+        if parameters != variants.parameters:
+            variants.dispose()
+            variants.initialize(parameters, program_cache, args.variants)
+            world_keys = [None] * args.variants
+            ray_keys = [None] * args.variants
+
+        # Variants keep their world and rays until a run of the chunk needs other ones
+        for variant, run in enumerate(chunk):
+            if world_keys[variant] != _get_world_key(run) or ray_keys[variant] != _get_ray_key(run):
+                ray_data, world_data = Pipeline.prepare_scene_data(
+                    parameters, run.ray_init_dx, run.ray_init_dy, run.world_int_y_jitter, run.world_int_ior
+                )
+                if world_keys[variant] != _get_world_key(run):
+                    Variant.update_world(variants, variant, world_data)
+                    world_keys[variant] = _get_world_key(run)
+                if ray_keys[variant] != _get_ray_key(run):
+                    Variant.update_rays(variants, variant, ray_data)
+                    ray_keys[variant] = _get_ray_key(run)
+
+        ray_dir_weights, frame_times = _run_frames(variants, [run.random_seed for run in chunk], args.frames)
+        for variant, run in enumerate(chunk):
+            results[run.index] = ray_dir_weights[variant], chunk_index, len(chunk), frame_times
+
+    variants.dispose()
+    program_cache.dispose()
+    headless.dispose()
+
+    return results, renderer, version
+
+
+def prepare_columns(runs, results):
+
+    # One entry per run in spec order, histograms are one row per run, timings belong to the chunk tracing the run
+    ray_dir_weights, chunk_indices, chunk_variant_counts, chunk_frame_times = zip(*results)
+    chunk_variant_counts = numpy.array(chunk_variant_counts, numpy.int64)
+    chunk_frame_times = numpy.array(chunk_frame_times, numpy.float64)
+    ray_counts = numpy.array([run.ray_count for run in runs], numpy.int64)
+    ray_bounce_counts = numpy.array([run.ray_bounce_count for run in runs], numpy.int64)
+    return {
+        "run": numpy.array([run.index for run in runs], numpy.int64),
+        "world_int_ior_outside": numpy.array([run.world_int_ior[0] for run in runs], numpy.float32),
+        "world_int_ior_inside": numpy.array([run.world_int_ior[1] for run in runs], numpy.float32),
+        "world_int_y_jitter": numpy.array([run.world_int_y_jitter for run in runs], numpy.float32),
+        "ray_init_dx": numpy.array([run.ray_init_dx for run in runs], numpy.float32),
+        "ray_init_dy": numpy.array([run.ray_init_dy for run in runs], numpy.float32),
+        "ray_bounce_count": ray_bounce_counts,
+        "ray_count": ray_counts,
+        "random_seed": numpy.array([run.random_seed for run in runs], numpy.uint32),
+        "chunk": numpy.array(chunk_indices, numpy.int64),
+        "chunk_variant_count": chunk_variant_counts,
+        "chunk_frame_time_min": chunk_frame_times.min(axis=1),
+        "chunk_frame_time_mean": chunk_frame_times.mean(axis=1),
+        "chunk_ray_segments_per_second": chunk_variant_counts * ray_counts * ray_bounce_counts / chunk_frame_times.mean(axis=1),
+        "ray_dir_weights": numpy.stack(ray_dir_weights)
+    }
+
+
+def main():
+
+    parser = ArgumentParser(description="Trace every combination of a sweep spec in an offscreen OpenGL context")
+    parser.add_argument("spec", help="JSON object of lists, keys are %s" % ", ".join(key for key, _ in SWEEP_AXES))
+    parser.add_argument("output", help="NumPy archive with one column per sweep key and result")
+    parser.add_argument("--world-line-count", type=int, default=WORLD_LINE_COUNT)
+    parser.add_argument("--frames", type=int, default=1, help="frames accumulated by every run")
+    parser.add_argument("--variants", type=int, default=VARIANT_COUNT, help="runs traced by a single dispatch")
+    parser.add_argument("--brute-force", action="store_true", help="trace without the world BVH")
+    parser.add_argument("--counter-random", action="store_true", help="hash random samples instead of keeping a state per ray")
+    parser.add_argument("--platform", choices=("egl", "osmesa"), default="egl")
+    args = parser.parse_args()
+
+    if args.frames <= 0:
+        parser.error("frames must be positive")
+    if args.variants <= 0:
+        parser.error("variants must be positive")
+
+    with open(args.spec) as spec_file:
+        spec = json.load(spec_file)
+
+    # The platform has to be set before OpenGL is imported
+    os.environ["PYOPENGL_PLATFORM"] = args.platform
+
+    try:
+        runs = prepare_runs(spec)
+        for run in runs:
+            _prepare_parameters(args, run)
+    except ValueError as error:
+        parser.error(str(error))
+
+    results, renderer, version = _run_batch(args, runs)
+    numpy.savez_compressed(
+        args.output, platform=args.platform, renderer=renderer, version=version, **prepare_columns(runs, results)
+    )
+
+
+if __name__ == "__main__":
+    main()
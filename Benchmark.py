@@ -0,0 +1,219 @@
+# coding: utf8
+
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+from itertools import product
+from time import perf_counter
+
+from Config import RAY_COUNT, RAY_GROUP_SIZE, RAY_BOUNCE_COUNT, WORLD_LINE_COUNT
+
+
+BENCHMARK_FRAME_WIDTH = 640
+BENCHMARK_FRAME_HEIGHT = 480
+
+
+def _run_frame(pipeline, view_projection):
+
+    import Random
+    import Ray
+
+    world, ray, random = pipeline.world, pipeline.ray, pipeline.random
+    bounce_count = pipeline.parameters.ray_bounce_count
+
+    Random.init(random)
+
+    for iteration in range(bounce_count):
+        Ray.trace(ray, iteration, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+        Ray.display_lines(ray, view_projection, iteration)
+
+    Ray.display_directions(ray, iteration)
+
+
+def _run_case(pipeline, parameters, frame_count, warmup_frame_count):
+
+    from OpenGL.GL import glFinish
+    from glm import mat3
+
+    import Pipeline
+
+    Pipeline.update_parameters(pipeline, parameters)
+
+    view_projection = mat3(1.0)
+
+    for _ in range(warmup_frame_count):
+        _run_frame(pipeline, view_projection)
+    glFinish()
+
+    frame_times = []
+    for _ in range(frame_count):
+        start_time = perf_counter()
+        _run_frame(pipeline, view_projection)
+        glFinish()
+        frame_times.append(perf_counter() - start_time)
+
+    return _prepare_result(parameters, frame_times)
+
+
+def _run_cpu_frame(cpu_pool, bounce_count):
+
+    import CpuPool
+
+    CpuPool.init(cpu_pool)
+
+    for iteration in range(bounce_count):
+        CpuPool.trace(cpu_pool, iteration)
+
+    CpuPool.compute_directions(cpu_pool, iteration)
+
+
+def _run_cpu_case(parameters, process_count, frame_count, warmup_frame_count):
+
+    import CpuPool
+    import Pipeline
+
+    # Workers attach to the scene of this case, the pool does not outlive it
+    ray_data, world_data = Pipeline.prepare_scene_data(parameters)
+    cpu_pool = CpuPool.Resources()
+    cpu_pool.initialize(ray_data, world_data, parameters.ray_dir_count, process_count)
+    cpu_pool.random.counter = parameters.random_counter
+
+    try:
+        for _ in range(warmup_frame_count):
+            _run_cpu_frame(cpu_pool, parameters.ray_bounce_count)
+
+        frame_times = []
+        for _ in range(frame_count):
+            start_time = perf_counter()
+            _run_cpu_frame(cpu_pool, parameters.ray_bounce_count)
+            frame_times.append(perf_counter() - start_time)
+    finally:
+        cpu_pool.dispose()
+
+    return _prepare_result(parameters, frame_times)
+
+
+def _prepare_result(parameters, frame_times):
+
+    # Segment tests are counted as if every ray segment was tested against every world line
+    frame_count = len(frame_times)
+    total_time = sum(frame_times)
+    ray_segment_count = parameters.ray_count * parameters.ray_bounce_count * frame_count
+    return {
+        "ray_count": parameters.ray_count,
+        "world_line_count": parameters.world_line_count,
+        "bounce_count": parameters.ray_bounce_count,
+        "world_bvh": parameters.world_bvh,
+        "world_scene_path": parameters.world_scene_path,
+        "ray_sort": parameters.ray_sort,
+        "random_counter": parameters.random_counter,
+        "frame_count": frame_count,
+        "frame_time_min": min(frame_times),
+        "frame_time_mean": total_time / frame_count,
+        "ray_segments_per_second": ray_segment_count / total_time,
+        "segment_tests_per_second": ray_segment_count * parameters.world_line_count / total_time
+    }
+
+
+def _run_gl_cases(args, cases):
+
+    import Headless
+    import Pipeline
+
+    headless = Headless.Resources()
+    headless.initialize(BENCHMARK_FRAME_WIDTH, BENCHMARK_FRAME_HEIGHT)
+    renderer, version = Headless.get_renderer()
+    Headless.bind_framebuffer(headless)
+
+    # Every case reuses the same context, only buffers are reallocated and programs come from the cache
+    pipeline = Pipeline.Resources()
+    pipeline.initialize()
+
+    results = []
+    for ray_count, world_line_count, bounce_count in cases:
+        parameters = Pipeline.prepare_parameters(
+            ray_count=ray_count, world_line_count=world_line_count, ray_bounce_count=bounce_count,
+            world_bvh=not args.brute_force, world_scene_path=args.scene, ray_sort=args.sort,
+            random_counter=args.counter_random
+        )
+        results.append(_run_case(pipeline, parameters, args.frames, args.warmup_frames))
+
+    pipeline.dispose()
+    headless.dispose()
+
+    return results, renderer, version
+
+
+def _run_cpu_cases(args, cases):
+
+    import Pipeline
+
+    # CPU tracing tests every world line, there is no BVH to report
+    results = []
+    for ray_count, world_line_count, bounce_count in cases:
+        parameters = Pipeline.prepare_parameters(
+            ray_count=ray_count, world_line_count=world_line_count, ray_bounce_count=bounce_count,
+            world_bvh=False, random_counter=args.counter_random
+        )
+        results.append(_run_cpu_case(parameters, args.cpu_processes, args.frames, args.warmup_frames))
+
+    return results, "CPU", "%d processes" % (args.cpu_processes or os.cpu_count())
+
+
+def main():
+
+    parser = ArgumentParser(description="Benchmark the ray pipeline in an offscreen OpenGL context or on CPU processes")
+    parser.add_argument("--ray-counts", type=int, nargs="+", default=[RAY_COUNT])
+    parser.add_argument("--world-line-counts", type=int, nargs="+", default=[WORLD_LINE_COUNT])
+    parser.add_argument("--bounce-counts", type=int, nargs="+", default=[RAY_BOUNCE_COUNT])
+    parser.add_argument("--frames", type=int, default=16)
+    parser.add_argument("--warmup-frames", type=int, default=2)
+    parser.add_argument("--brute-force", action="store_true", help="trace without the world BVH")
+    parser.add_argument("--scene", help="scene file replacing the generated world, its line count is used")
+    parser.add_argument("--sort", action="store_true", help="sort rays by direction and origin before each bounce")
+    parser.add_argument("--counter-random", action="store_true", help="hash random samples instead of keeping a state per ray")
+    parser.add_argument("--platform", choices=("egl", "osmesa"), default="egl")
+    parser.add_argument("--cpu-processes", type=int, help="trace on a CPU process pool instead, 0 uses every core")
+    parser.add_argument("--output", help="JSON file, printed to stdout otherwise")
+    args = parser.parse_args()
+
+    for ray_count in args.ray_counts:
+        if ray_count <= 0 or ray_count % RAY_GROUP_SIZE != 0:
+            parser.error("ray counts must be multiples of %d" % RAY_GROUP_SIZE)
+    for world_line_count in args.world_line_counts:
+        if world_line_count <= 0 or world_line_count % 2 != 0:
+            parser.error("world line counts must be even")
+    for bounce_count in args.bounce_counts:
+        if bounce_count <= 0:
+            parser.error("bounce counts must be positive")
+    if args.frames <= 0:
+        parser.error("frames must be positive")
+    if args.cpu_processes is not None and args.cpu_processes < 0:
+        parser.error("CPU processes must not be negative")
+    if args.cpu_processes is not None and args.sort:
+        parser.error("rays are only sorted by the OpenGL pipeline")
+    if args.cpu_processes is not None and args.scene:
+        parser.error("scene files are only loaded by the OpenGL pipeline")
+
+    # The platform has to be set before OpenGL is imported
+    os.environ["PYOPENGL_PLATFORM"] = args.platform
+
+    cases = product(args.ray_counts, [None] if args.scene else args.world_line_counts, args.bounce_counts)
+    if args.cpu_processes is not None:
+        results, renderer, version = _run_cpu_cases(args, cases)
+    else:
+        results, renderer, version = _run_gl_cases(args, cases)
+
+    report = {"platform": args.platform, "renderer": renderer, "version": version, "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+
+if __name__ == "__main__":
+    main()
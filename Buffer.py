@@ -1,36 +1,101 @@
 # coding: utf8
 
-from OpenGL.GL import GL_SHADER_STORAGE_BUFFER, GL_STATIC_DRAW, \
-    GLuint, GLfloat, sizeof,\
-    glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferData
+from OpenGL.GL import GL_SHADER_STORAGE_BUFFER, GL_BUFFER_SIZE, GL_STATIC_DRAW, GL_R32UI, GL_RED_INTEGER, GL_UNSIGNED_INT, \
+    GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, GLuint, GLfloat, sizeof,\
+    glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferData, glBufferSubData, glGetBufferSubData, glGetBufferParameteriv, \
+    glClearBufferData, glCopyBufferSubData
+
+import numpy
+
+import Registry
+
+
+def _as_array(data, data_type=None):
+
+    # NumPy arrays, memoryviews and array.array objects are used in place, lists are converted once
+    if not isinstance(data, numpy.ndarray):
+        try:
+            data = numpy.asarray(memoryview(data))
+        except TypeError:
+            data = numpy.asarray(data, data_type)
+    return numpy.ascontiguousarray(data, data_type)
 
 
 def prepare_float_buffer_data(float_array):
 
-    buffer_data_type = GLfloat * len(float_array)
-    return sizeof(buffer_data_type), buffer_data_type(*float_array)
+    buffer_data = _as_array(float_array, numpy.float32)
+    return buffer_data.nbytes, buffer_data
 
 
 def prepare_uint_buffer_data(int_array):
 
-    buffer_data_type = GLuint * len(int_array)
-    return sizeof(buffer_data_type), buffer_data_type(*int_array)
+    buffer_data = _as_array(int_array, numpy.uint32)
+    return buffer_data.nbytes, buffer_data
+
+
+def prepare_empty_float_buffer_data(float_count):
+
+    return sizeof(GLfloat) * float_count, None
+
+
+def prepare_empty_uint_buffer_data(uint_count):
+
+    return sizeof(GLuint) * uint_count, None
 
 
 def initialize_buffer(buffer_data_size, buffer_data=None, buffer_usage=GL_STATIC_DRAW):
 
     if buffer_data is None:
-        buffer_data_size, buffer_data = buffer_data_size
+        if isinstance(buffer_data_size, tuple):
+            buffer_data_size, buffer_data = buffer_data_size
+        else:
+            buffer_data = _as_array(buffer_data_size)
+            buffer_data_size = buffer_data.nbytes
 
     buffer = GLuint(0)
     glGenBuffers(1, buffer)
     glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
     glBufferData(GL_SHADER_STORAGE_BUFFER, buffer_data_size, buffer_data, buffer_usage)
     glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
-    return buffer
+    return Registry.track("buffer", buffer, buffer_data_size)
+
+
+def update_buffer(buffer, offset, data):
+
+    data = _as_array(data)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+    glBufferSubData(GL_SHADER_STORAGE_BUFFER, offset, data.nbytes, data)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+
+def read_buffer(buffer, data_type, offset=0, size=None):
+
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+    if size is None:
+        size = glGetBufferParameteriv(GL_SHADER_STORAGE_BUFFER, GL_BUFFER_SIZE) - offset
+    data = glGetBufferSubData(GL_SHADER_STORAGE_BUFFER, offset, size)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+    return numpy.frombuffer(data, data_type).copy()
+
+
+def clear_uint_buffer(buffer):
+
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffer)
+    glClearBufferData(GL_SHADER_STORAGE_BUFFER, GL_R32UI, GL_RED_INTEGER, GL_UNSIGNED_INT, None)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+
+def copy_buffer(source_buffer, source_offset, destination_buffer, destination_offset, size):
+
+    glBindBuffer(GL_COPY_READ_BUFFER, source_buffer)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, destination_buffer)
+    glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, source_offset, destination_offset, size)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+    glBindBuffer(GL_COPY_READ_BUFFER, 0)
 
 
 def dispose_buffer(buffer):
 
     if buffer is not None:
-        glDeleteBuffers(1, (buffer,))
+        Registry.untrack("buffer", buffer)
+        glDeleteBuffers(1, buffer)
@@ -0,0 +1,302 @@
+# coding: utf8
+
+import numpy
+
+from Config import WORLD_BVH_LEAF_SIZE
+
+
+# Boxes are padded so flat world lines still have a volume for the slab test
+BVH_BOX_PADDING = 1e-5
+
+BVH_NODE_SIZE = 6
+
+NODE_LAYOUT = """
+#define BVH_STACK_SIZE 32
+
+struct BvhNode
+{
+    vec2 box_min;
+    vec2 box_max;
+    uint child_or_first_line;
+    uint line_count;            // 0 for inner nodes, children are stored at child_or_first_line and next to it
+};
+"""
+
+BUFFER_LAYOUT = NODE_LAYOUT + """
+layout(std430, binding = {binding}) buffer WorldBvh
+{{
+    uint bvh_lines[WORLD_LINE_COUNT];
+    BvhNode bvh_nodes[];
+}};
+""".format(binding=4)
+
+SHADER = """
+float intersect_bvh_box(BvhNode node, vec2 ray_o, vec2 ray_inv_d, float max_dist)
+{{
+    vec2 t0 = (node.box_min - ray_o) * ray_inv_d;
+    vec2 t1 = (node.box_max - ray_o) * ray_inv_d;
+    vec2 t_near = min(t0, t1);
+    vec2 t_far = max(t0, t1);
+    float t_enter = max(max(t_near.x, t_near.y), 0.0);
+    float t_exit = min(min(t_far.x, t_far.y), max_dist);
+    return t_enter <= t_exit ? t_enter : +1e32;
+}}
+
+void intersect_world(vec3 ray_l, vec2 ray0_o0, vec2 ray0_d0, inout vec2 min_hit, inout float min_dist, inout vec2 min_normal, inout float min_ior_i, inout float min_ior_t)
+{{
+    // Rays without a direction never hit anything, this also rejects NaN directions that could pass every box test
+    if (!(dot(ray0_d0, ray0_d0) > 0.5))
+    {{
+        return;
+    }}
+
+    vec2 ray0_inv_d0 = 1.0 / ray0_d0;
+
+    uint stack[BVH_STACK_SIZE];
+    uint stack_size = 0;
+
+    uint node_index = 0;
+    bool has_node = intersect_bvh_box(bvh_nodes[0], ray0_o0, ray0_inv_d0, min_dist) < +1e32;
+
+    while (has_node)
+    {{
+        BvhNode node = bvh_nodes[node_index];
+        has_node = false;
+
+        if (node.line_count > 0)
+        {{
+            for (uint line = node.child_or_first_line; line < node.child_or_first_line + node.line_count; ++line)
+            {{
+                intersect_world_line(bvh_lines[line], ray_l, ray0_o0, ray0_d0, min_hit, min_dist, min_normal, min_ior_i, min_ior_t);
+            }}
+        }}
+        else
+        {{
+            // Visit the nearest child first and keep the other one for later
+            uint child0 = node.child_or_first_line;
+            uint child1 = child0 + 1;
+            float dist0 = intersect_bvh_box(bvh_nodes[child0], ray0_o0, ray0_inv_d0, min_dist);
+            float dist1 = intersect_bvh_box(bvh_nodes[child1], ray0_o0, ray0_inv_d0, min_dist);
+
+            if (dist1 < dist0)
+            {{
+                uint child = child0; child0 = child1; child1 = child;
+                float dist = dist0; dist0 = dist1; dist1 = dist;
+            }}
+
+            if (dist0 < +1e32)
+            {{
+                node_index = child0;
+                has_node = true;
+                if (dist1 < +1e32)
+                {{
+                    stack[stack_size++] = child1;
+                }}
+            }}
+        }}
+
+        // Skip stacked nodes which are further than the closest hit found since they were pushed
+        while (!has_node && stack_size > 0)
+        {{
+            node_index = stack[--stack_size];
+            has_node = intersect_bvh_box(bvh_nodes[node_index], ray0_o0, ray0_inv_d0, min_dist) < +1e32;
+        }}
+    }}
+}}
+""".format()
+
+
+def get_bvh_node_count(line_count, leaf_size=WORLD_BVH_LEAF_SIZE):
+
+    # Median splits only depend on the line count, every world with as many lines has as many nodes
+    node_count = 0
+    node_line_counts = [line_count]
+    while node_line_counts:
+        node_line_count = node_line_counts.pop()
+        node_count += 1
+        if node_line_count > leaf_size:
+            node_line_counts.extend((node_line_count >> 1, node_line_count - (node_line_count >> 1)))
+    return node_count
+
+
+def build_bvh(world_pos_x, world_pos_y, leaf_size=WORLD_BVH_LEAF_SIZE):
+
+    line_count = len(world_pos_x) >> 1
+    line_center_x = (world_pos_x[0::2] + world_pos_x[1::2]) * 0.5
+    line_center_y = (world_pos_y[0::2] + world_pos_y[1::2]) * 0.5
+
+    # Lines of every node stay contiguous and sorted along both axes, splits keep both orders with a stable partition
+    lines_x = numpy.argsort(line_center_x).astype(numpy.uint32)
+    lines_y = numpy.argsort(line_center_y).astype(numpy.uint32)
+    line_is_left = numpy.zeros(line_count, bool)
+
+    # Median splits along the largest centroid extent, one level at a time, children are allocated in pairs after
+    # the level of their parent and in the same order
+    level_first = numpy.zeros(1, numpy.int64)
+    level_last = numpy.full(1, line_count, numpy.int64)
+    node_first = []
+    node_last = []
+    node_child = []
+    node_depth = []
+
+    node_count = 0
+    while len(level_first):
+        node_count += len(level_first)
+        is_split = level_last - level_first > leaf_size
+        split_first = level_first[is_split]
+        split_last = level_last[is_split]
+        split_middle = (split_first + split_last) >> 1
+        split_count = len(split_first)
+
+        level_child = numpy.zeros(len(level_first), numpy.int64)
+        level_child[is_split] = node_count + 2 * numpy.arange(split_count)
+        node_first.append(level_first)
+        node_last.append(level_last)
+        node_child.append(level_child)
+        node_depth.append(numpy.full(len(level_first), len(node_depth)))
+
+        if split_count:
+            split_line_counts = split_last - split_first
+            split_starts = numpy.cumsum(split_line_counts) - split_line_counts
+            segments = numpy.repeat(numpy.arange(split_count), split_line_counts)
+            segment_indices = numpy.arange(len(segments)) - split_starts[segments]
+            positions = split_first[segments] + segment_indices
+
+            extent_x = line_center_x[lines_x[split_last - 1]] - line_center_x[lines_x[split_first]]
+            extent_y = line_center_y[lines_y[split_last - 1]] - line_center_y[lines_y[split_first]]
+            # Lines before the median along the axis of their node go to the first child
+            split_lines = numpy.where((extent_x >= extent_y)[segments], lines_x[positions], lines_y[positions])
+            line_is_left[split_lines] = positions < split_middle[segments]
+
+            for axis_lines in (lines_x, lines_y):
+                split_axis_lines = axis_lines[positions]
+                is_left = line_is_left[split_axis_lines]
+                left_ranks = numpy.cumsum(is_left) - is_left
+                left_ranks -= left_ranks[split_starts][segments]
+                axis_lines[numpy.where(
+                    is_left,
+                    split_first[segments] + left_ranks,
+                    split_middle[segments] + segment_indices - left_ranks
+                )] = split_axis_lines
+
+        level_first = numpy.stack((split_first, split_middle), axis=1).ravel()
+        level_last = numpy.stack((split_middle, split_last), axis=1).ravel()
+
+    lines = lines_x
+    node_first = numpy.concatenate(node_first).astype(numpy.uint32)
+    node_last = numpy.concatenate(node_last).astype(numpy.uint32)
+    node_child = numpy.concatenate(node_child).astype(numpy.uint32)
+    node_is_leaf = node_last - node_first <= leaf_size
+
+    nodes = numpy.zeros((len(node_first), BVH_NODE_SIZE), numpy.float32)
+    node_links = nodes[:, 4:].view(numpy.uint32)
+    node_links[:, 0] = numpy.where(node_is_leaf, node_first, node_child)
+    node_links[:, 1] = numpy.where(node_is_leaf, node_last - node_first, 0)
+
+    node_depth = numpy.concatenate(node_depth).astype(numpy.uint32)
+    refit_bvh(nodes, node_depth, lines, world_pos_x, world_pos_y)
+
+    return lines, nodes, node_depth
+
+
+def refit_bvh(nodes, node_depth, lines, world_pos_x, world_pos_y):
+
+    node_links = nodes[:, 4:].view(numpy.uint32)
+    line_count = node_links[:, 1]
+    is_leaf = line_count > 0
+
+    # Leaves bound their lines, ordered lines are contiguous for each leaf
+    leaves = numpy.nonzero(is_leaf)[0]
+    leaves = leaves[numpy.argsort(node_links[leaves, 0])]
+    leaf_first = node_links[leaves, 0]
+    ordered_x = world_pos_x.reshape(-1, 2)[lines]
+    ordered_y = world_pos_y.reshape(-1, 2)[lines]
+    nodes[leaves, 0] = numpy.minimum.reduceat(ordered_x.min(axis=1), leaf_first) - BVH_BOX_PADDING
+    nodes[leaves, 1] = numpy.minimum.reduceat(ordered_y.min(axis=1), leaf_first) - BVH_BOX_PADDING
+    nodes[leaves, 2] = numpy.maximum.reduceat(ordered_x.max(axis=1), leaf_first) + BVH_BOX_PADDING
+    nodes[leaves, 3] = numpy.maximum.reduceat(ordered_y.max(axis=1), leaf_first) + BVH_BOX_PADDING
+
+    # Inner nodes bound their children, deepest level first
+    for depth in range(int(node_depth.max()), -1, -1):
+        inner = numpy.nonzero(~is_leaf & (node_depth == depth))[0]
+        child0 = node_links[inner, 0]
+        child1 = child0 + 1
+        nodes[inner, 0:2] = numpy.minimum(nodes[child0, 0:2], nodes[child1, 0:2])
+        nodes[inner, 2:4] = numpy.maximum(nodes[child0, 2:4], nodes[child1, 2:4])
+
+
+def get_bvh_node_depth(nodes):
+
+    # Depth of every node for trees that were not just built, children come in pairs after their parent
+    node_links = nodes[:, 4:].view(numpy.uint32)
+    node_depth = numpy.zeros(len(nodes), numpy.uint32)
+    level = numpy.zeros(1, numpy.int64)
+    while len(level):
+        inner = level[node_links[level, 1] == 0]
+        level = numpy.stack((node_links[inner, 0], node_links[inner, 0] + 1), axis=1).ravel().astype(numpy.int64)
+        node_depth[level] = node_depth[inner].repeat(2) + 1
+    return node_depth
+
+
+def prepare_bvh_links(nodes, lines):
+
+    # Leaf of every line and parent of every node, the root is its own parent
+    node_links = nodes[:, 4:].view(numpy.uint32)
+    is_leaf = node_links[:, 1] > 0
+
+    inner = numpy.nonzero(~is_leaf)[0]
+    node_parents = numpy.zeros(len(nodes), numpy.int64)
+    node_parents[node_links[inner, 0]] = inner
+    node_parents[node_links[inner, 0] + 1] = inner
+
+    leaves = numpy.nonzero(is_leaf)[0]
+    leaves = leaves[numpy.argsort(node_links[leaves, 0])]
+    line_leaves = numpy.zeros(len(lines), numpy.int64)
+    line_leaves[lines] = numpy.repeat(leaves, node_links[leaves, 1])
+
+    return node_parents, line_leaves
+
+
+def refit_bvh_lines(nodes, node_depth, node_parents, line_leaves, lines, world_pos_x, world_pos_y, refit_lines):
+
+    # Same boxes as refit_bvh for the leaves of the lines and their ancestors only, returns these nodes in order
+    node_links = nodes[:, 4:].view(numpy.uint32)
+
+    leaves = numpy.unique(line_leaves[refit_lines])
+    leaf_line_counts = node_links[leaves, 1].astype(numpy.int64)
+    leaf_starts = numpy.cumsum(leaf_line_counts) - leaf_line_counts
+    segments = numpy.repeat(numpy.arange(len(leaves)), leaf_line_counts)
+    leaf_lines = lines[node_links[leaves, 0][segments] + numpy.arange(len(segments)) - leaf_starts[segments]]
+    leaf_x = world_pos_x.reshape(-1, 2)[leaf_lines]
+    leaf_y = world_pos_y.reshape(-1, 2)[leaf_lines]
+    nodes[leaves, 0] = numpy.minimum.reduceat(leaf_x.min(axis=1), leaf_starts) - BVH_BOX_PADDING
+    nodes[leaves, 1] = numpy.minimum.reduceat(leaf_y.min(axis=1), leaf_starts) - BVH_BOX_PADDING
+    nodes[leaves, 2] = numpy.maximum.reduceat(leaf_x.max(axis=1), leaf_starts) + BVH_BOX_PADDING
+    nodes[leaves, 3] = numpy.maximum.reduceat(leaf_y.max(axis=1), leaf_starts) + BVH_BOX_PADDING
+
+    ancestors = [numpy.zeros(0, numpy.int64)]
+    parents = leaves[leaves > 0]
+    while len(parents):
+        parents = numpy.unique(node_parents[parents])
+        ancestors.append(parents)
+        parents = parents[parents > 0]
+    ancestors = numpy.unique(numpy.concatenate(ancestors))
+
+    # Leaves are not always at the same depth, deepest ancestors first
+    ancestor_depth = node_depth[ancestors]
+    for depth in numpy.unique(ancestor_depth)[::-1]:
+        inner = ancestors[ancestor_depth == depth]
+        child0 = node_links[inner, 0]
+        child1 = child0 + 1
+        nodes[inner, 0:2] = numpy.minimum(nodes[child0, 0:2], nodes[child1, 0:2])
+        nodes[inner, 2:4] = numpy.maximum(nodes[child0, 2:4], nodes[child1, 2:4])
+
+    return numpy.union1d(leaves, ancestors)
+
+
+def prepare_bvh_buffer_data(lines, nodes):
+
+    # Nodes are 8 bytes aligned in the std430 layout
+    line_padding = numpy.zeros(len(lines) % 2, numpy.uint32)
+    buffer_data = numpy.concatenate((lines, line_padding, nodes.view(numpy.uint32).ravel()))
+    return buffer_data.nbytes, buffer_data
@@ -0,0 +1,302 @@
+# coding: utf8
+
+import json
+import os
+import sys
+
+from argparse import ArgumentParser
+
+import numpy
+
+from Config import RAY_COUNT, RAY_GROUP_SIZE, RAY_BOUNCE_COUNT, WORLD_LINE_COUNT
+
+
+CHECK_FRAME_WIDTH = 64
+CHECK_FRAME_HEIGHT = 64
+
+# CPU and GPU rays are computed with different float operations, only the random state has to match bit for bit
+CHECK_RAY_TOLERANCE = 1e-4
+CHECK_RAY_MIN_CLOSE_RATIO = 0.99
+
+CHECK_RANDOM_SAMPLE_COUNT = 5
+
+RANDOM_SAMPLE_COMPUTE_SHADER = """
+#version 430
+
+{include_random_layout}
+{include_random}
+
+layout(std430, binding = 0) writeonly buffer SampleBuffer
+{{
+    float samples[];
+}};
+
+layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
+
+void main()
+{{
+    uint generator_index = gl_GlobalInvocationID.x;
+
+    // Some generators skip a round, their state has to stay behind
+    for (uint round = 0; round < {define_sample_count}; ++round)
+    {{
+        set_random_bounce(round);
+        if ((generator_index + round) % 3 != 0)
+        {{
+            samples[round * {define_ray_count} + generator_index] = random(generator_index);
+        }}
+    }}
+}}
+"""
+
+
+def prepare_random_sample_compute_shader(parameters):
+
+    import Random
+
+    return RANDOM_SAMPLE_COMPUTE_SHADER.format(
+        include_random_layout=Random.prepare_buffer_layout(parameters),
+        include_random=Random.prepare_shader(parameters),
+        ray_group_size=parameters.ray_group_size,
+        define_sample_count=CHECK_RANDOM_SAMPLE_COUNT,
+        define_ray_count=parameters.ray_count
+    )
+
+
+def _read_mt_status(pipeline):
+
+    from Buffer import read_buffer
+
+    ray_count = pipeline.parameters.ray_count
+    return read_buffer(pipeline.random.seed_buffer, numpy.uint32)[:4 * ray_count].reshape(ray_count, 4).T
+
+
+def _run_gpu_random_samples(pipeline):
+
+    from OpenGL.GL import GL_COMPUTE_SHADER, GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, \
+        glUseProgram, glBindBufferBase, glDispatchCompute, glMemoryBarrier
+
+    import Random
+
+    from Buffer import prepare_empty_float_buffer_data, initialize_buffer, read_buffer, dispose_buffer
+    from Shader import get_program
+
+    parameters = pipeline.parameters
+    program = get_program(pipeline.program_cache, (GL_COMPUTE_SHADER, prepare_random_sample_compute_shader(parameters)))
+    sample_buffer = initialize_buffer(prepare_empty_float_buffer_data(CHECK_RANDOM_SAMPLE_COUNT * parameters.ray_count))
+
+    try:
+        Random.init(pipeline.random)
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        glUseProgram(program)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, sample_buffer)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, pipeline.random.seed_buffer)
+        glDispatchCompute(parameters.ray_count // parameters.ray_group_size, 1, 1)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
+        glUseProgram(0)
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        return read_buffer(sample_buffer, numpy.float32).reshape(CHECK_RANDOM_SAMPLE_COUNT, parameters.ray_count)
+    finally:
+        dispose_buffer(sample_buffer)
+
+
+def _check_random(pipeline):
+
+    import CpuRandom
+    import Random
+
+    parameters = pipeline.parameters
+    cpu_random = CpuRandom.Resources()
+    cpu_random.counter = parameters.random_counter
+    cpu_random.initialize(parameters.ray_count)
+
+    checks = []
+    if not parameters.random_counter:
+        Random.init(pipeline.random)
+        checks.append(("random_init", numpy.array_equal(_read_mt_status(pipeline), cpu_random.mt_status)))
+
+    # Samples are compared as bits, skipped samples are never written on either side
+    gpu_samples = _run_gpu_random_samples(pipeline)
+    generator_indices = numpy.arange(parameters.ray_count)
+    samples_equal = True
+    for sample_round in range(CHECK_RANDOM_SAMPLE_COUNT):
+        CpuRandom.set_bounce(cpu_random, sample_round)
+        drawn = generator_indices[(generator_indices + sample_round) % 3 != 0]
+        cpu_samples = CpuRandom.random(cpu_random, drawn)
+        samples_equal &= numpy.array_equal(gpu_samples[sample_round, drawn].view(numpy.uint32), cpu_samples.view(numpy.uint32))
+    checks.append(("random_samples", bool(samples_equal)))
+
+    if not parameters.random_counter:
+        checks.append(("random_state", numpy.array_equal(_read_mt_status(pipeline), cpu_random.mt_status)))
+
+    cpu_random.dispose()
+    return checks
+
+
+def _run_gpu_bounces(pipeline):
+
+    import Random
+    import Ray
+
+    from Buffer import read_buffer
+
+    world, ray, random = pipeline.world, pipeline.ray, pipeline.random
+    parameters = pipeline.parameters
+
+    Random.init(random)
+
+    ray_buffers = []
+    for iteration in range(parameters.ray_bounce_count):
+        Ray.trace(ray, iteration, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+        ray_buffers.append(read_buffer(Ray.get_ray_buffer(ray, iteration), numpy.float32).reshape(4, parameters.ray_count))
+
+    return numpy.stack(ray_buffers)
+
+
+def _run_gpu_paths(pipeline):
+
+    import Random
+    import Ray
+
+    from Buffer import read_buffer
+
+    world, ray, random = pipeline.world, pipeline.ray, pipeline.random
+    parameters = pipeline.parameters
+
+    Random.init(random)
+    Ray.trace_paths(ray, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+
+    # The first vertex is the input ray, the next ones are the rays traced by each bounce
+    path_data = read_buffer(ray.trace_path_buffer, numpy.float32)
+    return path_data.reshape(parameters.ray_bounce_count + 1, 4, parameters.ray_count)[1:]
+
+
+def _run_cpu_bounces(parameters, ray_data, world_data):
+
+    import CpuRandom
+    import CpuRay
+    import CpuWorld
+
+    world = CpuWorld.Resources()
+    world.initialize(world_data)
+    ray = CpuRay.Resources()
+    ray.initialize(ray_data)
+    random = CpuRandom.Resources()
+    random.counter = parameters.random_counter
+    random.initialize(parameters.ray_count)
+
+    ray_buffers = []
+    for iteration in range(parameters.ray_bounce_count):
+        CpuRay.trace(ray, iteration, world, random)
+        ray_buffers.append(CpuRay.get_ray_buffer(ray, iteration).copy())
+
+    random.dispose()
+    ray.dispose()
+    world.dispose()
+
+    return numpy.stack(ray_buffers)
+
+
+def _compare_rays(name, ray_buffers, reference_ray_buffers):
+
+    # Escaped rays hold NaNs or infinities once they leave the scene, equal ones match
+    return name, numpy.array_equal(ray_buffers, reference_ray_buffers, equal_nan=True)
+
+
+def _compare_close_rays(name, ray_buffers, reference_ray_buffers):
+
+    close = numpy.isclose(
+        ray_buffers, reference_ray_buffers, rtol=CHECK_RAY_TOLERANCE, atol=CHECK_RAY_TOLERANCE, equal_nan=True
+    ).all(axis=1)
+    close_ratio = float(close.mean())
+    return name, close_ratio >= CHECK_RAY_MIN_CLOSE_RATIO, close_ratio
+
+
+def _run_checks(pipeline, parameters):
+
+    import Pipeline
+
+    # Every variant traces the same scene, the brute force trace without sort is the reference
+    reference_parameters = parameters._replace(world_bvh=False, ray_sort=False)
+    Pipeline.update_parameters(pipeline, reference_parameters)
+    checks = _check_random(pipeline)
+
+    reference_ray_buffers = _run_gpu_bounces(pipeline)
+    checks.append(_compare_rays("gpu_paths", _run_gpu_paths(pipeline), reference_ray_buffers))
+
+    ray_data, world_data = Pipeline.prepare_scene_data(reference_parameters)
+    cpu_ray_buffers = _run_cpu_bounces(reference_parameters, ray_data, world_data)
+    checks.append(_compare_close_rays("cpu_rays", cpu_ray_buffers, reference_ray_buffers))
+
+    Pipeline.update_parameters(pipeline, reference_parameters._replace(world_bvh=True))
+    checks.append(_compare_rays("gpu_bvh", _run_gpu_bounces(pipeline), reference_ray_buffers))
+
+    Pipeline.update_parameters(pipeline, reference_parameters._replace(ray_sort=True))
+    checks.append(_compare_rays("gpu_sort", _run_gpu_bounces(pipeline), reference_ray_buffers))
+
+    return [
+        dict(zip(("name", "passed", "close_ratio"), check), ray_count=parameters.ray_count,
+             world_line_count=parameters.world_line_count, bounce_count=parameters.ray_bounce_count,
+             random_counter=parameters.random_counter)
+        for check in checks
+    ]
+
+
+def main():
+
+    parser = ArgumentParser(description="Check that CPU and GPU traces and every GPU trace path agree in an offscreen OpenGL context")
+    parser.add_argument("--ray-count", type=int, default=RAY_COUNT)
+    parser.add_argument("--world-line-count", type=int, default=WORLD_LINE_COUNT)
+    parser.add_argument("--bounce-count", type=int, default=RAY_BOUNCE_COUNT)
+    parser.add_argument("--platform", choices=("egl", "osmesa"), default="egl")
+    parser.add_argument("--output", help="JSON file, printed to stdout otherwise")
+    args = parser.parse_args()
+
+    if args.ray_count <= 0 or args.ray_count % RAY_GROUP_SIZE != 0:
+        parser.error("ray count must be a multiple of %d" % RAY_GROUP_SIZE)
+    if args.world_line_count <= 0 or args.world_line_count % 2 != 0:
+        parser.error("world line count must be even")
+    if args.bounce_count <= 0:
+        parser.error("bounce count must be positive")
+
+    # The platform has to be set before OpenGL is imported
+    os.environ["PYOPENGL_PLATFORM"] = args.platform
+
+    import Headless
+    import Pipeline
+
+    headless = Headless.Resources()
+    headless.initialize(CHECK_FRAME_WIDTH, CHECK_FRAME_HEIGHT)
+    renderer, version = Headless.get_renderer()
+    Headless.bind_framebuffer(headless)
+
+    pipeline = Pipeline.Resources()
+    pipeline.initialize()
+
+    # Both generators, the state of the default one and the hash of the counter one have their own CPU mirror
+    results = []
+    for random_counter in (False, True):
+        parameters = Pipeline.prepare_parameters(
+            ray_count=args.ray_count, world_line_count=args.world_line_count, ray_bounce_count=args.bounce_count,
+            random_counter=random_counter
+        )
+        results.extend(_run_checks(pipeline, parameters))
+
+    pipeline.dispose()
+    headless.dispose()
+
+    report = {"platform": args.platform, "renderer": renderer, "version": version, "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+
+    if not all(result["passed"] for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
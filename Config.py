@@ -2,26 +2,93 @@
 
 from random import random, seed
 
+import numpy
+
 
 # Hell yeah !
-seed(42)
+SCENE_SEED = 42
+seed(SCENE_SEED)
+
+
+def random_array(count):
+
+    # Same sequence as calling random() count times
+    return numpy.fromiter((random() for _ in range(count)), numpy.float64, count)
+
 
 # Compute shader settings
 RAY_COUNT = 128 * 16
 RAY_GROUP_SIZE = 128
 
+RAY_BOUNCE_COUNT = 10
+RAY_SINGLE_DISPATCH = True
+
+RANDOM_SEED = 234340
+# Hashed samples instead of a generator state per ray
+RANDOM_COUNTER = False
+
 RAY_DIR_COUNT = 128
 RAY_DIR_GROUP_SIZE = 64
+RAY_DIR_SCATTER = True
+RAY_DIR_SHARED_HISTOGRAM_MAX_COUNT = 4096
+
+# Rays sorted by direction then origin cells before each bounce
+RAY_SORT = False
+RAY_SORT_DIRECTION_BIT_COUNT = 6
+RAY_SORT_ORIGIN_BIT_COUNT = 5
+RAY_SORT_EXTENT = 2.0
+
+# Progressive accumulation through frames
+PROGRESSIVE = True
+PROGRESSIVE_DENSITY_SIZE = 1024
+PROGRESSIVE_DENSITY_EXTENT = 2.0
+
+# CPU trace settings
+CPU_RAY_BATCH_SIZE = 256
+CPU_WORLD_BATCH_SIZE = 4096
+# Processes tracing shards of the live rays, None uses every core
+CPU_PROCESS_COUNT = None
+
+# GPU timings
+TIMER_FRAME_COUNT = 4
+TIMER_SAMPLE_COUNT = 256
+TIMER_PRINT_INTERVAL = 2.0
+
+# Streaming buffers
+STREAM_REGION_COUNT = 3
+STREAM_WAIT_TIMEOUT = 1000000
+
+# Readback of directions and rays, a directory gets one archive per frame, None disables it
+READBACK_PATH = None
+READBACK_REGION_COUNT = 4
+READBACK_WAIT_TIMEOUT = 1000000
+
+# Scene variants traced by a single dispatch in batches
+VARIANT_COUNT = 8
+
+# Linked program binaries, None disables the cache
+PROGRAM_BINARY_CACHE_PATH = ".program_cache"
+
+# GL objects tracking, frames kept from the call stack creating each object
+REGISTRY_STACK_LIMIT = 8
 
 # Ray batch 0
 RAY_INIT_DX = -1.0
 RAY_INIT_DY = -1.0
 RAY_INIT_JITTER_OX = 0.0
 
-RAY0_DATA_OX = [-0.9 + (i / RAY_COUNT) * 1.8 + random() * RAY_INIT_JITTER_OX for i in range(RAY_COUNT)]
-RAY0_DATA_OY = [+0.3] * RAY_COUNT
-RAY0_DATA_DX = [RAY_INIT_DX] * RAY_COUNT
-RAY0_DATA_DY = [RAY_INIT_DY] * RAY_COUNT
+
+def prepare_ray_data(ray_count, init_dx=RAY_INIT_DX, init_dy=RAY_INIT_DY):
+
+    data_ox = -0.9 + (numpy.arange(ray_count) / ray_count) * 1.8 + random_array(ray_count) * RAY_INIT_JITTER_OX
+    data_oy = numpy.full(ray_count, +0.3)
+    data_dx = numpy.full(ray_count, init_dx)
+    data_dy = numpy.full(ray_count, init_dy)
+    return data_ox.astype(numpy.float32), data_oy.astype(numpy.float32), \
+        data_dx.astype(numpy.float32), data_dy.astype(numpy.float32)
+
+
+RAY0_DATA_OX, RAY0_DATA_OY, RAY0_DATA_DX, RAY0_DATA_DY = prepare_ray_data(RAY_COUNT)
 
 #RAY0_DATA_OX = RAY0_DATA_OX[100:101]
 #RAY0_DATA_OY = RAY0_DATA_OY[100:101]
@@ -56,19 +123,37 @@ RAY0_DATA_DY = [RAY_INIT_DY] * RAY_COUNT
 WORLD_LINE_COUNT = 1024
 WORLD_INT_X_JITTER = 0.0
 WORLD_INT_Y_JITTER = 0.01
+# Outside and inside of the slab between both interfaces
+WORLD_INT_IOR = (1.0, 1.4)
+
+
+def prepare_world_data(world_line_count, int_y_jitter=WORLD_INT_Y_JITTER, int_ior=WORLD_INT_IOR):
+
+    ior_outside, ior_inside = int_ior
+    intx_line_count = world_line_count // 2
+    intx_point_count = intx_line_count + 1
+    intx_offset_x = (numpy.arange(intx_point_count) / intx_line_count) * 4.0
+    int0_x = (WORLD_INT_X_JITTER * random_array(intx_point_count) - 2.0 + intx_offset_x).astype(numpy.float32)
+    int0_y = (int_y_jitter * random_array(intx_point_count) + 0.2).astype(numpy.float32)
+    int0_ior_i = numpy.full(intx_line_count, ior_outside, numpy.float32)
+    int0_ior_t = numpy.full(intx_line_count, ior_inside, numpy.float32)
+    int1_x = (WORLD_INT_X_JITTER * random_array(intx_point_count) - 2.0 + intx_offset_x).astype(numpy.float32)
+    int1_y = (int_y_jitter * random_array(intx_point_count) - 0.2).astype(numpy.float32)
+    int1_ior_i = numpy.full(intx_line_count, ior_inside, numpy.float32)
+    int1_ior_t = numpy.full(intx_line_count, ior_outside, numpy.float32)
+    return [int0_x, int1_x], [int0_y, int1_y], [int0_ior_i, int1_ior_i], [int0_ior_t, int1_ior_t]
+
+
+INT_X, INT_Y, INT_IOR_I, INT_IOR_T = prepare_world_data(WORLD_LINE_COUNT)
+
+# Binary scene loaded instead of the generated world, None keeps the generated one
+WORLD_SCENE_PATH = None
+WORLD_SCENE_CHUNK_LINE_COUNT = 1 << 16
+
+# World editing, spare lines are free for inserted polylines and dirty runs closer than the distance are uploaded together
+WORLD_SPARE_LINE_COUNT = 0
+WORLD_EDIT_MERGE_DISTANCE = 32
 
-INTX_LINE_COUNT = WORLD_LINE_COUNT // 2
-INTX_POINT_COUNT = INTX_LINE_COUNT + 1
-INT0_X = [WORLD_INT_X_JITTER * random() - 2.0 + (i / INTX_LINE_COUNT) * 4.0 for i in range(INTX_POINT_COUNT)]
-INT0_Y = [WORLD_INT_Y_JITTER * random() + 0.2 for i in range(INTX_POINT_COUNT)]
-INT0_IOR_I = [1.0] * INTX_LINE_COUNT
-INT0_IOR_T = [1.4] * INTX_LINE_COUNT
-INT1_X = [WORLD_INT_X_JITTER * random() - 2.0 + (i / INTX_LINE_COUNT) * 4.0 for i in range(INTX_POINT_COUNT)]
-INT1_Y = [WORLD_INT_Y_JITTER * random() - 0.2 for i in range(INTX_POINT_COUNT)]
-INT1_IOR_I = [1.4] * INTX_LINE_COUNT
-INT1_IOR_T = [1.0] * INTX_LINE_COUNT
-
-INT_X = [INT0_X, INT1_X]
-INT_Y = [INT0_Y, INT1_Y]
-INT_IOR_I = [INT0_IOR_I, INT1_IOR_I]
-INT_IOR_T = [INT0_IOR_T, INT1_IOR_T]
+# World acceleration structure
+WORLD_BVH = True
+WORLD_BVH_LEAF_SIZE = 4
@@ -0,0 +1,178 @@
+# coding: utf8
+
+import os
+
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy
+
+import CpuRandom
+import CpuRay
+import CpuWorld
+
+from Config import RAY_DIR_COUNT, CPU_PROCESS_COUNT, CPU_RAY_BATCH_SIZE
+
+
+# Arrays shared with the workers, every worker attaches them once and then only receives ray indices
+WORLD_ARRAY_NAMES = ("world_pos_x", "world_pos_y", "world_ior_i", "world_ior_t")
+RAY_ARRAY_NAMES = ("trace_ray0_buffer", "trace_ray1_buffer", "trace_ray2_buffer")
+RANDOM_ARRAY_NAMES = ("mt_status", "mt_m1", "mt_m2", "mt_tmat")
+
+
+def _share_array(shared_memories, array):
+
+    shared_memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+    shared_memories.append(shared_memory)
+    shared_array = numpy.ndarray(array.shape, array.dtype, shared_memory.buf)
+    shared_array[...] = array
+    return shared_array
+
+
+def _share_arrays(shared_memories, descriptors, resources, names):
+
+    for name in names:
+        shared_array = _share_array(shared_memories, getattr(resources, name))
+        setattr(resources, name, shared_array)
+        descriptors[name] = (shared_memories[-1].name, shared_array.shape, shared_array.dtype.str)
+
+
+def _attach_arrays(shared_memories, descriptors, resources, names):
+
+    for name in names:
+        shared_memory_name, shape, dtype = descriptors[name]
+        shared_memory = SharedMemory(name=shared_memory_name)
+        shared_memories.append(shared_memory)
+        setattr(resources, name, numpy.ndarray(shape, dtype, shared_memory.buf))
+
+
+class _Worker(object):
+
+    def __init__(self):
+
+        self.shared_memories = []
+        self.world = CpuWorld.Resources()
+        self.ray = CpuRay.Resources()
+        self.random = CpuRandom.Resources()
+
+
+_worker = None
+
+
+def _initialize_worker(descriptors, world_line_count):
+
+    global _worker
+    _worker = _Worker()
+    _attach_arrays(_worker.shared_memories, descriptors, _worker.world, WORLD_ARRAY_NAMES)
+    _attach_arrays(_worker.shared_memories, descriptors, _worker.ray, RAY_ARRAY_NAMES)
+    _attach_arrays(_worker.shared_memories, descriptors, _worker.random, RANDOM_ARRAY_NAMES)
+    _worker.world.world_line_count = world_line_count
+
+
+def _trace_shard(iteration, ray_indices, random_key):
+
+    # Shards never share a ray, so every generator and every ray buffer column is written by a single worker
+    _worker.random.seed, _worker.random.frame, _worker.random.counter = random_key
+    return CpuRay.trace_rays(_worker.ray, iteration, _worker.world, _worker.random, ray_indices)
+
+
+def _count_shard_directions(iteration, ray_indices, ray_dir_count):
+
+    return CpuRay.count_directions(_worker.ray, iteration, ray_indices, ray_dir_count)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.pool = None
+        self.process_count = 0
+        self.shared_memories = None
+        self.world = None
+        self.ray = None
+        self.random = None
+        self.ray_dir_count = 0
+        self.ray_dir_weights = None
+
+    def initialize(self, ray_data=None, world_data=None, ray_dir_count=RAY_DIR_COUNT, process_count=CPU_PROCESS_COUNT):
+
+        self.world = CpuWorld.Resources()
+        self.world.initialize(world_data)
+        self.ray = CpuRay.Resources()
+        self.ray.initialize(ray_data)
+        self.random = CpuRandom.Resources()
+        self.random.initialize(self.ray.trace_ray0_buffer.shape[1])
+
+        # The parent keeps working on the same memory, init and results need no copy
+        self.shared_memories = []
+        descriptors = {}
+        _share_arrays(self.shared_memories, descriptors, self.world, WORLD_ARRAY_NAMES)
+        _share_arrays(self.shared_memories, descriptors, self.ray, RAY_ARRAY_NAMES)
+        _share_arrays(self.shared_memories, descriptors, self.random, RANDOM_ARRAY_NAMES)
+
+        self.process_count = process_count or os.cpu_count()
+        self.pool = Pool(self.process_count, _initialize_worker, (descriptors, self.world.world_line_count))
+        self.ray_dir_count = ray_dir_count
+        self.ray_dir_weights = numpy.zeros(ray_dir_count, numpy.float32)
+
+    def dispose(self):
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+        # Views go first, shared memory can not be closed while they are alive
+        for resources in (self.world, self.ray, self.random):
+            if resources is not None:
+                resources.dispose()
+        if self.shared_memories is not None:
+            for shared_memory in self.shared_memories:
+                shared_memory.close()
+                shared_memory.unlink()
+
+        self.pool = None
+        self.process_count = 0
+        self.shared_memories = None
+        self.world = None
+        self.ray = None
+        self.random = None
+        self.ray_dir_count = 0
+        self.ray_dir_weights = None
+
+
+def _split_rays(resources, ray_indices):
+
+    # One shard per process, small sets are not worth the round trip
+    shard_count = min(resources.process_count, max(len(ray_indices) // CPU_RAY_BATCH_SIZE, 1))
+    return [shard for shard in numpy.array_split(ray_indices, shard_count) if len(shard) > 0]
+
+
+def init(resources):
+
+    CpuRandom.init(resources.random)
+
+
+def trace(resources, iteration):
+
+    if iteration == 0:
+        resources.ray.trace_live_rays = numpy.arange(resources.ray.trace_ray0_buffer.shape[1])
+
+    random_key = resources.random.seed, resources.random.frame, resources.random.counter
+    live_rays = resources.pool.starmap(_trace_shard, [
+        (iteration, shard, random_key) for shard in _split_rays(resources, resources.ray.trace_live_rays)
+    ])
+
+    # Shards keep their order, the live list is the same as a single process trace
+    resources.ray.trace_live_rays = numpy.concatenate(live_rays) if live_rays else numpy.zeros(0, numpy.intp)
+
+
+def compute_directions(resources, iteration):
+
+    # Same rays and normalization as Ray.compute_directions, per shard histograms are merged here
+    ray_count = resources.ray.trace_ray0_buffer.shape[1]
+    ray_dir_counts = resources.pool.starmap(_count_shard_directions, [
+        (iteration, shard, resources.ray_dir_count) for shard in _split_rays(resources, numpy.arange(ray_count))
+    ])
+    ray_dir_counts = numpy.sum(ray_dir_counts, axis=0, dtype=numpy.uint32)
+    resources.ray_dir_weights = ray_dir_counts.astype(numpy.float32) * numpy.float32(1.0 / ray_count)
+    return resources.ray_dir_weights
@@ -0,0 +1,148 @@
+# coding: utf8
+
+import numpy
+
+from Config import RANDOM_SEED, RANDOM_COUNTER, RAY_COUNT
+
+
+# Mirrors SHADER and INIT_SHADER from Random.py, one column per generator and every generator advances in lock step
+MT_M1 = 0xf50a1d49
+MT_M2 = 0xffa8ffeb
+MT_TMAT = 0x0bf2bfff
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.mt_status = None
+        self.mt_m1 = None
+        self.mt_m2 = None
+        self.mt_tmat = None
+        self.seed = RANDOM_SEED
+        self.counter = RANDOM_COUNTER
+        self.frame = 0
+        self.bounce = 0
+
+    def initialize(self, generator_count=RAY_COUNT):
+
+        self.mt_status = numpy.zeros((4, generator_count), numpy.uint32)
+        self.mt_m1 = numpy.full(generator_count, MT_M1, numpy.uint32)
+        self.mt_m2 = numpy.full(generator_count, MT_M2, numpy.uint32)
+        self.mt_tmat = numpy.full(generator_count, MT_TMAT, numpy.uint32)
+        init(self)
+
+    def dispose(self):
+
+        self.mt_status = None
+        self.mt_m1 = None
+        self.mt_m2 = None
+        self.mt_tmat = None
+
+
+def _next_state(status, m1, m2, tmat):
+
+    x = (status[0] & numpy.uint32(0x7fffffff)) ^ status[1] ^ status[2]
+    x ^= x << numpy.uint32(1)
+    y = status[3] ^ (status[3] >> numpy.uint32(1)) ^ x
+
+    # -(y & 1) is an all ones mask when the lowest bit is set
+    mask = numpy.uint32(0) - (y & numpy.uint32(1))
+    next_status = numpy.empty_like(status)
+    next_status[0] = status[1]
+    next_status[1] = status[2] ^ (mask & m1)
+    next_status[2] = x ^ (y << numpy.uint32(10)) ^ (mask & m2)
+    next_status[3] = y
+
+    t1 = next_status[0] + (next_status[2] >> numpy.uint32(8))
+    t0 = next_status[3] ^ t1 ^ ((numpy.uint32(0) - (t1 & numpy.uint32(1))) & tmat)
+
+    return next_status, t0
+
+
+def _init_mt(resources):
+
+    generator_count = resources.mt_status.shape[1]
+    status = resources.mt_status
+    status[0] = numpy.uint32(resources.seed) ^ numpy.arange(generator_count, dtype=numpy.uint32)
+    status[1] = resources.mt_m1
+    status[2] = resources.mt_m2
+    status[3] = resources.mt_tmat
+
+    # Same operator precedence as the shader: (i + 1812433253 * s) ^ (s >> 30)
+    for i in range(1, 8):
+        previous_status = status[(i - 1) & 3]
+        status[i & 3] ^= (numpy.uint32(i) + numpy.uint32(1812433253) * previous_status) ^ (previous_status >> numpy.uint32(30))
+
+    for _ in range(12):
+        status[:], _ = _next_state(status, resources.mt_m1, resources.mt_m2, resources.mt_tmat)
+
+
+def init(resources):
+
+    resources.frame = 0
+    if resources.mt_status is not None:
+        _init_mt(resources)
+
+
+def advance(resources):
+
+    resources.frame += 1
+
+
+def set_bounce(resources, bounce):
+
+    resources.bounce = bounce
+
+
+def _pcg4d_mix(x, y, z, w):
+
+    x = x + y * w
+    y = y + z * x
+    z = z + x * y
+    w = w + y * z
+    return x, y, z, w
+
+
+def _pcg4d(x, y, z, w):
+
+    # Mirrors COUNTER_SHADER from Random.py, uint32 arrays wrap around like GLSL
+    x, y, z, w = (v * numpy.uint32(1664525) + numpy.uint32(1013904223) for v in (x, y, z, w))
+    x, y, z, w = _pcg4d_mix(x, y, z, w)
+    x, y, z, w = (v ^ (v >> numpy.uint32(16)) for v in (x, y, z, w))
+    return _pcg4d_mix(x, y, z, w)
+
+
+def _counter_random(resources, generator_indices):
+
+    # Trace draws a single sample per ray and bounce, the first one of the bounce
+    generator_indices = numpy.asarray(generator_indices, numpy.uint32)
+    key = numpy.ones_like(generator_indices)
+    x, _, _, _ = _pcg4d(
+        generator_indices,
+        key * numpy.uint32(resources.bounce << 16),
+        key * numpy.uint32(resources.frame),
+        key * numpy.uint32(resources.seed)
+    )
+    return (x >> 8).astype(numpy.float32) * numpy.float32(1.0 / 16777216.0)
+
+
+def _mt_random(resources, generator_indices):
+
+    status, t0 = _next_state(
+        resources.mt_status[:, generator_indices],
+        resources.mt_m1[generator_indices],
+        resources.mt_m2[generator_indices],
+        resources.mt_tmat[generator_indices]
+    )
+    resources.mt_status[:, generator_indices] = status
+
+    # The shader converts to float before scaling, the result can round up to 1.0 like on the GPU
+    return t0.astype(numpy.float32) * numpy.float32(1.0 / 4294967296.0)
+
+
+def random(resources, generator_indices):
+
+    if resources.counter:
+        return _counter_random(resources, generator_indices)
+    return _mt_random(resources, generator_indices)
@@ -0,0 +1,264 @@
+# coding: utf8
+
+import numpy
+
+from CpuWorld import get_world_lines
+from CpuRandom import random, set_bounce
+from Config import CPU_RAY_BATCH_SIZE, CPU_WORLD_BATCH_SIZE, RAY0_DATA_OX, RAY0_DATA_OY, RAY0_DATA_DX, RAY0_DATA_DY
+
+
+# Mirrors TRACE_COMPUTE_SHADER from Ray.py, every computation is done in float32 like on the GPU
+
+
+def _normalize(x, y):
+
+    inv_length = numpy.float32(1.0) / numpy.sqrt(x * x + y * y)
+    return x * inv_length, y * inv_length
+
+
+def _refract(i_x, i_y, n_x, n_y, cos_theta, inv_eta):
+
+    cost2 = numpy.float32(1.0) - inv_eta * inv_eta * (numpy.float32(1.0) - cos_theta * cos_theta)
+    t = inv_eta * cos_theta - numpy.sqrt(numpy.abs(cost2))
+    mask = (cost2 > 0.0).astype(numpy.float32)
+    return (inv_eta * i_x + t * n_x) * mask, (inv_eta * i_y + t * n_y) * mask
+
+
+def _reflect(i_x, i_y, n_x, n_y, cos_theta):
+
+    return i_x + numpy.float32(2.0) * n_x * cos_theta, i_y + numpy.float32(2.0) * n_y * cos_theta
+
+
+def _fresnel_dielectric_dielectric(eta, cos_theta):
+
+    sin_theta_2 = numpy.float32(1.0) - cos_theta * cos_theta
+
+    t0 = numpy.sqrt(numpy.float32(1.0) - (sin_theta_2 / (eta * eta)))
+    t1 = eta * t0
+    t2 = eta * cos_theta
+
+    rs = (cos_theta - t1) / (cos_theta + t1)
+    rp = (t0 - t2) / (t0 + t2)
+
+    return numpy.float32(0.5) * (rs * rs + rp * rp)
+
+
+def _intersect_world(world, ray0_o0_x, ray0_o0_y, ray0_d0_x, ray0_d0_y, ray0_o1_x, ray0_o1_y):
+
+    ray_count = len(ray0_o0_x)
+
+    # Homogeneous ray lines, one row per ray
+    ray_l_x = (ray0_o0_y - ray0_o1_y)[:, None]
+    ray_l_y = (ray0_o1_x - ray0_o0_x)[:, None]
+    ray_l_z = (ray0_o0_x * ray0_o1_y - ray0_o0_y * ray0_o1_x)[:, None]
+
+    min_hit_x = ray0_o1_x.copy()
+    min_hit_y = ray0_o1_y.copy()
+    min_dist = numpy.full(ray_count, 1e32, numpy.float32)
+    min_line = numpy.full(ray_count, -1, numpy.int64)
+
+    for first_line in range(0, world.world_line_count, CPU_WORLD_BATCH_SIZE):
+
+        last_line = min(first_line + CPU_WORLD_BATCH_SIZE, world.world_line_count)
+        int_o0_x, int_o0_y, int_o1_x, int_o1_y, _, _ = get_world_lines(world, first_line, last_line)
+
+        # Homogeneous world lines, one column per world line
+        int_l_x = int_o0_y - int_o1_y
+        int_l_y = int_o1_x - int_o0_x
+        int_l_z = int_o0_x * int_o1_y - int_o0_y * int_o1_x
+
+        hit_p_x = ray_l_y * int_l_z - ray_l_z * int_l_y
+        hit_p_y = ray_l_z * int_l_x - ray_l_x * int_l_z
+        hit_p_z = ray_l_x * int_l_y - ray_l_y * int_l_x
+
+        valid = numpy.abs(hit_p_z) > 0.0
+        hit_x = hit_p_x / hit_p_z
+        hit_y = hit_p_y / hit_p_z
+
+        dist_hit = ray0_d0_x[:, None] * (hit_x - ray0_o0_x[:, None]) + ray0_d0_y[:, None] * (hit_y - ray0_o0_y[:, None])
+        valid &= (0.0 < dist_hit) & (dist_hit < numpy.float32(1e32))
+
+        int_d_x = int_o1_x - int_o0_x
+        int_d_y = int_o1_y - int_o0_y
+        dist_int = int_d_x * (hit_x - int_o0_x) + int_d_y * (hit_y - int_o0_y)
+        # +1e-8 is an epsilon for handling precision issues
+        valid &= (0.0 < dist_int) & (dist_int <= (int_d_x * int_d_x + int_d_y * int_d_y) + numpy.float32(1e-8))
+
+        # First minimum wins, exactly like the strict comparison in the shader loop
+        dist_hit = numpy.where(valid, dist_hit, numpy.float32(numpy.inf))
+        batch_line = numpy.argmin(dist_hit, axis=1)
+        rays = numpy.arange(ray_count)
+        batch_dist = dist_hit[rays, batch_line]
+        closer = batch_dist < min_dist
+
+        min_dist[closer] = batch_dist[closer]
+        min_line[closer] = first_line + batch_line[closer]
+        min_hit_x[closer] = hit_x[rays, batch_line][closer]
+        min_hit_y[closer] = hit_y[rays, batch_line][closer]
+
+    return min_hit_x, min_hit_y, min_dist, min_line
+
+
+def _trace_batch(world, random_resources, ray_indices, ray0, ray1):
+
+    ray0_d0_x, ray0_d0_y = _normalize(ray0[2], ray0[3])
+    ray0_o0_x = ray0[0]
+    ray0_o0_y = ray0[1]
+    ray0_o1_x = ray0_o0_x + numpy.float32(1e6) * ray0_d0_x
+    ray0_o1_y = ray0_o0_y + numpy.float32(1e6) * ray0_d0_y
+
+    min_hit_x, min_hit_y, min_dist, min_line = _intersect_world(
+        world, ray0_o0_x, ray0_o0_y, ray0_d0_x, ray0_d0_y, ray0_o1_x, ray0_o1_y
+    )
+
+    ray1[0] = ray0_o1_x
+    ray1[1] = ray0_o1_y
+    ray1[2] = ray0_d0_x
+    ray1[3] = ray0_d0_y
+
+    hit = numpy.nonzero(min_dist < numpy.float32(1e32))[0]
+    if len(hit) == 0:
+        return hit
+
+    d0_x = ray0_d0_x[hit]
+    d0_y = ray0_d0_y[hit]
+    hit_x = min_hit_x[hit]
+    hit_y = min_hit_y[hit]
+
+    int_o0_x, int_o0_y, int_o1_x, int_o1_y, _, _ = get_world_lines(world, 0, world.world_line_count)
+    line = min_line[hit]
+    min_normal_x, min_normal_y = _normalize(
+        -(int_o1_y[line] - int_o0_y[line]),
+        int_o1_x[line] - int_o0_x[line]
+    )
+    min_ior_i = world.world_ior_i[line]
+    min_ior_t = world.world_ior_t[line]
+
+    cos_theta = min_normal_x * -d0_x + min_normal_y * -d0_y
+    back_face = cos_theta < 0.0
+    min_normal_x = numpy.where(back_face, -min_normal_x, min_normal_x)
+    min_normal_y = numpy.where(back_face, -min_normal_y, min_normal_y)
+    cos_theta = min_normal_x * -d0_x + min_normal_y * -d0_y
+    eta = numpy.where(back_face, min_ior_i / min_ior_t, min_ior_t / min_ior_i)
+
+    f = _fresnel_dielectric_dielectric(eta, cos_theta)
+
+    is_reflected = random(random_resources, ray_indices[hit]) < f
+
+    reflect_d_x, reflect_d_y = _reflect(d0_x, d0_y, min_normal_x, min_normal_y, cos_theta)
+    refract_d_x, refract_d_y = _refract(d0_x, d0_y, min_normal_x, min_normal_y, cos_theta, numpy.float32(1.0) / eta)
+    offset = numpy.where(is_reflected, numpy.float32(1e-6), numpy.float32(-1e-6))
+
+    ray1[0][hit] = hit_x + offset * min_normal_x
+    ray1[1][hit] = hit_y + offset * min_normal_y
+    ray1[2][hit] = numpy.where(is_reflected, reflect_d_x, refract_d_x)
+    ray1[3][hit] = numpy.where(is_reflected, reflect_d_y, refract_d_y)
+
+    return hit
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.trace_ray0_buffer = None
+        self.trace_ray1_buffer = None
+        self.trace_ray2_buffer = None
+        self.trace_live_rays = None
+
+    def initialize(self, ray_data=None):
+
+        # Same structure of arrays as the ray buffers: ox, oy, dx, dy
+        if ray_data is None:
+            ray_data = RAY0_DATA_OX, RAY0_DATA_OY, RAY0_DATA_DX, RAY0_DATA_DY
+        self.trace_ray0_buffer = numpy.array(ray_data, numpy.float32)
+        ray_count = self.trace_ray0_buffer.shape[1]
+        self.trace_ray1_buffer = numpy.zeros((4, ray_count), numpy.float32)
+        self.trace_ray2_buffer = numpy.zeros((4, ray_count), numpy.float32)
+        self.trace_live_rays = numpy.arange(ray_count)
+
+    def dispose(self):
+
+        self.trace_ray0_buffer = None
+        self.trace_ray1_buffer = None
+        self.trace_ray2_buffer = None
+        self.trace_live_rays = None
+
+
+def _select_input_buffer(resources, iteration):
+
+    if iteration == 0:
+        return resources.trace_ray0_buffer  # we never mutate this buffer
+    elif iteration % 2 == 0:
+        return resources.trace_ray2_buffer
+    else:
+        return resources.trace_ray1_buffer
+
+
+def _select_output_buffer(resources, iteration):
+
+    if iteration % 2 == 0:
+        return resources.trace_ray1_buffer
+    else:
+        return resources.trace_ray2_buffer
+
+
+def get_ray_buffer(resources, iteration):
+
+    # Same buffer as Ray.get_ray_buffer for the same bounce
+    return _select_output_buffer(resources, iteration)
+
+
+def trace_rays(resources, iteration, world, random_resources, ray_indices):
+
+    ray0_buffer = _select_input_buffer(resources, iteration)
+    ray1_buffer = _select_output_buffer(resources, iteration)
+    ray2_buffer = _select_output_buffer(resources, iteration + 1)
+
+    set_bounce(random_resources, iteration)
+
+    # Same compaction as the GPU trace, escaped rays are frozen in the next output buffer and never traced again
+    live_rays = []
+    with numpy.errstate(invalid="ignore", divide="ignore", over="ignore"):
+        for first_ray in range(0, len(ray_indices), CPU_RAY_BATCH_SIZE):
+            batch_indices = ray_indices[first_ray:first_ray + CPU_RAY_BATCH_SIZE]
+            ray1 = numpy.empty((4, len(batch_indices)), numpy.float32)
+            hit = _trace_batch(world, random_resources, batch_indices, ray0_buffer[:, batch_indices], ray1)
+            ray1_buffer[:, batch_indices] = ray1
+            escaped = numpy.ones(len(batch_indices), bool)
+            escaped[hit] = False
+            ray2_buffer[:, batch_indices[escaped]] = ray1[:, escaped]
+            live_rays.append(batch_indices[hit])
+
+    return numpy.concatenate(live_rays) if live_rays else numpy.zeros(0, numpy.intp)
+
+
+def trace(resources, iteration, world, random_resources):
+
+    if iteration == 0:
+        resources.trace_live_rays = numpy.arange(resources.trace_ray0_buffer.shape[1])
+
+    resources.trace_live_rays = trace_rays(resources, iteration, world, random_resources, resources.trace_live_rays)
+
+
+def count_directions(resources, iteration, ray_indices, ray_dir_count):
+
+    # Mirrors SCATTER_COMPUTE_SHADER from Ray.py, which bins rays like GATHER_COMPUTE_SHADER
+    ray_buffer = _select_input_buffer(resources, iteration)
+    ray_dir_counts = numpy.zeros(ray_dir_count, numpy.uint32)
+    with numpy.errstate(invalid="ignore", divide="ignore"):
+        ray_d_x, ray_d_y = _normalize(ray_buffer[2, ray_indices], ray_buffer[3, ray_indices])
+    upward = ray_d_y > 0.0
+    ray_angle = numpy.arccos(ray_d_x[upward])
+
+    pi = numpy.float32(numpy.pi)
+    dir_step = pi / numpy.float32(ray_dir_count - 1)
+    dir_center = numpy.round(ray_angle / dir_step).astype(numpy.int64)
+    for dir_offset in (-1, 0, 1):
+        dir_index = dir_center + dir_offset
+        valid = (0 <= dir_index) & (dir_index < ray_dir_count)
+        dir_angle = pi * (dir_index[valid].astype(numpy.float32) / numpy.float32(ray_dir_count - 1))
+        counted = numpy.abs(ray_angle[valid] - dir_angle) < dir_step
+        numpy.add.at(ray_dir_counts, dir_index[valid][counted], 1)
+
+    return ray_dir_counts
@@ -0,0 +1,47 @@
+# coding: utf8
+
+import numpy
+
+from Config import INT_X, INT_Y, INT_IOR_I, INT_IOR_T
+
+from World import prepare_lines
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.world_pos_x = None
+        self.world_pos_y = None
+        self.world_ior_i = None
+        self.world_ior_t = None
+        self.world_line_count = None
+
+    def initialize(self, world_data=None):
+
+        # Same structure of arrays as the World buffer, points are stored in pairs
+        int_x, int_y, int_ior_i, int_ior_t = world_data if world_data is not None else (INT_X, INT_Y, INT_IOR_I, INT_IOR_T)
+        self.world_pos_x = numpy.concatenate([prepare_lines(line_strip) for line_strip in int_x])
+        self.world_pos_y = numpy.concatenate([prepare_lines(line_strip) for line_strip in int_y])
+        self.world_ior_i = numpy.concatenate(int_ior_i).astype(numpy.float32)
+        self.world_ior_t = numpy.concatenate(int_ior_t).astype(numpy.float32)
+        self.world_line_count = len(self.world_ior_i)
+
+    def dispose(self):
+
+        self.world_pos_x = None
+        self.world_pos_y = None
+        self.world_ior_i = None
+        self.world_ior_t = None
+        self.world_line_count = None
+
+
+def get_world_lines(resources, first_line, last_line):
+
+    p0_x = resources.world_pos_x[first_line << 1:last_line << 1:2]
+    p0_y = resources.world_pos_y[first_line << 1:last_line << 1:2]
+    p1_x = resources.world_pos_x[(first_line << 1) + 1:last_line << 1:2]
+    p1_y = resources.world_pos_y[(first_line << 1) + 1:last_line << 1:2]
+    ior_i = resources.world_ior_i[first_line:last_line]
+    ior_t = resources.world_ior_t[first_line:last_line]
+    return p0_x, p0_y, p1_x, p1_y, ior_i, ior_t
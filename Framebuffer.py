@@ -0,0 +1,60 @@
+# coding: utf8
+
+from OpenGL.GL import GL_TEXTURE_2D, GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_FRAMEBUFFER_COMPLETE, \
+    GL_TEXTURE_MIN_FILTER, GL_TEXTURE_MAG_FILTER, GL_TEXTURE_WRAP_S, GL_TEXTURE_WRAP_T, GL_LINEAR, GL_CLAMP_TO_EDGE, \
+    GL_R32F, GL_R32UI, GL_RG32F, GL_RGBA8, GL_RGBA16F, GL_RGBA32F, GLuint, \
+    glGenTextures, glDeleteTextures, glBindTexture, glTexStorage2D, glTexParameteri, \
+    glGenFramebuffers, glDeleteFramebuffers, glBindFramebuffer, glFramebufferTexture2D, glCheckFramebufferStatus
+
+import Registry
+
+
+TEXEL_SIZES = {
+    GL_R32F: 4,
+    GL_R32UI: 4,
+    GL_RG32F: 8,
+    GL_RGBA8: 4,
+    GL_RGBA16F: 8,
+    GL_RGBA32F: 16
+}
+
+
+def initialize_texture(width, height, internal_format):
+
+    texture = GLuint(0)
+    glGenTextures(1, texture)
+    glBindTexture(GL_TEXTURE_2D, texture)
+    glTexStorage2D(GL_TEXTURE_2D, 1, internal_format, width, height)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MIN_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_MAG_FILTER, GL_LINEAR)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_S, GL_CLAMP_TO_EDGE)
+    glTexParameteri(GL_TEXTURE_2D, GL_TEXTURE_WRAP_T, GL_CLAMP_TO_EDGE)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    return Registry.track("texture", texture, width * height * TEXEL_SIZES.get(internal_format, 0))
+
+
+def dispose_texture(texture):
+
+    if texture is not None:
+        Registry.untrack("texture", texture)
+        glDeleteTextures(1, texture)
+
+
+def initialize_framebuffer(texture):
+
+    framebuffer = GLuint(0)
+    glGenFramebuffers(1, framebuffer)
+    glBindFramebuffer(GL_FRAMEBUFFER, framebuffer)
+    glFramebufferTexture2D(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_TEXTURE_2D, texture, 0)
+    status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    if status != GL_FRAMEBUFFER_COMPLETE:
+        raise RuntimeError("Framebuffer is incomplete (%s)" % status)
+    return Registry.track("framebuffer", framebuffer)
+
+
+def dispose_framebuffer(framebuffer):
+
+    if framebuffer is not None:
+        Registry.untrack("framebuffer", framebuffer)
+        glDeleteFramebuffers(1, framebuffer)
@@ -4,11 +4,19 @@ from OpenGL.GL import GL_COLOR_BUFFER_BIT, glViewport, glClear, glClearColor
 
 from glm import mat3, vec3, vec2, inverse, abs, sign
 
+import numpy
 
+import Pipeline
+import Progressive
 import Random
 import Ray
+import Readback
+import Registry
+import Timer
 import World
 
+from Config import RAY_SINGLE_DISPATCH, PROGRESSIVE, TIMER_PRINT_INTERVAL, READBACK_PATH
+
 
 def mat_projection(window_width, window_height):
 
@@ -40,6 +48,16 @@ def mat_inv_viewport(window_width, window_height):
     return mat3(2.0 / window_width, 0.0, 0.0, 0.0, -2.0 / window_height, 0.0, -1.0, +1.0, 1.0)
 
 
+def prepare_readback_fields(parameters):
+
+    # Paths hold every bounce, otherwise only the rays of the last bounce are left
+    if RAY_SINGLE_DISPATCH:
+        ray_float_count = (parameters.ray_bounce_count + 1) * 4 * parameters.ray_count
+    else:
+        ray_float_count = 4 * parameters.ray_count
+    return ("ray_dir_weights", numpy.float32, parameters.ray_dir_count), ("rays", numpy.float32, ray_float_count)
+
+
 def max_abs(v):
 
     if abs(v.x) > abs(v.y):
@@ -67,15 +85,25 @@ def main():
     # Enable VSync
     glfw.swap_interval(1)
 
-    # World
-    world = World.Resources()
-    world.initialize()
+    # World and rays
+    pipeline = Pipeline.Resources()
+    pipeline.initialize()
+
+    world = pipeline.world
+    ray = pipeline.ray
+    random = pipeline.random
+
+    progressive = Progressive.Resources()
+    progressive.initialize()
 
-    ray = Ray.Resources()
-    ray.initialize()
+    timer = Timer.Resources()
+    timer.initialize()
+    last_timer_print_time = glfw.get_time()
 
-    random = Random.Resources()
-    random.initialize()
+    # Streamed to disk without waiting for the GPU, sized again whenever the parameters change
+    readback = Readback.Resources()
+    readback_parameters = None
+    frame_index = 0
 
     # OpenGL
     glClearColor(0.2, 0.2, 0.2, 0)
@@ -87,6 +115,13 @@ def main():
     transform_view = mat3(1.0)
     last_view = mat3(1.0)
 
+    # Emitter
+    last_emitter_cursor = None
+
+    # Ray count
+    key_minus_was_pressed = False
+    key_equal_was_pressed = False
+
     while not glfw.window_should_close(window):
 
         window_width, window_height = glfw.get_window_size(window)
@@ -130,25 +165,137 @@ def main():
         current_view = last_view * transform_view
         current_view_projection = projection * current_view
 
-        # Keep random stable through frames
-        Random.init(random)
-
-        # Display rays
-        glViewport(0, 0, window_width, window_height)
-        glClear(GL_COLOR_BUFFER_BIT)
+        # Halve or double the ray count, programs of every count are only compiled once
+        key_minus_is_pressed = bool(glfw.get_key(window, glfw.KEY_MINUS))
+        key_equal_is_pressed = bool(glfw.get_key(window, glfw.KEY_EQUAL))
+        ray_count = pipeline.parameters.ray_count
+        if key_minus_was_pressed and not key_minus_is_pressed:
+            ray_count = max(ray_count >> 1, pipeline.parameters.ray_group_size)
+        if key_equal_was_pressed and not key_equal_is_pressed:
+            ray_count = ray_count << 1
+        if ray_count != pipeline.parameters.ray_count:
+            Pipeline.update_parameters(pipeline, pipeline.parameters._replace(ray_count=ray_count))
+            last_emitter_cursor = None
+        key_minus_was_pressed = key_minus_is_pressed
+        key_equal_was_pressed = key_equal_is_pressed
+
+        ray_bounce_count = pipeline.parameters.ray_bounce_count
+
+        # Drag the emitted rays with the middle button
+        if glfw.get_mouse_button(window, 2) and next_cursor != last_emitter_cursor:
+            data_ox, data_oy, data_dx, data_dy = pipeline.ray_data
+            emitter_offset = next_cursor - vec2(float(data_ox.mean()), float(data_oy.mean()))
+            Ray.update_emitter(ray, data_ox + emitter_offset.x, data_oy + emitter_offset.y, data_dx, data_dy)
+            last_emitter_cursor = next_cursor
+
+        Timer.begin_frame(timer)
+
+        # Traced paths only depend on the world, the emitted rays and the random seed
+        trace_key = (world.version, ray.version, random.seed)
+
+        if PROGRESSIVE:
+            # Let random advance through frames and only start over when the simulation changes
+            if progressive.key != trace_key:
+                with Timer.measure(timer, "Random.init"):
+                    Random.init(random)
+                Ray.reset_directions(ray)
+                Progressive.reset(progressive, trace_key)
+            else:
+                Random.advance(random)
 
-        World.display(world, current_view_projection)
+            Progressive.begin_accumulation(progressive)
 
-        for iteration in range(10):
-            Ray.trace(ray, iteration, world.display_buffer, random.seed_buffer)
-            Ray.display_lines(ray, current_view_projection, iteration)
+            if RAY_SINGLE_DISPATCH:
+                with Timer.measure(timer, "Ray.trace_paths"):
+                    Ray.trace_paths(ray, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+                with Timer.measure(timer, "Ray.display_paths"):
+                    Ray.display_paths(ray, Progressive.DENSITY_VIEW_PROJECTION)
+                with Timer.measure(timer, "Ray.compute_directions"):
+                    Ray.accumulate_path_directions(ray, ray_bounce_count - 1)
+            else:
+                for iteration in range(ray_bounce_count):
+                    with Timer.measure(timer, "Ray.trace %d" % iteration):
+                        Ray.trace(ray, iteration, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+                    with Timer.measure(timer, "Ray.display_lines %d" % iteration):
+                        Ray.display_lines(ray, Progressive.DENSITY_VIEW_PROJECTION, iteration)
+                with Timer.measure(timer, "Ray.compute_directions"):
+                    Ray.accumulate_directions(ray, iteration)
+
+            Progressive.end_accumulation(progressive)
+
+            glViewport(0, 0, window_width, window_height)
+            glClear(GL_COLOR_BUFFER_BIT)
+
+            with Timer.measure(timer, "World.display"):
+                World.display(world, current_view_projection)
+            with Timer.measure(timer, "Progressive.display"):
+                Progressive.display(progressive, current_view_projection)
+
+        elif RAY_SINGLE_DISPATCH:
+            # Keep traced paths through frames, panning and zooming only redraw them
+            if ray.trace_key != trace_key:
+                with Timer.measure(timer, "Random.init"):
+                    Random.init(random)
+                with Timer.measure(timer, "Ray.trace_paths"):
+                    Ray.trace_paths(ray, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+                with Timer.measure(timer, "Ray.compute_directions"):
+                    Ray.compute_path_directions(ray, ray_bounce_count - 1)
+                ray.trace_key = trace_key
+
+            glViewport(0, 0, window_width, window_height)
+            glClear(GL_COLOR_BUFFER_BIT)
+
+            with Timer.measure(timer, "World.display"):
+                World.display(world, current_view_projection)
+            with Timer.measure(timer, "Ray.display_paths"):
+                Ray.display_paths(ray, current_view_projection)
 
-        Ray.display_directions(ray, iteration)
+        else:
+            # Keep random stable through frames
+            with Timer.measure(timer, "Random.init"):
+                Random.init(random)
+
+            glViewport(0, 0, window_width, window_height)
+            glClear(GL_COLOR_BUFFER_BIT)
+
+            with Timer.measure(timer, "World.display"):
+                World.display(world, current_view_projection)
+            for iteration in range(ray_bounce_count):
+                with Timer.measure(timer, "Ray.trace %d" % iteration):
+                    Ray.trace(ray, iteration, world.display_buffer, world.bvh_buffer, random.seed_buffer)
+                with Timer.measure(timer, "Ray.display_lines %d" % iteration):
+                    Ray.display_lines(ray, current_view_projection, iteration)
+            with Timer.measure(timer, "Ray.compute_directions"):
+                Ray.compute_directions(ray, iteration)
+
+        with Timer.measure(timer, "Ray.draw_directions"):
+            Ray.draw_directions(ray)
+
+        if READBACK_PATH is not None:
+            if readback_parameters != pipeline.parameters:
+                readback.dispose()
+                readback.initialize(prepare_readback_fields(pipeline.parameters), Readback.prepare_directory_consumer(READBACK_PATH))
+                readback_parameters = pipeline.parameters
+            rays_buffer = ray.trace_path_buffer if RAY_SINGLE_DISPATCH else Ray.get_ray_buffer(ray, ray_bounce_count - 1)
+            with Timer.measure(timer, "Readback.read_region"):
+                Readback.read_region(readback, frame_index, ray.display_dir_buffer, rays_buffer)
+        frame_index += 1
+
+        # Timings
+        if TIMER_PRINT_INTERVAL > 0.0 and glfw.get_time() - last_timer_print_time > TIMER_PRINT_INTERVAL:
+            print(Timer.format_statistics(timer))
+            last_timer_print_time = glfw.get_time()
 
         # Done !
         glfw.swap_buffers(window)
         glfw.poll_events()
 
+    readback.dispose()
+    timer.dispose()
+    progressive.dispose()
+    pipeline.dispose()
+    print(Registry.format_leaks())
+
     glfw.terminate()
 
 
@@ -0,0 +1,160 @@
+# coding: utf8
+
+import os
+
+# PyOpenGL picks its platform once, when OpenGL is imported for the first time
+PLATFORM = os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+
+from ctypes import pointer
+
+from OpenGL.GL import GL_FRAMEBUFFER, GL_RENDERBUFFER, GL_COLOR_ATTACHMENT0, GL_FRAMEBUFFER_COMPLETE, GL_RGBA8, \
+    GL_UNSIGNED_BYTE, GL_RENDERER, GL_VERSION, GLuint, \
+    glGenFramebuffers, glDeleteFramebuffers, glBindFramebuffer, glCheckFramebufferStatus, glFramebufferRenderbuffer, \
+    glGenRenderbuffers, glDeleteRenderbuffers, glBindRenderbuffer, glRenderbufferStorage, glViewport, glGetString
+
+import Registry
+
+
+# Mesa's EGL_MESA_platform_surfaceless, it needs neither a display server nor a GPU when running on llvmpipe
+EGL_PLATFORM_SURFACELESS_MESA = 0x31DD
+
+
+def _initialize_egl_context():
+
+    from OpenGL import EGL
+    from OpenGL.EGL.EXT.platform_base import eglGetPlatformDisplayEXT
+
+    display = eglGetPlatformDisplayEXT(EGL_PLATFORM_SURFACELESS_MESA, None, None)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+    if not EGL.eglInitialize(display, pointer(major), pointer(minor)):
+        raise RuntimeError("Failed to initialize the EGL display")
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+    context_attributes = (EGL.EGLint * 7)(
+        EGL.EGL_CONTEXT_MAJOR_VERSION, 4,
+        EGL.EGL_CONTEXT_MINOR_VERSION, 5,
+        EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+        EGL.EGL_NONE
+    )
+    context = EGL.eglCreateContext(display, None, EGL.EGL_NO_CONTEXT, context_attributes)
+    if context == EGL.EGL_NO_CONTEXT:
+        raise RuntimeError("Failed to create an EGL context")
+
+    EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context)
+    return display, context, None
+
+
+def _dispose_egl_context(display, context):
+
+    from OpenGL import EGL
+
+    EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, EGL.EGL_NO_CONTEXT)
+    EGL.eglDestroyContext(display, context)
+    EGL.eglTerminate(display)
+
+
+def _initialize_osmesa_context(width, height):
+
+    from OpenGL import osmesa, arrays
+
+    context_attributes = (
+        osmesa.OSMESA_FORMAT, osmesa.OSMESA_RGBA,
+        osmesa.OSMESA_PROFILE, osmesa.OSMESA_CORE_PROFILE,
+        osmesa.OSMESA_CONTEXT_MAJOR_VERSION, 4,
+        osmesa.OSMESA_CONTEXT_MINOR_VERSION, 5,
+        0
+    )
+    context = osmesa.OSMesaCreateContextAttribs(context_attributes, None)
+    if not context:
+        raise RuntimeError("Failed to create an OSMesa context")
+
+    # OSMesa always renders to client memory, it is kept alive as long as the context
+    color_buffer = arrays.GLubyteArray.zeros((height, width, 4))
+    if not osmesa.OSMesaMakeCurrent(context, color_buffer, GL_UNSIGNED_BYTE, width, height):
+        raise RuntimeError("Failed to make the OSMesa context current")
+
+    return None, context, color_buffer
+
+
+def _dispose_osmesa_context(context):
+
+    from OpenGL import osmesa
+
+    osmesa.OSMesaDestroyContext(context)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.display = None
+        self.context = None
+        self.context_color_buffer = None
+        self.framebuffer = None
+        self.renderbuffer = None
+        self.width = 0
+        self.height = 0
+
+    def initialize(self, width, height):
+
+        if PLATFORM == "egl":
+            self.display, self.context, self.context_color_buffer = _initialize_egl_context()
+        elif PLATFORM == "osmesa":
+            self.display, self.context, self.context_color_buffer = _initialize_osmesa_context(width, height)
+        else:
+            raise RuntimeError("Unsupported headless platform (%s)" % PLATFORM)
+
+        # Surfaceless contexts have no default framebuffer, draws go to this one instead
+        self.renderbuffer = GLuint(0)
+        glGenRenderbuffers(1, self.renderbuffer)
+        Registry.track("renderbuffer", self.renderbuffer, width * height * 4)
+        glBindRenderbuffer(GL_RENDERBUFFER, self.renderbuffer)
+        glRenderbufferStorage(GL_RENDERBUFFER, GL_RGBA8, width, height)
+        glBindRenderbuffer(GL_RENDERBUFFER, 0)
+
+        self.framebuffer = GLuint(0)
+        glGenFramebuffers(1, self.framebuffer)
+        Registry.track("framebuffer", self.framebuffer)
+        glBindFramebuffer(GL_FRAMEBUFFER, self.framebuffer)
+        glFramebufferRenderbuffer(GL_FRAMEBUFFER, GL_COLOR_ATTACHMENT0, GL_RENDERBUFFER, self.renderbuffer)
+        status = glCheckFramebufferStatus(GL_FRAMEBUFFER)
+        glBindFramebuffer(GL_FRAMEBUFFER, 0)
+        if status != GL_FRAMEBUFFER_COMPLETE:
+            raise RuntimeError("Framebuffer is incomplete (%s)" % status)
+
+        self.width = width
+        self.height = height
+
+    def dispose(self):
+
+        if self.framebuffer is not None:
+            Registry.untrack("framebuffer", self.framebuffer)
+            glDeleteFramebuffers(1, self.framebuffer)
+        if self.renderbuffer is not None:
+            Registry.untrack("renderbuffer", self.renderbuffer)
+            glDeleteRenderbuffers(1, self.renderbuffer)
+
+        if self.context is not None:
+            if PLATFORM == "egl":
+                _dispose_egl_context(self.display, self.context)
+            else:
+                _dispose_osmesa_context(self.context)
+
+        self.display = None
+        self.context = None
+        self.context_color_buffer = None
+        self.framebuffer = None
+        self.renderbuffer = None
+        self.width = 0
+        self.height = 0
+
+
+def bind_framebuffer(resources):
+
+    glBindFramebuffer(GL_FRAMEBUFFER, resources.framebuffer)
+    glViewport(0, 0, resources.width, resources.height)
+
+
+def get_renderer():
+
+    return glGetString(GL_RENDERER).decode(), glGetString(GL_VERSION).decode()
@@ -1,28 +1,11 @@
 from ctypes import sizeof, c_float, c_void_p, c_int
 from OpenGL import GL
-
-
-def list_used_names():
-
-    return (
-        [("buffer", name) for name in range(1024) if GL.glIsBuffer(name)] +
-        [("framebuffer", name) for name in range(1024) if GL.glIsFramebuffer(name)] +
-        [("program", name) for name in range(1024) if GL.glIsProgram(name)] +
-        [("program_pipeline", name) for name in range(1024) if GL.glIsProgramPipeline(name)] +
-        [("query", name) for name in range(1024) if GL.glIsQuery(name)] +
-        [("renderbuffer", name) for name in range(1024) if GL.glIsRenderbuffer(name)] +
-        [("sampler", name) for name in range(1024) if GL.glIsSampler(name)] +
-        [("shader", name) for name in range(1024) if GL.glIsShader(name)] +
-        [("sync", name) for name in range(1024) if GL.glIsSync(name)] +
-        [("texture", name) for name in range(1024) if GL.glIsTexture(name)] +
-        [("transform_feedback", name) for name in range(1024) if GL.glIsTransformFeedback(name)] +
-        [("vertex_array", name) for name in range(1024) if GL.glIsVertexArray(name)]
-    )
+import Registry
 
 
 def compile_shader(source, shader_type):
 
-    shader = GL.glCreateShader(shader_type)
+    shader = Registry.track("shader", GL.glCreateShader(shader_type))
     GL.glShaderSource(shader, source)
 
     GL.glCompileShader(shader)
@@ -35,7 +18,7 @@ def compile_shader(source, shader_type):
 
 def link_program(*shaders, delete_shaders=True):
 
-    program = GL.glCreateProgram()
+    program = Registry.track("program", GL.glCreateProgram())
     for shader in shaders:
         GL.glAttachShader(program, shader)
 
@@ -44,6 +27,7 @@ def link_program(*shaders, delete_shaders=True):
     # We delete these anyways because we will reinitialize the whole things later...
     if delete_shaders:
         for shader in shaders:
+            Registry.untrack("shader", shader)
             GL.glDeleteShader(shader)
 
     result = GL.glGetProgramiv(program, GL.GL_LINK_STATUS)
@@ -150,7 +134,7 @@ def create_vertex_array_and_draw_call(layout_locations, attribute_sizes, attribu
     GL.glBufferData(GL.GL_ARRAY_BUFFER, sizeof(vertex_buffer_type), vertex_buffer_type(*vertex_buffer_data), GL.GL_STATIC_DRAW)
     GL.glBindBuffer(GL.GL_ARRAY_BUFFER, 0)
 
-    vertex_array = GL.glGenVertexArrays(1)
+    vertex_array = Registry.track("vertex_array", GL.glGenVertexArrays(1))
     GL.glBindVertexArray(vertex_array)
     GL.glBindBuffer(GL.GL_ARRAY_BUFFER, vertex_buffer)
     for layout_location, attribute_size, attribute_offset in zip(layout_locations, attribute_sizes, attribute_offsets):
@@ -2,7 +2,8 @@ from OpenGL import GL, error
 import glfw
 import importlib
 import traceback
-from Helpers import list_used_names
+import Registry
+import Reload
 
 
 def main():
@@ -29,7 +30,13 @@ def main():
     frame_size = glfw.get_framebuffer_size(window)
     resources = module.Resources()
     resources.initialize(frame_size)
-    print(list_used_names())
+    print(Registry.format_report())
+
+    # Watch the files and modules resources are built from
+    reload_resources = Reload.Resources()
+    reload_resources.initialize()
+    Reload.watch(reload_resources, module.list_dependencies())
+    last_reload_poll_time = glfw.get_time()
 
     # Exceptions
     disable_render = False
@@ -48,7 +55,7 @@ def main():
         if frame_size != last_frame_size:
             resources.dispose()
             resources.initialize(frame_size)
-            print(list_used_names())
+            print(Registry.format_report())
             start_time = glfw.get_time()
 
         # Handle shortcuts
@@ -61,7 +68,9 @@ def main():
                 resources = module.Resources()
                 try:
                     resources.initialize(frame_size)
-                    print(list_used_names())
+                    print(Registry.format_report())
+                    Reload.watch(reload_resources, module.list_dependencies())
+                    reload_resources.pending_names.clear()
                     start_time = glfw.get_time()
                     disable_render = False
                 except (error.GLError, FileNotFoundError):
@@ -82,6 +91,24 @@ def main():
 
         key_r_was_pressed = key_r_is_pressed
 
+        # Only rebuild resources depending on changed files, the others and their GL objects are kept
+        if glfw.get_time() - last_reload_poll_time > Reload.RELOAD_POLL_INTERVAL:
+            last_reload_poll_time = glfw.get_time()
+            changed_paths = Reload.poll(reload_resources)
+            if changed_paths:
+                try:
+                    if Reload.is_module_changed(changed_paths):
+                        module = Reload.reload_modules(changed_paths, module)
+                        resources = module.Resources(resources)
+                        Reload.watch(reload_resources, module.list_dependencies())
+                    module.reload(resources, sorted(reload_resources.pending_names), frame_size)
+                    reload_resources.pending_names.clear()
+                    print(Registry.format_report())
+                    disable_render = False
+                except Exception:
+                    traceback.print_exc()
+                    disable_render = True
+
         # Render some shit
         try:
             if disable_render:
@@ -102,6 +129,8 @@ def main():
         glfw.poll_events()
 
     resources.dispose()
+    reload_resources.dispose()
+    print(Registry.format_leaks())
 
     glfw.terminate()
 
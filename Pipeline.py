@@ -0,0 +1,144 @@
+# coding: utf8
+
+from collections import namedtuple
+from random import seed
+
+import Random
+import Ray
+import Scene
+import World
+
+from Shader import ProgramCache
+from Config import SCENE_SEED, RAY_COUNT, RAY_GROUP_SIZE, RAY_BOUNCE_COUNT, RAY_DIR_COUNT, RAY_DIR_GROUP_SIZE, \
+    RAY_SORT, RANDOM_COUNTER, RAY_INIT_DX, RAY_INIT_DY, WORLD_LINE_COUNT, WORLD_BVH, WORLD_SCENE_PATH, \
+    WORLD_SPARE_LINE_COUNT, WORLD_INT_Y_JITTER, WORLD_INT_IOR, prepare_ray_data, prepare_world_data
+
+
+# Everything which changes shader sources or buffer sizes
+Parameters = namedtuple("Parameters", (
+    "ray_count",
+    "ray_group_size",
+    "ray_bounce_count",
+    "ray_dir_count",
+    "ray_dir_group_size",
+    "world_line_count",
+    "world_bvh",
+    "world_scene_path",
+    "world_spare_line_count",
+    "ray_sort",
+    "random_counter"
+))
+
+
+def prepare_parameters(**parameters):
+
+    # Scenes give their own line count
+    world_scene_path = parameters.pop("world_scene_path", WORLD_SCENE_PATH)
+    world_line_count = parameters.pop("world_line_count", None)
+    if world_line_count is None:
+        world_line_count = Scene.read_line_count(world_scene_path) if world_scene_path is not None else WORLD_LINE_COUNT
+
+    parameters = Parameters(
+        ray_count=parameters.pop("ray_count", RAY_COUNT),
+        ray_group_size=parameters.pop("ray_group_size", RAY_GROUP_SIZE),
+        ray_bounce_count=parameters.pop("ray_bounce_count", RAY_BOUNCE_COUNT),
+        ray_dir_count=parameters.pop("ray_dir_count", RAY_DIR_COUNT),
+        ray_dir_group_size=parameters.pop("ray_dir_group_size", RAY_DIR_GROUP_SIZE),
+        world_line_count=world_line_count,
+        world_bvh=parameters.pop("world_bvh", WORLD_BVH),
+        world_scene_path=world_scene_path,
+        world_spare_line_count=parameters.pop("world_spare_line_count", WORLD_SPARE_LINE_COUNT),
+        ray_sort=parameters.pop("ray_sort", RAY_SORT),
+        random_counter=parameters.pop("random_counter", RANDOM_COUNTER),
+        **parameters
+    )
+
+    if parameters.ray_count <= 0 or parameters.ray_count % parameters.ray_group_size != 0:
+        raise ValueError("Ray count must be a multiple of %d" % parameters.ray_group_size)
+    if parameters.ray_group_size % 16 != 0:
+        raise ValueError("Ray group size must be a multiple of 16")
+    if parameters.ray_dir_count <= 0 or parameters.ray_dir_count % parameters.ray_dir_group_size != 0:
+        raise ValueError("Ray direction count must be a multiple of %d" % parameters.ray_dir_group_size)
+    if parameters.world_line_count <= 0:
+        raise ValueError("World line count must be positive")
+    if parameters.world_scene_path is None and parameters.world_line_count % 2 != 0:
+        raise ValueError("World line count must be even")
+    if parameters.world_spare_line_count < 0:
+        raise ValueError("World spare line count must not be negative")
+    if parameters.ray_bounce_count <= 0:
+        raise ValueError("Ray bounce count must be positive")
+
+    return parameters
+
+
+def prepare_scene_data(parameters, ray_init_dx=RAY_INIT_DX, ray_init_dy=RAY_INIT_DY,
+                       world_int_y_jitter=WORLD_INT_Y_JITTER, world_int_ior=WORLD_INT_IOR):
+
+    # Same random sequence as Config, default parameters give the default scene, scene files are read by World
+    seed(SCENE_SEED)
+    ray_data = prepare_ray_data(parameters.ray_count, ray_init_dx, ray_init_dy)
+    if parameters.world_scene_path is not None:
+        return ray_data, None
+    world_data = prepare_world_data(parameters.world_line_count, world_int_y_jitter, world_int_ior)
+    return ray_data, world_data
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.parameters = None
+        self.program_cache = None
+        self.ray_data = None
+        self.world = None
+        self.ray = None
+        self.random = None
+
+    def initialize(self, parameters=None):
+
+        self.program_cache = ProgramCache()
+        self.program_cache.initialize()
+
+        self.world = World.Resources()
+        self.ray = Ray.Resources()
+        self.random = Random.Resources()
+
+        update_parameters(self, parameters or prepare_parameters())
+
+    def dispose(self):
+
+        if self.world is not None:
+            self.world.dispose()
+        if self.ray is not None:
+            self.ray.dispose()
+        if self.random is not None:
+            self.random.dispose()
+        if self.program_cache is not None:
+            self.program_cache.dispose()
+
+        self.parameters = None
+        self.program_cache = None
+        self.ray_data = None
+        self.world = None
+        self.ray = None
+        self.random = None
+
+
+def update_parameters(resources, parameters):
+
+    # Buffers are sized for one parameter set, programs stay in the cache for the next time it is used
+    if parameters == resources.parameters:
+        return
+
+    ray_data, world_data = prepare_scene_data(parameters)
+
+    resources.world.dispose()
+    resources.ray.dispose()
+    resources.random.dispose()
+
+    resources.world.initialize(parameters, resources.program_cache, world_data)
+    resources.ray.initialize(parameters, resources.program_cache, ray_data)
+    resources.random.initialize(parameters, resources.program_cache)
+
+    resources.parameters = parameters
+    resources.ray_data = ray_data
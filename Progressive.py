@@ -0,0 +1,148 @@
+# coding: utf8
+
+from OpenGL.GL import GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_FRAMEBUFFER, GL_COLOR, GL_R32F, GL_TEXTURE0, \
+    GL_TEXTURE_2D, GL_TRIANGLES, GL_BLEND, GL_FUNC_ADD, GL_ONE, \
+    glBindFramebuffer, glClearBufferfv, glViewport, glUseProgram, glBindVertexArray, glDrawArrays, \
+    glActiveTexture, glBindTexture, glUniformMatrix3fv, glUniform1f, glEnable, glDisable, glBlendEquation, glBlendFunc
+
+from glm import mat3, inverse, value_ptr
+
+from Shader import initialize_program_from_sources, dispose_program
+from Vertex import initialize_vertex_array, dispose_vertex_array
+from Framebuffer import initialize_texture, dispose_texture, initialize_framebuffer, dispose_framebuffer
+from Config import PROGRESSIVE_DENSITY_SIZE, PROGRESSIVE_DENSITY_EXTENT
+
+
+# Line density is accumulated in world space so panning and zooming never invalidate it
+DENSITY_VIEW_PROJECTION = mat3(
+    1.0 / PROGRESSIVE_DENSITY_EXTENT, 0.0, 0.0,
+    0.0, 1.0 / PROGRESSIVE_DENSITY_EXTENT, 0.0,
+    0.0, 0.0, 1.0
+)
+
+INV_VIEW_PROJECTION_LOCATION = 1
+DENSITY_WEIGHT_LOCATION = 2
+
+
+DISPLAY_VERTEX_SHADER = """
+#version 430
+
+layout(location = {define_inv_view_projection_location}) uniform mat3 inv_view_projection;
+
+out vec2 density_position;
+
+void main()
+{{
+    // One triangle covering the whole screen
+    vec2 position = vec2(gl_VertexID == 1 ? 3.0 : -1.0, gl_VertexID == 2 ? 3.0 : -1.0);
+
+    vec3 world_position = inv_view_projection * vec3(position, 1.0);
+    density_position = (world_position.xy / world_position.z) * (0.5 / {define_density_extent}) + 0.5;
+
+    gl_Position = vec4(position, 0.0, 1.0);
+}}
+""".format(
+    define_inv_view_projection_location=INV_VIEW_PROJECTION_LOCATION,
+    define_density_extent=float(PROGRESSIVE_DENSITY_EXTENT)
+)
+
+
+DISPLAY_FRAGMENT_SHADER = """
+#version 430
+
+layout(binding = 0) uniform sampler2D density;
+layout(location = {define_density_weight_location}) uniform float density_weight;
+
+in vec2 density_position;
+
+out vec4 Color;
+
+void main()
+{{
+    if (any(lessThan(density_position, vec2(0.0))) || any(greaterThan(density_position, vec2(1.0))))
+    {{
+        discard;
+    }}
+
+    Color = vec4(texture(density, density_position).r * density_weight);
+}}
+""".format(
+    define_density_weight_location=DENSITY_WEIGHT_LOCATION
+)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.density_texture = None
+        self.density_framebuffer = None
+        self.display_program = None
+        self.display_vertex_array = None
+        self.frame_count = 0
+        self.key = None
+
+    def initialize(self):
+
+        self.density_texture = initialize_texture(PROGRESSIVE_DENSITY_SIZE, PROGRESSIVE_DENSITY_SIZE, GL_R32F)
+        self.density_framebuffer = initialize_framebuffer(self.density_texture)
+
+        self.display_program = initialize_program_from_sources(
+            (GL_VERTEX_SHADER, DISPLAY_VERTEX_SHADER),
+            (GL_FRAGMENT_SHADER, DISPLAY_FRAGMENT_SHADER)
+        )
+
+        self.display_vertex_array = initialize_vertex_array()
+
+        self.frame_count = 0
+        self.key = None
+
+    def dispose(self):
+
+        self.density_framebuffer = dispose_framebuffer(self.density_framebuffer)
+        self.density_texture = dispose_texture(self.density_texture)
+        self.display_program = dispose_program(self.display_program)
+        self.display_vertex_array = dispose_vertex_array(self.display_vertex_array)
+        self.frame_count = 0
+        self.key = None
+
+
+def reset(resources, key):
+
+    glBindFramebuffer(GL_FRAMEBUFFER, resources.density_framebuffer)
+    glClearBufferfv(GL_COLOR, 0, (0.0, 0.0, 0.0, 0.0))
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    resources.frame_count = 0
+    resources.key = key
+
+
+def begin_accumulation(resources):
+
+    glBindFramebuffer(GL_FRAMEBUFFER, resources.density_framebuffer)
+    glViewport(0, 0, PROGRESSIVE_DENSITY_SIZE, PROGRESSIVE_DENSITY_SIZE)
+
+
+def end_accumulation(resources):
+
+    glBindFramebuffer(GL_FRAMEBUFFER, 0)
+    resources.frame_count += 1
+
+
+def display(resources, view_projection):
+
+    inv_view_projection = inverse(view_projection)
+
+    glEnable(GL_BLEND)
+    glBlendEquation(GL_FUNC_ADD)
+    glBlendFunc(GL_ONE, GL_ONE)
+    glBindVertexArray(resources.display_vertex_array)
+    glUseProgram(resources.display_program)
+    glUniformMatrix3fv(INV_VIEW_PROJECTION_LOCATION, 1, False, value_ptr(inv_view_projection))
+    glUniform1f(DENSITY_WEIGHT_LOCATION, 1.0 / max(resources.frame_count, 1))
+    glActiveTexture(GL_TEXTURE0)
+    glBindTexture(GL_TEXTURE_2D, resources.density_texture)
+    glDrawArrays(GL_TRIANGLES, 0, 3)
+    glBindTexture(GL_TEXTURE_2D, 0)
+    glUseProgram(0)
+    glBindVertexArray(0)
+    glDisable(GL_BLEND)
@@ -1,12 +1,14 @@
 # coding: utf8
 
 from OpenGL.GL import GL_COMPUTE_SHADER, \
-    GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, \
-    glUseProgram, glBindBufferBase, glDispatchCompute, glMemoryBarrier
+    GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, GL_BUFFER_UPDATE_BARRIER_BIT, \
+    glUseProgram, glUniform1ui, glBindBufferBase, glDispatchCompute, glMemoryBarrier
 
-from Buffer import prepare_uint_buffer_data, initialize_buffer, dispose_buffer
-from Shader import initialize_shader, initialize_program, dispose_program
-from Config import RAY_COUNT
+import numpy
+
+from Buffer import prepare_uint_buffer_data, initialize_buffer, update_buffer, dispose_buffer
+from Shader import get_program
+from Config import RANDOM_SEED
 
 
 BUFFER_LAYOUT = """
@@ -19,9 +21,31 @@ layout(std430, binding = {binding}) buffer MersenneTwister
     uint mt_m2[MERSENNE_TWISTER_COUNT];
     uint mt_tmat[MERSENNE_TWISTER_COUNT];
 }};
-""".format(binding=3, mersenne_twister_count=RAY_COUNT)
+"""
+
+
+# Counter based generator, a sample only depends on its generator, bounce, frame and seed
+COUNTER_BUFFER_LAYOUT = """
+layout(std430, binding = {binding}) readonly buffer RandomKey
+{{
+    uint random_seed;
+    uint random_frame;
+}};
+"""
+
+
+def prepare_buffer_layout(parameters):
+
+    if parameters.random_counter:
+        return COUNTER_BUFFER_LAYOUT.format(binding=3)
+    return BUFFER_LAYOUT.format(binding=3, mersenne_twister_count=parameters.ray_count)
+
 
 SHADER = """
+void set_random_bounce(uint bounce)
+{{
+}}
+
 float random(uint generator_index)
 {{
     uvec4 status = mt_status[generator_index];
@@ -50,6 +74,47 @@ float random(uint generator_index)
 """.format()
 
 
+# PCG4D hash from Jarzynski and Olano, Hash Functions for GPU Rendering
+COUNTER_SHADER = """
+uint random_counter = 0u;
+
+void set_random_bounce(uint bounce)
+{
+    random_counter = bounce << 16;
+}
+
+uvec4 pcg4d(uvec4 v)
+{
+    v = v * 1664525u + 1013904223u;
+    v.x += v.y * v.w;
+    v.y += v.z * v.x;
+    v.z += v.x * v.y;
+    v.w += v.y * v.z;
+    v ^= v >> 16u;
+    v.x += v.y * v.w;
+    v.y += v.z * v.x;
+    v.z += v.x * v.y;
+    v.w += v.y * v.z;
+    return v;
+}
+
+float random(uint generator_index)
+{
+    uint x = pcg4d(uvec4(generator_index, random_counter++, random_frame, random_seed)).x;
+    
+    // 24 bits are exact in a float, the result stays below 1.0
+    return (x >> 8) * (1.0f / 16777216.0f);
+}
+"""
+
+
+def prepare_shader(parameters):
+
+    return COUNTER_SHADER if parameters.random_counter else SHADER
+
+
+SEED_LOCATION = 0
+
 INIT_SHADER = """
 #version 430
 
@@ -58,6 +123,8 @@ INIT_SHADER = """
 
 layout (local_size_x = 16, local_size_y = 1) in;
 
+layout(location = {define_seed_location}) uniform uint random_seed;
+
 void init(uint generator_index, uint seed, uint m1, uint m2, uint tmat)
 {{
   uvec4 status = uvec4(seed, m1, m2, tmat);
@@ -80,34 +147,74 @@ void init(uint generator_index, uint seed, uint m1, uint m2, uint tmat)
 void main()
 {{
     uint generator_index = gl_GlobalInvocationID.x;
-    init(generator_index, 234340U ^ generator_index, 0xf50a1d49U, 0xffa8ffebU, 0x0bf2bfffU);  
+    init(generator_index, random_seed ^ generator_index, 0xf50a1d49U, 0xffa8ffebU, 0x0bf2bfffU);  
 }}
-""".format(include_rand_buffer_layout=BUFFER_LAYOUT, include_rand_shader=SHADER)
+"""
+
+
+def prepare_init_shader(parameters):
+
+    return INIT_SHADER.format(
+        include_rand_buffer_layout=prepare_buffer_layout(parameters),
+        include_rand_shader=SHADER,
+        define_seed_location=SEED_LOCATION
+    )
 
 
 class Resources(object):
 
     def __init__(self):
 
+        self.parameters = None
         self.init_program = None
         self.seed_buffer = None
+        self.seed = RANDOM_SEED
+        self.frame = 0
 
-    def initialize(self):
+    def initialize(self, parameters, program_cache):
 
-        self.init_program = initialize_program(initialize_shader(GL_COMPUTE_SHADER, INIT_SHADER))
-        self.seed_buffer = initialize_buffer(prepare_uint_buffer_data([0] * 7 * RAY_COUNT))
+        self.parameters = parameters
+        if parameters.random_counter:
+            # Only the key, nothing depends on the ray count
+            self.seed_buffer = initialize_buffer(prepare_uint_buffer_data(numpy.array([self.seed, 0], numpy.uint32)))
+        else:
+            self.init_program = get_program(program_cache, (GL_COMPUTE_SHADER, prepare_init_shader(parameters)))
+            self.seed_buffer = initialize_buffer(prepare_uint_buffer_data(numpy.zeros(7 * parameters.ray_count, numpy.uint32)))
 
     def dispose(self):
 
-        self.init_program = dispose_program(self.init_program)
+        # Programs belong to the program cache
+        self.parameters = None
+        self.init_program = None
         self.seed_buffer = dispose_buffer(self.seed_buffer)
+        self.frame = 0
+
+
+def _update_key(resources):
+
+    glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+    update_buffer(resources.seed_buffer, 0, numpy.array([resources.seed, resources.frame], numpy.uint32))
 
 
 def init(resources):
 
+    resources.frame = 0
+    if resources.parameters.random_counter:
+        _update_key(resources)
+        return
+
     glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
     glUseProgram(resources.init_program)
+    glUniform1ui(SEED_LOCATION, resources.seed)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, resources.seed_buffer)
-    glDispatchCompute(RAY_COUNT // 16, 1, 1)
+    glDispatchCompute(resources.parameters.ray_count // 16, 1, 1)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
     glUseProgram(0)
+
+
+def advance(resources):
+
+    # Generator states advance by themselves, counters need the next frame for new samples
+    resources.frame += 1
+    if resources.parameters.random_counter:
+        _update_key(resources)
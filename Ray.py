@@ -1,18 +1,28 @@
 # coding: utf8
 
-from OpenGL.GL import GL_COMPUTE_SHADER, GL_FRAGMENT_SHADER, GL_VERTEX_SHADER, \
-    GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, GL_LINES, GL_LINE_STRIP, \
-    GL_BLEND, GL_FUNC_ADD, GL_ONE, \
-    glUseProgram, glBindBufferBase, glDrawArrays, glBindVertexArray, glDispatchCompute, glMemoryBarrier, glEnable,\
-    glDisable, glBlendFunc, glBlendEquation, glUniform1ui
+from itertools import count
 
-from Buffer import prepare_float_buffer_data, initialize_buffer, dispose_buffer
-from Shader import initialize_shader, initialize_program, dispose_program
+from OpenGL.GL import GL_COMPUTE_SHADER, GL_FRAGMENT_SHADER, GL_VERTEX_SHADER, \
+    GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, GL_COMMAND_BARRIER_BIT, GL_BUFFER_UPDATE_BARRIER_BIT, \
+    GL_DISPATCH_INDIRECT_BUFFER, \
+    GL_LINES, GL_LINE_STRIP, GL_BLEND, GL_FUNC_ADD, GL_ONE, GL_RGBA32UI, GL_RGBA_INTEGER, GL_UNSIGNED_INT, \
+    glUseProgram, glBindBufferBase, glDrawArrays, glBindVertexArray, glDispatchCompute, glDispatchComputeIndirect, \
+    glMemoryBarrier, glEnable, glDisable, glBlendFunc, glBlendEquation, glUniform1ui, glUniform1f, glBindBufferRange, \
+    glBindBuffer, glClearBufferSubData, GLfloat, GLuint, sizeof
+
+import numpy
+
+from Buffer import prepare_float_buffer_data, prepare_uint_buffer_data, prepare_empty_float_buffer_data, \
+    initialize_buffer, clear_uint_buffer, copy_buffer, dispose_buffer
+from Shader import get_program
 from Vertex import initialize_vertex_array, dispose_vertex_array
-from Random import BUFFER_LAYOUT as RANDOM_BUFFER_LAYOUT, SHADER as RANDOM_SHADER
-from World import BUFFER_LAYOUT as WORLD_BUFFER_LAYOUT
-from Config import RAY_COUNT, RAY_GROUP_SIZE, RAY_DIR_COUNT, RAY_DIR_GROUP_SIZE,\
-    RAY0_DATA_OX, RAY0_DATA_OY, RAY0_DATA_DX, RAY0_DATA_DY
+from Stream import Resources as StreamResources, map_region, copy_region, fence_region
+from Sort import Resources as SortResources, sort, prepare_key_value_buffer_layout as prepare_sort_buffer_layout
+from Random import prepare_buffer_layout as prepare_random_buffer_layout, prepare_shader as prepare_random_shader
+from World import prepare_buffer_layout as prepare_world_buffer_layout
+from Bvh import BUFFER_LAYOUT as WORLD_BVH_BUFFER_LAYOUT, SHADER as WORLD_BVH_SHADER
+from Config import RAY_DIR_SCATTER, RAY_DIR_SHARED_HISTOGRAM_MAX_COUNT, RAY_SORT_DIRECTION_BIT_COUNT, \
+    RAY_SORT_ORIGIN_BIT_COUNT, RAY_SORT_EXTENT
 from View import update_view_projection, DATA_LAYOUT as VIEW_DATA_LAYOUT
 
 
@@ -26,21 +36,77 @@ layout(std430, binding = {binding}) buffer RayBuffer{suffix}
 }};
 """
 
-RAY_BUFFER0_LAYOUT = BUFFER_LAYOUT.format(binding=1, suffix=0, ray_count=RAY_COUNT)
-RAY_BUFFER1_LAYOUT = BUFFER_LAYOUT.format(binding=2, suffix=1, ray_count=RAY_COUNT)
+def prepare_ray_buffer0_layout(parameters):
 
+    return BUFFER_LAYOUT.format(binding=1, suffix=0, ray_count=parameters.ray_count)
 
-TRACE_COMPUTE_SHADER = """
-#version 430
 
-{world_buffer_layout}
-{ray_buffer0_layout}
-{ray_buffer1_layout}
-{include_random_layout}
-{include_random}
+def prepare_ray_buffer1_layout(parameters):
+
+    return BUFFER_LAYOUT.format(binding=2, suffix=1, ray_count=parameters.ray_count)
+
+
+def prepare_ray_buffer2_layout(parameters):
 
-//layout(location=0) uniform uint iteration;
+    return BUFFER_LAYOUT.format(binding=7, suffix=2, ray_count=parameters.ray_count)
 
+
+RAY_LIVE_BUFFER_LAYOUT = """
+#define RAY_LIVE_COUNT {define_ray_count}
+#define RAY_LIVE_GROUP_SIZE {define_ray_group_size}
+
+struct RayLiveList
+{{
+    uint group_count_x;
+    uint group_count_y;
+    uint group_count_z;
+    uint ray_count;
+}};
+
+// Rays still in the scene, the current bounce appends to one list and reads the other one
+layout(std430, binding = 6) buffer RayLiveBuffer
+{{
+    RayLiveList live_lists[2];
+    uint live_indices[2 * RAY_LIVE_COUNT];
+}};
+
+void append_live_ray(uint live_list, uint ray_index)
+{{
+    // The first ray of each group bumps the group count, lists are used as they are by indirect dispatches
+    uint live_slot = atomicAdd(live_lists[live_list].ray_count, 1u);
+    if (live_slot % RAY_LIVE_GROUP_SIZE == 0u)
+    {{
+        atomicAdd(live_lists[live_list].group_count_x, 1u);
+    }}
+    live_indices[live_list * RAY_LIVE_COUNT + live_slot] = ray_index;
+}}
+"""
+
+# Headers of both lists come first, each one is a dispatch indirect command followed by its ray count
+RAY_LIVE_LIST_SIZE = 4 * sizeof(GLuint)
+RAY_LIVE_LIST_RESET_DATA = numpy.array([0, 1, 1, 0], numpy.uint32)
+
+
+def prepare_ray_live_buffer_layout(parameters):
+
+    return RAY_LIVE_BUFFER_LAYOUT.format(
+        define_ray_count=parameters.ray_count,
+        define_ray_group_size=parameters.ray_group_size
+    )
+
+
+INTERSECT_WORLD_SHADER = """
+void intersect_world(vec3 ray_l, vec2 ray0_o0, vec2 ray0_d0, inout vec2 min_hit, inout float min_dist, inout vec2 min_normal, inout float min_ior_i, inout float min_ior_t)
+{
+    for (uint world_line = 0; world_line < WORLD_LINE_COUNT; ++world_line)
+    {
+        intersect_world_line(world_line, ray_l, ray0_o0, ray0_d0, min_hit, min_dist, min_normal, min_ior_i, min_ior_t);
+    }
+}
+"""
+
+
+TRACE_SHADER = """
 vec2 refract(vec2 i, vec2 n, float cos_theta, float inv_eta)
 {{
   //float cos_theta = dot(-i, n);
@@ -74,14 +140,42 @@ float pow2(float value)
     return value * value;
 }}
 
-layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
-
-void main()
+void intersect_world_line(uint world_line, vec3 ray_l, vec2 ray0_o0, vec2 ray0_d0, inout vec2 min_hit, inout float min_dist, inout vec2 min_normal, inout float min_ior_i, inout float min_ior_t)
 {{
-    uint ray_index = gl_GlobalInvocationID.x;
+    vec2 int_o0, int_o1;
+    float ior_i, ior_t;
+    get_world_line(world_line, int_o0, int_o1, ior_i, ior_t); 
     
-    vec2 ray0_d0 = normalize(vec2(ray0_dx[ray_index], ray0_dy[ray_index]));
-    vec2 ray0_o0 = vec2(ray0_ox[ray_index], ray0_oy[ray_index]);    
+    vec3 int_l = cross(vec3(int_o0, 1.0), vec3(int_o1, 1.0));
+    vec3 hit_p = cross(ray_l, int_l);
+    if (abs(hit_p.z) > 0.0)
+    {{
+        vec2 hit = hit_p.xy / hit_p.z;
+        float dist_hit = dot(ray0_d0, hit - ray0_o0);
+        if (0.0 < dist_hit && dist_hit < min_dist)
+        {{
+            vec2 int_d = int_o1 - int_o0;
+            float dist_int = dot(int_d, hit - int_o0);
+            // +1e-8 is an epsilon for handling precision issues
+            if (0.0 < dist_int && dist_int <= dot(int_d, int_d) + 1e-8)
+            {{
+                min_hit = hit;
+                min_dist = dist_hit;
+                min_normal = int_d.yx * vec2(-1.0, 1.0);
+                min_ior_i = ior_i;
+                min_ior_t = ior_t;
+            }}
+        }} 
+    }}
+}}
+
+{include_intersect_world}
+
+// Moves a ray to its next interface and picks between reflection and refraction, false once it left the scene
+bool trace_ray(uint ray_index, inout vec2 ray_o, inout vec2 ray_d)
+{{
+    vec2 ray0_d0 = normalize(ray_d);
+    vec2 ray0_o0 = ray_o;
     vec2 ray0_o1 = ray0_o0 + 1e6 * ray0_d0;
         
     vec3 ray_l = cross(vec3(ray0_o0, 1.0), vec3(ray0_o1, 1.0));
@@ -90,35 +184,8 @@ void main()
     float min_dist = +1e32;
     vec2 min_normal = vec2(0.0, 1.0);
     float min_ior_i, min_ior_t;
-            
-    for (uint world_line = 0; world_line < WORLD_LINE_COUNT; ++world_line)
-    {{
-        vec2 int_o0, int_o1;
-        float ior_i, ior_t;
-        get_world_line(world_line, int_o0, int_o1, ior_i, ior_t); 
-        
-        vec3 int_l = cross(vec3(int_o0, 1.0), vec3(int_o1, 1.0));
-        vec3 hit_p = cross(ray_l, int_l);
-        if (abs(hit_p.z) > 0.0)
-        {{
-            vec2 hit = hit_p.xy / hit_p.z;
-            float dist_hit = dot(ray0_d0, hit - ray0_o0);
-            if (0.0 < dist_hit && dist_hit < min_dist)
-            {{
-                vec2 int_d = int_o1 - int_o0;
-                float dist_int = dot(int_d, hit - int_o0);
-                // +1e-8 is an epsilon for handling precision issues
-                if (0.0 < dist_int && dist_int <= dot(int_d, int_d) + 1e-8)
-                {{
-                    min_hit = hit;
-                    min_dist = dist_hit;
-                    min_normal = int_d.yx * vec2(-1.0, 1.0);
-                    min_ior_i = ior_i;
-                    min_ior_t = ior_t;
-                }}
-            }} 
-        }}
-    }}
+    
+    intersect_world(ray_l, ray0_o0, ray0_d0, min_hit, min_dist, min_normal, min_ior_i, min_ior_t);
     
     vec2 ray1_d, ray1_o;
     ray1_d = ray0_d0;
@@ -155,19 +222,242 @@ void main()
         }}
     }}
     
-    ray1_ox[ray_index] = ray1_o.x;
-    ray1_oy[ray_index] = ray1_o.y;
-    ray1_dx[ray_index] = ray1_d.x;
-    ray1_dy[ray_index] = ray1_d.y;
+    ray_o = ray1_o;
+    ray_d = ray1_d;
+    
+    return min_dist < +1e32;
+}}
+"""
+
+
+def prepare_trace_shader(parameters):
+
+    return TRACE_SHADER.format(
+        include_intersect_world=WORLD_BVH_SHADER if parameters.world_bvh else INTERSECT_WORLD_SHADER
+    )
+
+
+TRACE_COMPUTE_SHADER = """
+#version 430
+
+{world_buffer_layout}
+{world_bvh_buffer_layout}
+{ray_buffer0_layout}
+{ray_buffer1_layout}
+{ray_buffer2_layout}
+{ray_live_buffer_layout}
+{include_random_layout}
+{include_random}
+
+#define RAY_LIVE_INPUT {define_ray_live_input}
+
+layout(location = 0) uniform uint live_output;
+layout(location = 1) uniform uint trace_bounce;
+
+{include_trace}
+
+layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
+
+void main()
+{{
+#if RAY_LIVE_INPUT
+    uint live_input = live_output ^ 1u;
+    if (gl_GlobalInvocationID.x >= live_lists[live_input].ray_count)
+    {{
+        return;
+    }}
+    uint ray_index = live_indices[live_input * RAY_LIVE_COUNT + gl_GlobalInvocationID.x];
+#else
+    uint ray_index = gl_GlobalInvocationID.x;
+#endif
+    
+    vec2 ray_o = vec2(ray0_ox[ray_index], ray0_oy[ray_index]);
+    vec2 ray_d = vec2(ray0_dx[ray_index], ray0_dy[ray_index]);
+    
+    set_random_bounce(trace_bounce);
+    bool is_alive = trace_ray(ray_index, ray_o, ray_d);
+    
+    ray1_ox[ray_index] = ray_o.x;
+    ray1_oy[ray_index] = ray_o.y;
+    ray1_dx[ray_index] = ray_d.x;
+    ray1_dy[ray_index] = ray_d.y;
+    
+    if (is_alive)
+    {{
+        append_live_ray(live_output, ray_index);
+    }}
+    else
+    {{
+        // Escaped rays are frozen, the output buffer of the next bounce is never written for them
+        ray2_ox[ray_index] = ray_o.x;
+        ray2_oy[ray_index] = ray_o.y;
+        ray2_dx[ray_index] = ray_d.x;
+        ray2_dy[ray_index] = ray_d.y;
+    }}
+}}
+"""
+
+
+def prepare_trace_compute_shader(parameters, ray_live_input):
+
+    return TRACE_COMPUTE_SHADER.format(
+        world_buffer_layout=prepare_world_buffer_layout(parameters),
+        world_bvh_buffer_layout=WORLD_BVH_BUFFER_LAYOUT if parameters.world_bvh else "",
+        ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        ray_buffer1_layout=prepare_ray_buffer1_layout(parameters),
+        ray_buffer2_layout=prepare_ray_buffer2_layout(parameters),
+        ray_live_buffer_layout=prepare_ray_live_buffer_layout(parameters),
+        define_ray_live_input=int(ray_live_input),
+        include_random_layout=prepare_random_buffer_layout(parameters),
+        include_random=prepare_random_shader(parameters),
+        include_trace=prepare_trace_shader(parameters),
+        ray_group_size=parameters.ray_group_size
+    )
+
+
+SORT_KEY_COMPUTE_SHADER = """
+#version 430
+
+{ray_buffer0_layout}
+{ray_live_buffer_layout}
+{sort_buffer_layout}
+
+#define RAY_SORT_DIRECTION_CELL_COUNT {define_direction_cell_count}u
+#define RAY_SORT_ORIGIN_CELL_COUNT {define_origin_cell_count}u
+#define RAY_SORT_EXTENT {define_extent}
+
+layout(location = 0) uniform uint live_input;
+
+layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
+
+uint get_sort_key(vec2 ray_o, vec2 ray_d)
+{{
+    // Direction cells first, rays going the same way walk the BVH alike, then origin cells
+    float direction = atan(ray_d.y, ray_d.x) * (0.5 / 3.14159265) + 0.5;
+    uint direction_cell = min(uint(direction * RAY_SORT_DIRECTION_CELL_COUNT), RAY_SORT_DIRECTION_CELL_COUNT - 1u);
+    vec2 origin = clamp(ray_o * (0.5 / RAY_SORT_EXTENT) + 0.5, 0.0, 1.0);
+    uvec2 origin_cell = min(uvec2(origin * RAY_SORT_ORIGIN_CELL_COUNT), uvec2(RAY_SORT_ORIGIN_CELL_COUNT - 1u));
+    return (direction_cell * RAY_SORT_ORIGIN_CELL_COUNT + origin_cell.y) * RAY_SORT_ORIGIN_CELL_COUNT + origin_cell.x;
+}}
+
+void main()
+{{
+    uint live_index = gl_GlobalInvocationID.x;
+    if (live_index >= live_lists[live_input].ray_count)
+    {{
+        return;
+    }}
+    
+    uint ray_index = live_indices[live_input * RAY_LIVE_COUNT + live_index];
+    vec2 ray_o = vec2(ray0_ox[ray_index], ray0_oy[ray_index]);
+    vec2 ray_d = vec2(ray0_dx[ray_index], ray0_dy[ray_index]);
+    
+    sort_keys0[live_index] = get_sort_key(ray_o, ray_d);
+    sort_values0[live_index] = ray_index;
+}}
+"""
+
+RAY_SORT_KEY_BIT_COUNT = RAY_SORT_DIRECTION_BIT_COUNT + 2 * RAY_SORT_ORIGIN_BIT_COUNT
+
+
+def prepare_sort_key_compute_shader(parameters):
+
+    return SORT_KEY_COMPUTE_SHADER.format(
+        ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        ray_live_buffer_layout=prepare_ray_live_buffer_layout(parameters),
+        sort_buffer_layout=prepare_sort_buffer_layout(parameters.ray_count, 2, 3, 0),
+        define_direction_cell_count=1 << RAY_SORT_DIRECTION_BIT_COUNT,
+        define_origin_cell_count=1 << RAY_SORT_ORIGIN_BIT_COUNT,
+        define_extent=float(RAY_SORT_EXTENT),
+        ray_group_size=parameters.ray_group_size
+    )
+
+
+PATH_BUFFER_LAYOUT = """
+#define RAY_BOUNCE_COUNT {define_ray_bounce_count}
+#define PATH_RAY_COUNT {define_ray_count}
+
+// One ray buffer slice per path vertex, the first slice is a copy of the input rays
+layout(std430, binding = 2) buffer PathBuffer
+{{
+    float path_data[];
+}};
+
+void set_path_vertex(uint bounce, uint ray_index, vec2 ray_o, vec2 ray_d)
+{{
+    uint slice = bounce * 4 * PATH_RAY_COUNT;
+    path_data[slice + 0 * PATH_RAY_COUNT + ray_index] = ray_o.x;
+    path_data[slice + 1 * PATH_RAY_COUNT + ray_index] = ray_o.y;
+    path_data[slice + 2 * PATH_RAY_COUNT + ray_index] = ray_d.x;
+    path_data[slice + 3 * PATH_RAY_COUNT + ray_index] = ray_d.y;
+}}
+
+vec2 get_path_vertex_origin(uint bounce, uint ray_index)
+{{
+    uint slice = bounce * 4 * PATH_RAY_COUNT;
+    return vec2(path_data[slice + 0 * PATH_RAY_COUNT + ray_index], path_data[slice + 1 * PATH_RAY_COUNT + ray_index]);
+}}
+"""
+
+
+def prepare_path_buffer_layout(parameters):
+
+    return PATH_BUFFER_LAYOUT.format(
+        define_ray_bounce_count=parameters.ray_bounce_count,
+        define_ray_count=parameters.ray_count
+    )
+
+
+TRACE_PATH_COMPUTE_SHADER = """
+#version 430
+
+{world_buffer_layout}
+{world_bvh_buffer_layout}
+{ray_buffer0_layout}
+{include_path_buffer_layout}
+{include_random_layout}
+{include_random}
+
+{include_trace}
+
+layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
+
+void main()
+{{
+    uint ray_index = gl_GlobalInvocationID.x;
+    
+    vec2 ray_o = vec2(ray0_ox[ray_index], ray0_oy[ray_index]);
+    vec2 ray_d = vec2(ray0_dx[ray_index], ray0_dy[ray_index]);
+    
+    set_path_vertex(0, ray_index, ray_o, ray_d);
+    
+    // Escaped rays keep their last vertex, like the compacted bounces
+    bool is_alive = true;
+    for (uint bounce = 1; bounce <= RAY_BOUNCE_COUNT; ++bounce)
+    {{
+        if (is_alive)
+        {{
+            set_random_bounce(bounce - 1);
+            is_alive = trace_ray(ray_index, ray_o, ray_d);
+        }}
+        set_path_vertex(bounce, ray_index, ray_o, ray_d);
+    }}
 }}
-""".format(
-    world_buffer_layout=WORLD_BUFFER_LAYOUT,
-    ray_buffer0_layout=RAY_BUFFER0_LAYOUT,
-    ray_buffer1_layout=RAY_BUFFER1_LAYOUT,
-    include_random_layout=RANDOM_BUFFER_LAYOUT,
-    include_random=RANDOM_SHADER,
-    ray_group_size=RAY_GROUP_SIZE,
-)
+"""
+
+
+def prepare_trace_path_compute_shader(parameters):
+
+    return TRACE_PATH_COMPUTE_SHADER.format(
+        world_buffer_layout=prepare_world_buffer_layout(parameters),
+        world_bvh_buffer_layout=WORLD_BVH_BUFFER_LAYOUT if parameters.world_bvh else "",
+        ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        include_path_buffer_layout=prepare_path_buffer_layout(parameters),
+        include_random_layout=prepare_random_buffer_layout(parameters),
+        include_random=prepare_random_shader(parameters),
+        include_trace=prepare_trace_shader(parameters),
+        ray_group_size=parameters.ray_group_size
+    )
 
 
 DISPLAY_VERTEX_SHADER = """
@@ -186,11 +476,44 @@ void main()
 
     gl_Position = vec4(position.xy / position.z, 0.0, 1.0);
 }}
-""".format(
-    include_view_data_layout=VIEW_DATA_LAYOUT,
-    include_ray_buffer0_layout=RAY_BUFFER0_LAYOUT,
-    include_ray_buffer1_layout=RAY_BUFFER1_LAYOUT,
-)
+"""
+
+
+def prepare_display_vertex_shader(parameters):
+
+    return DISPLAY_VERTEX_SHADER.format(
+        include_view_data_layout=VIEW_DATA_LAYOUT,
+        include_ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        include_ray_buffer1_layout=prepare_ray_buffer1_layout(parameters)
+    )
+
+
+DISPLAY_PATH_VERTEX_SHADER = """
+#version 430
+
+{include_view_data_layout}
+{include_path_buffer_layout}
+
+void main()
+{{
+    // Segments of every bounce, in the same order as the path buffer slices
+    uint segment = uint(gl_VertexID >> 1);
+    uint bounce = segment / PATH_RAY_COUNT + uint(gl_VertexID & 1);
+    uint ray_index = segment % PATH_RAY_COUNT;
+
+    vec3 position = view_projection * vec3(get_path_vertex_origin(bounce, ray_index), 1.0);
+
+    gl_Position = vec4(position.xy / position.z, 0.0, 1.0);
+}}
+"""
+
+
+def prepare_display_path_vertex_shader(parameters):
+
+    return DISPLAY_PATH_VERTEX_SHADER.format(
+        include_view_data_layout=VIEW_DATA_LAYOUT,
+        include_path_buffer_layout=prepare_path_buffer_layout(parameters)
+    )
 
 
 DISPLAY_FRAGMENT_SHADER = """
@@ -212,9 +535,14 @@ layout(std430, binding = 0) buffer RayDirBuffer
 {{
     float ray_dir_weights[RAY_DIR_COUNT];
 }};
-""".format(
-    define_ray_dir_count=RAY_DIR_COUNT
-)
+"""
+
+
+def prepare_ray_dir_buffer_layout(parameters):
+
+    return RAY_DIR_BUFFER_LAYOUT.format(
+        define_ray_dir_count=parameters.ray_dir_count
+    )
 
 
 GATHER_COMPUTE_SHADER = """
@@ -253,13 +581,141 @@ void main()
     
     ray_dir_weights[dir_index] = ray_dir_weight;
 }}
-""".format(
-    define_ray_dir_group_size=RAY_DIR_GROUP_SIZE,
-    define_ray_dir_count=RAY_DIR_COUNT,
-    define_ray_count=RAY_COUNT,
-    include_ray_buffer0_layout=RAY_BUFFER0_LAYOUT,
-    include_ray_dir_buffer_layout=RAY_DIR_BUFFER_LAYOUT
-)
+"""
+
+
+def prepare_gather_compute_shader(parameters):
+
+    return GATHER_COMPUTE_SHADER.format(
+        define_ray_dir_group_size=parameters.ray_dir_group_size,
+        define_ray_dir_count=parameters.ray_dir_count,
+        define_ray_count=parameters.ray_count,
+        include_ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        include_ray_dir_buffer_layout=prepare_ray_dir_buffer_layout(parameters)
+    )
+
+
+RAY_DIR_COUNT_BUFFER_LAYOUT = """
+layout(std430, binding = 5) buffer RayDirCountBuffer
+{
+    uint ray_dir_counts[RAY_DIR_COUNT];
+};
+"""
+
+
+SCATTER_COMPUTE_SHADER = """
+#version 430
+
+#define RAY_GROUP_SIZE {define_ray_group_size}
+#define RAY_DIR_SHARED_HISTOGRAM {define_ray_dir_shared_histogram}
+
+{include_ray_buffer0_layout}
+{include_ray_dir_buffer_layout}
+{include_ray_dir_count_buffer_layout}
+
+const float PI = 3.1415926535897932384626433832795;
+
+layout (local_size_x = RAY_GROUP_SIZE, local_size_y = 1) in;
+
+#if RAY_DIR_SHARED_HISTOGRAM
+shared uint group_ray_dir_counts[RAY_DIR_COUNT];
+#endif
+
+void count_ray_dir(uint dir_index)
+{{
+#if RAY_DIR_SHARED_HISTOGRAM
+    atomicAdd(group_ray_dir_counts[dir_index], 1U);
+#else
+    atomicAdd(ray_dir_counts[dir_index], 1U);
+#endif
+}}
+
+void main()
+{{
+#if RAY_DIR_SHARED_HISTOGRAM
+    for (uint dir_index = gl_LocalInvocationID.x; dir_index < RAY_DIR_COUNT; dir_index += RAY_GROUP_SIZE)
+    {{
+        group_ray_dir_counts[dir_index] = 0U;
+    }}
+    barrier();
+#endif
+
+    uint ray_index = gl_GlobalInvocationID.x;
+    
+    float dir_step = PI / (RAY_DIR_COUNT - 1);
+    
+    vec2 ray_d = normalize(vec2(ray0_dx[ray_index], ray0_dy[ray_index]));
+    if (ray_d.y > 0.0)
+    {{
+        // Same bins as the gather pass, a ray lands in the bins whose angle is closer than a step
+        float ray_angle = acos(ray_d.x);
+        uint dir_center = uint(round(ray_angle / dir_step));
+        uint dir_first = max(dir_center, 1U) - 1U;
+        uint dir_last = min(dir_center + 1U, RAY_DIR_COUNT - 1U);
+        for (uint dir_index = dir_first; dir_index <= dir_last; ++dir_index)
+        {{
+            float dir_angle = PI * (dir_index / float(RAY_DIR_COUNT - 1));
+            float delta_angle = ray_angle - dir_angle;
+            if (abs(delta_angle) < dir_step)
+            {{
+                count_ray_dir(dir_index);
+            }}
+        }}
+    }}
+
+#if RAY_DIR_SHARED_HISTOGRAM
+    barrier();
+    for (uint dir_index = gl_LocalInvocationID.x; dir_index < RAY_DIR_COUNT; dir_index += RAY_GROUP_SIZE)
+    {{
+        uint group_ray_dir_count = group_ray_dir_counts[dir_index];
+        if (group_ray_dir_count > 0U)
+        {{
+            atomicAdd(ray_dir_counts[dir_index], group_ray_dir_count);
+        }}
+    }}
+#endif
+}}
+"""
+
+
+def prepare_scatter_compute_shader(parameters):
+
+    return SCATTER_COMPUTE_SHADER.format(
+        define_ray_group_size=parameters.ray_group_size,
+        define_ray_dir_shared_histogram=int(parameters.ray_dir_count <= RAY_DIR_SHARED_HISTOGRAM_MAX_COUNT),
+        include_ray_buffer0_layout=prepare_ray_buffer0_layout(parameters),
+        include_ray_dir_buffer_layout=prepare_ray_dir_buffer_layout(parameters),
+        include_ray_dir_count_buffer_layout=RAY_DIR_COUNT_BUFFER_LAYOUT
+    )
+
+
+NORMALIZE_DIR_COMPUTE_SHADER = """
+#version 430
+
+#define RAY_DIR_GROUP_SIZE {define_ray_dir_group_size}
+
+{include_ray_dir_buffer_layout}
+{include_ray_dir_count_buffer_layout}
+
+layout(location = 0) uniform float ray_dir_weight;
+
+layout (local_size_x = RAY_DIR_GROUP_SIZE, local_size_y = 1) in;
+
+void main()
+{{
+    uint dir_index = gl_GlobalInvocationID.x;
+    ray_dir_weights[dir_index] = ray_dir_counts[dir_index] * ray_dir_weight;
+}}
+"""
+
+
+def prepare_normalize_dir_compute_shader(parameters):
+
+    return NORMALIZE_DIR_COMPUTE_SHADER.format(
+        define_ray_dir_group_size=parameters.ray_dir_group_size,
+        include_ray_dir_buffer_layout=prepare_ray_dir_buffer_layout(parameters),
+        include_ray_dir_count_buffer_layout=RAY_DIR_COUNT_BUFFER_LAYOUT
+    )
 
 
 DISPLAY_DIR_VERTEX_SHADER = """
@@ -277,9 +733,14 @@ void main()
     vec2 dir_position = vec2(cos(dir_angle), sin(dir_angle)) * ray_dir_weights[dir_index] * 5.0;
     gl_Position = vec4(dir_position, 0.0, 1.0);
 }}
-""".format(
-    include_ray_dir_buffer_layout=RAY_DIR_BUFFER_LAYOUT
-)
+"""
+
+
+def prepare_display_dir_vertex_shader(parameters):
+
+    return DISPLAY_DIR_VERTEX_SHADER.format(
+        include_ray_dir_buffer_layout=prepare_ray_dir_buffer_layout(parameters)
+    )
 
 
 DISPLAY_DIR_FRAGMENT_SHADER = """
@@ -294,80 +755,178 @@ void main()
 """
 
 
-RAY1_DATA_OX = [+0.0] * RAY_COUNT
-RAY1_DATA_OY = [+0.0] * RAY_COUNT
-RAY1_DATA_DX = [+0.0] * RAY_COUNT
-RAY1_DATA_DY = [+0.0] * RAY_COUNT
-
-RAY2_DATA_OX = [+0.0] * RAY_COUNT
-RAY2_DATA_OY = [+0.0] * RAY_COUNT
-RAY2_DATA_DX = [+0.0] * RAY_COUNT
-RAY2_DATA_DY = [+0.0] * RAY_COUNT
+# Changes whenever emitted rays are initialized again
+_VERSIONS = count(1)
 
 
 class Resources(object):
 
     def __init__(self):
 
+        self.version = None
+        self.parameters = None
+        self.trace_key = None
         self.trace_program = None
+        self.trace_live_program = None
         self.display_program = None
         self.trace_ray0_buffer = None
         self.trace_ray1_buffer = None
         self.trace_ray2_buffer = None
+        self.trace_live_buffer = None
+        self.sort_key_program = None
+        self.sort = None
+        self.emitter_stream = None
+        self.trace_path_program = None
+        self.trace_path_buffer = None
+        self.display_path_program = None
         self.gather_dir_program = None
+        self.scatter_dir_program = None
+        self.normalize_dir_program = None
         self.display_dir_program = None
         self.display_dir_buffer = None
+        self.display_dir_count_buffer = None
+        self.display_dir_sample_count = 0
         self.display_vertex_array = None
 
-    def initialize(self):
+    def initialize(self, parameters, program_cache, ray_data):
 
-        self.trace_program = initialize_program(
-            initialize_shader(GL_COMPUTE_SHADER, TRACE_COMPUTE_SHADER)
+        self.version = next(_VERSIONS)
+        self.parameters = parameters
+        self.trace_key = None
+
+        self.trace_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_trace_compute_shader(parameters, False))
+        )
+
+        self.trace_live_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_trace_compute_shader(parameters, True))
         )
 
-        self.display_program = initialize_program(
-            initialize_shader(GL_VERTEX_SHADER, DISPLAY_VERTEX_SHADER),
-            initialize_shader(GL_FRAGMENT_SHADER, DISPLAY_FRAGMENT_SHADER)
+        self.display_program = get_program(
+            program_cache,
+            (GL_VERTEX_SHADER, prepare_display_vertex_shader(parameters)),
+            (GL_FRAGMENT_SHADER, DISPLAY_FRAGMENT_SHADER)
         )
 
-        ray0_buffer_data = prepare_float_buffer_data(RAY0_DATA_OX + RAY0_DATA_OY + RAY0_DATA_DX + RAY0_DATA_DY)
-        ray1_buffer_data = prepare_float_buffer_data(RAY1_DATA_OX + RAY1_DATA_OY + RAY1_DATA_DX + RAY1_DATA_DY)
-        ray2_buffer_data = prepare_float_buffer_data(RAY2_DATA_OX + RAY2_DATA_OY + RAY2_DATA_DX + RAY2_DATA_DY)
+        ray0_buffer_data = prepare_float_buffer_data(numpy.concatenate(ray_data))
+        ray1_buffer_data = prepare_float_buffer_data(numpy.zeros(4 * parameters.ray_count, numpy.float32))
+        ray2_buffer_data = prepare_float_buffer_data(numpy.zeros(4 * parameters.ray_count, numpy.float32))
+        if ray0_buffer_data[0] != ray1_buffer_data[0]:
+            raise RuntimeError("Ray data has %d rays instead of %d" % (len(ray_data[0]), parameters.ray_count))
 
         self.trace_ray0_buffer = initialize_buffer(ray0_buffer_data)
         self.trace_ray1_buffer = initialize_buffer(ray1_buffer_data)
         self.trace_ray2_buffer = initialize_buffer(ray2_buffer_data)
+        self.trace_live_buffer = initialize_buffer(prepare_uint_buffer_data(
+            numpy.zeros(8 + 2 * parameters.ray_count, numpy.uint32)
+        ))
+
+        if parameters.ray_sort:
+            self.sort_key_program = get_program(
+                program_cache,
+                (GL_COMPUTE_SHADER, prepare_sort_key_compute_shader(parameters))
+            )
+            self.sort = SortResources()
+            self.sort.initialize(parameters.ray_count, parameters.ray_group_size, RAY_SORT_KEY_BIT_COUNT, program_cache)
+
+        self.emitter_stream = StreamResources()
+        self.emitter_stream.initialize(ray0_buffer_data[0])
+
+        self.trace_path_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_trace_path_compute_shader(parameters))
+        )
+
+        self.trace_path_buffer = initialize_buffer(prepare_empty_float_buffer_data(
+            (parameters.ray_bounce_count + 1) * 4 * parameters.ray_count
+        ))
+
+        self.display_path_program = get_program(
+            program_cache,
+            (GL_VERTEX_SHADER, prepare_display_path_vertex_shader(parameters)),
+            (GL_FRAGMENT_SHADER, DISPLAY_FRAGMENT_SHADER)
+        )
+
+        self.gather_dir_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_gather_compute_shader(parameters))
+        )
 
-        self.gather_dir_program = initialize_program(
-            initialize_shader(GL_COMPUTE_SHADER, GATHER_COMPUTE_SHADER)
+        self.scatter_dir_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_scatter_compute_shader(parameters))
         )
 
-        self.display_dir_program = initialize_program(
-            initialize_shader(GL_VERTEX_SHADER, DISPLAY_DIR_VERTEX_SHADER),
-            initialize_shader(GL_FRAGMENT_SHADER, DISPLAY_DIR_FRAGMENT_SHADER)
+        self.normalize_dir_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_normalize_dir_compute_shader(parameters))
         )
 
-        self.display_dir_buffer = initialize_buffer(prepare_float_buffer_data([1.0] * RAY_DIR_COUNT))
+        self.display_dir_program = get_program(
+            program_cache,
+            (GL_VERTEX_SHADER, prepare_display_dir_vertex_shader(parameters)),
+            (GL_FRAGMENT_SHADER, DISPLAY_DIR_FRAGMENT_SHADER)
+        )
+
+        self.display_dir_buffer = initialize_buffer(prepare_float_buffer_data(numpy.ones(parameters.ray_dir_count, numpy.float32)))
+        self.display_dir_count_buffer = initialize_buffer(prepare_uint_buffer_data(numpy.zeros(parameters.ray_dir_count, numpy.uint32)))
+        self.display_dir_sample_count = 0
 
         self.display_vertex_array = initialize_vertex_array()
 
     def dispose(self):
 
-        self.trace_program = dispose_program(self.trace_program)
-        self.display_program = dispose_program(self.display_program)
+        # Programs belong to the program cache
+        self.version = None
+        self.parameters = None
+        self.trace_key = None
+        self.trace_program = None
+        self.trace_live_program = None
+        self.display_program = None
         self.trace_ray0_buffer = dispose_buffer(self.trace_ray0_buffer)
         self.trace_ray1_buffer = dispose_buffer(self.trace_ray1_buffer)
         self.trace_ray2_buffer = dispose_buffer(self.trace_ray2_buffer)
-        self.gather_dir_program = dispose_program(self.gather_dir_program)
-        self.display_dir_program = dispose_program(self.display_dir_program)
+        self.trace_live_buffer = dispose_buffer(self.trace_live_buffer)
+        self.sort_key_program = None
+        if self.sort is not None:
+            self.sort.dispose()
+            self.sort = None
+        if self.emitter_stream is not None:
+            self.emitter_stream.dispose()
+            self.emitter_stream = None
+        self.trace_path_program = None
+        self.trace_path_buffer = dispose_buffer(self.trace_path_buffer)
+        self.display_path_program = None
+        self.gather_dir_program = None
+        self.scatter_dir_program = None
+        self.normalize_dir_program = None
+        self.display_dir_program = None
         self.display_dir_buffer = dispose_buffer(self.display_dir_buffer)
+        self.display_dir_count_buffer = dispose_buffer(self.display_dir_count_buffer)
+        self.display_dir_sample_count = 0
         self.display_vertex_array = dispose_vertex_array(self.display_vertex_array)
 
 
+def update_emitter(resources, data_ox, data_oy, data_dx, data_dy):
+
+    # Emitted rays go through a streamed region and a GPU copy, Python never waits on the traces in flight
+    emitter_data = map_region(resources.emitter_stream, numpy.float32).reshape(4, resources.parameters.ray_count)
+    emitter_data[0] = data_ox
+    emitter_data[1] = data_oy
+    emitter_data[2] = data_dx
+    emitter_data[3] = data_dy
+    copy_region(resources.emitter_stream, resources.trace_ray0_buffer)
+    fence_region(resources.emitter_stream)
+
+    resources.version = next(_VERSIONS)
+
+
 def _select_input_buffer(resources, iteration):
 
     if iteration == 0:
-        return resources.trace_ray0_buffer  # we never mutate this buffer
+        return resources.trace_ray0_buffer  # only update_emitter mutates this buffer
     elif iteration % 2 == 0:
         return resources.trace_ray2_buffer
     else:
@@ -382,16 +941,84 @@ def _select_output_buffer(resources, iteration):
         return resources.trace_ray2_buffer
 
 
-def trace(resources, iteration, world_buffer, random_buffer):
+def get_ray_buffer(resources, iteration):
 
-    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
-    glUseProgram(resources.trace_program)
-    #glUniform1ui(0, iteration)
+    # Rays traced by the given bounce, they stay there until the bounce after the next one
+    return _select_output_buffer(resources, iteration)
+
+
+def _reset_live_list(resources, live_list):
+
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, resources.trace_live_buffer)
+    glClearBufferSubData(
+        GL_SHADER_STORAGE_BUFFER, GL_RGBA32UI, live_list * RAY_LIVE_LIST_SIZE, RAY_LIVE_LIST_SIZE,
+        GL_RGBA_INTEGER, GL_UNSIGNED_INT, RAY_LIVE_LIST_RESET_DATA
+    )
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+
+def _sort_live_list(resources, live_list, ray_buffer):
+
+    # Rays stay where they are, only their order in the live list changes so the random state follows them
+    live_list_offset = live_list * RAY_LIVE_LIST_SIZE
+    glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+    copy_buffer(resources.trace_live_buffer, live_list_offset, resources.sort.count_buffer, 0, RAY_LIVE_LIST_SIZE)
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_COMMAND_BARRIER_BIT)
+    glUseProgram(resources.sort_key_program)
+    glUniform1ui(0, live_list)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, ray_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.sort.key_buffers[0])
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, resources.sort.value_buffers[0])
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 6, resources.trace_live_buffer)
+    glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, resources.trace_live_buffer)
+    glDispatchComputeIndirect(live_list_offset)
+    glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 6, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
+    glUseProgram(0)
+
+    _, sorted_value_buffer = sort(resources.sort)
+
+    glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+    live_indices_size = resources.parameters.ray_count * sizeof(GLuint)
+    copy_buffer(
+        sorted_value_buffer, 0,
+        resources.trace_live_buffer, 2 * RAY_LIVE_LIST_SIZE + live_list * live_indices_size, live_indices_size
+    )
+
+
+def trace(resources, iteration, world_buffer, world_bvh_buffer, random_buffer):
+
+    # The first bounce runs every ray, the next ones only the rays which stayed in the scene
+    live_output = iteration & 1
+    if iteration > 0 and resources.sort is not None:
+        _sort_live_list(resources, live_output ^ 1, _select_input_buffer(resources, iteration))
+    _reset_live_list(resources, live_output)
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_COMMAND_BARRIER_BIT)
+    glUseProgram(resources.trace_live_program if iteration > 0 else resources.trace_program)
+    glUniform1ui(0, live_output)
+    glUniform1ui(1, iteration)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, world_buffer)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, _select_input_buffer(resources, iteration))
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, _select_output_buffer(resources, iteration))
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, random_buffer)
-    glDispatchCompute(RAY_COUNT // RAY_GROUP_SIZE, 1, 1)
+    if world_bvh_buffer is not None:
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, world_bvh_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 6, resources.trace_live_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 7, _select_output_buffer(resources, iteration + 1))
+    if iteration > 0:
+        glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, resources.trace_live_buffer)
+        glDispatchComputeIndirect((live_output ^ 1) * RAY_LIVE_LIST_SIZE)
+        glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, 0)
+    else:
+        glDispatchCompute(resources.parameters.ray_count // resources.parameters.ray_group_size, 1, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 7, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 6, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
@@ -399,6 +1026,39 @@ def trace(resources, iteration, world_buffer, random_buffer):
     glUseProgram(0)
 
 
+def trace_paths(resources, world_buffer, world_bvh_buffer, random_buffer):
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.trace_path_program)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, world_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, resources.trace_ray0_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.trace_path_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, random_buffer)
+    if world_bvh_buffer is not None:
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, world_bvh_buffer)
+    glDispatchCompute(resources.parameters.ray_count // resources.parameters.ray_group_size, 1, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
+    glUseProgram(0)
+
+
+def _bind_ray_buffers(resources, iteration):
+
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, _select_input_buffer(resources, iteration))
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, _select_output_buffer(resources, iteration))
+
+
+def _bind_path_buffers(resources, iteration):
+
+    # Path slices share the ray buffer layout, their size is a multiple of the ray group size which keeps offsets aligned
+    slice_size = 4 * resources.parameters.ray_count * sizeof(GLfloat)
+    glBindBufferRange(GL_SHADER_STORAGE_BUFFER, 1, resources.trace_path_buffer, iteration * slice_size, slice_size)
+    glBindBufferRange(GL_SHADER_STORAGE_BUFFER, 2, resources.trace_path_buffer, (iteration + 1) * slice_size, slice_size)
+
+
 def display_lines(resources, view_projection, iteration):
 
     glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
@@ -408,9 +1068,8 @@ def display_lines(resources, view_projection, iteration):
     glBindVertexArray(resources.display_vertex_array)
     glUseProgram(resources.display_program)
     update_view_projection(view_projection)
-    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, _select_input_buffer(resources, iteration))
-    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, _select_output_buffer(resources, iteration))
-    glDrawArrays(GL_LINES, 0, RAY_COUNT << 1)
+    _bind_ray_buffers(resources, iteration)
+    glDrawArrays(GL_LINES, 0, resources.parameters.ray_count << 1)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
     glUseProgram(0)
@@ -418,24 +1077,114 @@ def display_lines(resources, view_projection, iteration):
     glDisable(GL_BLEND)
 
 
-def display_directions(resources, iteration):
+def display_paths(resources, view_projection):
+
+    # Every bounce in a single draw, the path buffer keeps all of them
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glEnable(GL_BLEND)
+    glBlendEquation(GL_FUNC_ADD)
+    glBlendFunc(GL_ONE, GL_ONE)
+    glBindVertexArray(resources.display_vertex_array)
+    glUseProgram(resources.display_path_program)
+    update_view_projection(view_projection)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.trace_path_buffer)
+    glDrawArrays(GL_LINES, 0, (resources.parameters.ray_bounce_count * resources.parameters.ray_count) << 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
+    glUseProgram(0)
+    glBindVertexArray(0)
+    glDisable(GL_BLEND)
+
+
+def _gather_directions(resources, iteration, bind_buffers):
 
     glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
     glUseProgram(resources.gather_dir_program)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.display_dir_buffer)
-    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, _select_input_buffer(resources, iteration))
-    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, _select_output_buffer(resources, iteration))
-    glDispatchCompute(RAY_DIR_COUNT // RAY_DIR_GROUP_SIZE, 1, 1)
+    bind_buffers(resources, iteration)
+    glDispatchCompute(resources.parameters.ray_dir_count // resources.parameters.ray_dir_group_size, 1, 1)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
     glUseProgram(0)
 
+
+def reset_directions(resources):
+
+    clear_uint_buffer(resources.display_dir_count_buffer)
+    resources.display_dir_sample_count = 0
+
+
+def _scatter_directions(resources, iteration, bind_buffers):
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.scatter_dir_program)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, resources.display_dir_count_buffer)
+    bind_buffers(resources, iteration)
+    glDispatchCompute(resources.parameters.ray_count // resources.parameters.ray_group_size, 1, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, 0)
+    glUseProgram(0)
+
+    resources.display_dir_sample_count += resources.parameters.ray_count
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.normalize_dir_program)
+    glUniform1f(0, 1.0 / resources.display_dir_sample_count)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.display_dir_buffer)
+    glDispatchCompute(resources.parameters.ray_dir_count // resources.parameters.ray_dir_group_size, 1, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
+    glUseProgram(0)
+
+
+def _compute_directions(resources, iteration, bind_buffers):
+
+    if RAY_DIR_SCATTER:
+        reset_directions(resources)
+        _scatter_directions(resources, iteration, bind_buffers)
+    else:
+        _gather_directions(resources, iteration, bind_buffers)
+
+
+def compute_directions(resources, iteration):
+
+    _compute_directions(resources, iteration, _bind_ray_buffers)
+
+
+def compute_path_directions(resources, iteration):
+
+    _compute_directions(resources, iteration, _bind_path_buffers)
+
+
+def accumulate_directions(resources, iteration):
+
+    _scatter_directions(resources, iteration, _bind_ray_buffers)
+
+
+def accumulate_path_directions(resources, iteration):
+
+    _scatter_directions(resources, iteration, _bind_path_buffers)
+
+
+def draw_directions(resources):
+
     glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
     glBindVertexArray(resources.display_vertex_array)
     glUseProgram(resources.display_dir_program)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.display_dir_buffer)
-    glDrawArrays(GL_LINE_STRIP, 0, RAY_DIR_COUNT)
+    glDrawArrays(GL_LINE_STRIP, 0, resources.parameters.ray_dir_count)
     glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
     glUseProgram(0)
     glBindVertexArray(0)
+
+
+def display_directions(resources, iteration):
+
+    compute_directions(resources, iteration)
+    draw_directions(resources)
+
+
+def display_path_directions(resources, iteration):
+
+    compute_path_directions(resources, iteration)
+    draw_directions(resources)
@@ -0,0 +1,216 @@
+# coding: utf8
+
+import os
+
+from ctypes import c_ubyte
+from queue import SimpleQueue, Empty
+from threading import Thread
+
+from OpenGL.GL import GL_COPY_WRITE_BUFFER, GL_COPY_READ_BUFFER, GL_MAP_READ_BIT, GL_MAP_PERSISTENT_BIT, \
+    GL_MAP_COHERENT_BIT, GL_CLIENT_STORAGE_BIT, GL_BUFFER_UPDATE_BARRIER_BIT, GL_CLIENT_MAPPED_BUFFER_BARRIER_BIT, \
+    GL_SYNC_GPU_COMMANDS_COMPLETE, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_EXPIRED, GL_WAIT_FAILED, GLuint, \
+    glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferStorage, glMapBufferRange, glUnmapBuffer, \
+    glCopyBufferSubData, glMemoryBarrier, glFenceSync, glClientWaitSync, glDeleteSync
+
+import numpy
+
+import Registry
+
+from Config import READBACK_REGION_COUNT, READBACK_WAIT_TIMEOUT
+
+
+READBACK_MAP_FLAGS = GL_MAP_READ_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+
+
+def _consume_regions(resources):
+
+    # Runs on the consumer thread, it never calls GL and gives every region back once its views are consumed
+    while True:
+        ready_region = resources.ready_regions.get()
+        if ready_region is None:
+            return
+        region_index, key = ready_region
+        try:
+            if resources.consumer_error is None:
+                resources.consumer(key, _get_region_views(resources, region_index))
+        except Exception as error:
+            resources.consumer_error = error
+        finally:
+            resources.free_regions.put(region_index)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.buffer = None
+        self.mapping = None
+        self.fields = None
+        self.field_offsets = None
+        self.region_stride = 0
+        self.region_fences = None
+        self.pending_regions = None
+        self.free_regions = None
+        self.ready_regions = None
+        self.consumer = None
+        self.consumer_error = None
+        self.consumer_thread = None
+
+    def initialize(self, fields, consumer, region_count=READBACK_REGION_COUNT):
+
+        # Fields are (name, dtype, count) tuples, every region holds one copy of each of them
+        self.fields = [(name, numpy.dtype(data_type), count) for name, data_type, count in fields]
+        self.field_offsets = []
+        region_size = 0
+        for _, data_type, count in self.fields:
+            self.field_offsets.append(region_size)
+            region_size += (data_type.itemsize * count + 15) & ~15
+        self.region_stride = region_size
+        buffer_size = self.region_stride * region_count
+
+        # The buffer stays mapped for its whole life, copies are seen by Python once their fence is signaled
+        self.buffer = GLuint(0)
+        glGenBuffers(1, self.buffer)
+        Registry.track("buffer", self.buffer, buffer_size)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, self.buffer)
+        glBufferStorage(GL_COPY_WRITE_BUFFER, buffer_size, None, READBACK_MAP_FLAGS | GL_CLIENT_STORAGE_BIT)
+        address = glMapBufferRange(GL_COPY_WRITE_BUFFER, 0, buffer_size, READBACK_MAP_FLAGS)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        self.mapping = numpy.frombuffer((c_ubyte * buffer_size).from_address(address), numpy.uint8)
+        self.region_fences = [None] * region_count
+        self.pending_regions = []
+        self.free_regions = SimpleQueue()
+        for region_index in range(region_count):
+            self.free_regions.put(region_index)
+        self.ready_regions = SimpleQueue()
+
+        self.consumer = consumer
+        self.consumer_error = None
+        self.consumer_thread = Thread(target=_consume_regions, args=(self,), daemon=True)
+        self.consumer_thread.start()
+
+    def dispose(self):
+
+        # Regions in flight are still handed to the consumer, nothing copied is lost
+        if self.consumer_thread is not None:
+            while self.pending_regions:
+                _wait_region(self)
+            self.ready_regions.put(None)
+            self.consumer_thread.join()
+
+        if self.region_fences is not None:
+            for fence in self.region_fences:
+                if fence is not None:
+                    glDeleteSync(fence)
+
+        if self.buffer is not None:
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.buffer)
+            glUnmapBuffer(GL_COPY_WRITE_BUFFER)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+            Registry.untrack("buffer", self.buffer)
+            glDeleteBuffers(1, self.buffer)
+
+        self.buffer = None
+        self.mapping = None
+        self.fields = None
+        self.field_offsets = None
+        self.region_stride = 0
+        self.region_fences = None
+        self.pending_regions = None
+        self.free_regions = None
+        self.ready_regions = None
+        self.consumer = None
+        self.consumer_error = None
+        self.consumer_thread = None
+
+
+def _get_region_views(resources, region_index):
+
+    region_offset = region_index * resources.region_stride
+    region_views = {}
+    for (name, data_type, count), field_offset in zip(resources.fields, resources.field_offsets):
+        field_begin = region_offset + field_offset
+        region_views[name] = resources.mapping[field_begin:field_begin + data_type.itemsize * count].view(data_type)
+    return region_views
+
+
+def _release_region(resources):
+
+    region_index, key = resources.pending_regions.pop(0)
+    glDeleteSync(resources.region_fences[region_index])
+    resources.region_fences[region_index] = None
+    resources.ready_regions.put((region_index, key))
+
+
+def _wait_region(resources):
+
+    # Only waits when the GPU has not finished the oldest copies yet
+    region_index, _ = resources.pending_regions[0]
+    while True:
+        status = glClientWaitSync(resources.region_fences[region_index], GL_SYNC_FLUSH_COMMANDS_BIT, READBACK_WAIT_TIMEOUT)
+        if status == GL_WAIT_FAILED:
+            raise RuntimeError("Failed to wait for a readback fence")
+        if status != GL_TIMEOUT_EXPIRED:
+            break
+    _release_region(resources)
+
+
+def poll_regions(resources):
+
+    # Never waits, regions are handed over in the order they were read
+    if resources.consumer_error is not None:
+        raise RuntimeError("Readback consumer failed") from resources.consumer_error
+
+    while resources.pending_regions:
+        region_index, _ = resources.pending_regions[0]
+        status = glClientWaitSync(resources.region_fences[region_index], GL_SYNC_FLUSH_COMMANDS_BIT, 0)
+        if status == GL_WAIT_FAILED:
+            raise RuntimeError("Failed to wait for a readback fence")
+        if status == GL_TIMEOUT_EXPIRED:
+            break
+        _release_region(resources)
+
+
+def _acquire_region(resources):
+
+    poll_regions(resources)
+    try:
+        return resources.free_regions.get_nowait()
+    except Empty:
+        pass
+
+    # Every region is either in flight or with the consumer, the oldest copies are the first ones to be done
+    if resources.pending_regions:
+        _wait_region(resources)
+    return resources.free_regions.get()
+
+
+def read_region(resources, key, *buffers):
+
+    # One buffer per field, copied from its start, the consumer receives the key along with the field views
+    region_index = _acquire_region(resources)
+    region_offset = region_index * resources.region_stride
+
+    glMemoryBarrier(GL_BUFFER_UPDATE_BARRIER_BIT)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, resources.buffer)
+    for buffer, (_, data_type, count), field_offset in zip(buffers, resources.fields, resources.field_offsets):
+        glBindBuffer(GL_COPY_READ_BUFFER, buffer)
+        glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, 0, region_offset + field_offset, data_type.itemsize * count)
+    glBindBuffer(GL_COPY_READ_BUFFER, 0)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+    glMemoryBarrier(GL_CLIENT_MAPPED_BUFFER_BARRIER_BIT)
+    resources.region_fences[region_index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+    resources.pending_regions.append((region_index, key))
+
+
+def prepare_directory_consumer(path):
+
+    # One uncompressed archive per frame, views are only valid during the call so they are written right away
+    os.makedirs(path, exist_ok=True)
+
+    def consume(frame, views):
+        numpy.savez(os.path.join(path, "%06d.npz" % frame), **views)
+
+    return consume
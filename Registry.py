@@ -0,0 +1,76 @@
+# coding: utf8
+
+import sys
+
+from collections import Counter
+from traceback import StackSummary, walk_stack
+
+from Config import REGISTRY_STACK_LIMIT
+
+
+# Helpers are plain functions without resources, they all report to this module
+_entries = {}
+_counts = Counter()
+_byte_sizes = Counter()
+
+
+def _get_key(object_type, name):
+
+    return object_type, int(getattr(name, "value", name))
+
+
+def track(object_type, name, byte_size=0):
+
+    # Source lines are only read when a leak is reported
+    call_stack = StackSummary.extract(walk_stack(sys._getframe(1)), limit=REGISTRY_STACK_LIMIT, lookup_lines=False)
+    key = _get_key(object_type, name)
+    if key in _entries:
+        untrack(object_type, name)
+    _entries[key] = (byte_size, call_stack)
+    _counts[object_type] += 1
+    _byte_sizes[object_type] += byte_size
+    return name
+
+
+def untrack(object_type, name):
+
+    entry = _entries.pop(_get_key(object_type, name), None)
+    if entry is not None:
+        _counts[object_type] -= 1
+        _byte_sizes[object_type] -= entry[0]
+
+
+def get_count(object_type):
+
+    return _counts[object_type]
+
+
+def get_byte_size(object_type):
+
+    return _byte_sizes[object_type]
+
+
+def list_live_objects():
+
+    return sorted(_entries.keys())
+
+
+def format_report():
+
+    lines = []
+    for object_type in sorted(_counts):
+        if _counts[object_type] > 0:
+            lines.append("{0:<16} {1:6d} objects {2:12d} bytes".format(
+                object_type, _counts[object_type], _byte_sizes[object_type]
+            ))
+    return "\n".join(lines)
+
+
+def format_leaks():
+
+    # Whatever is still alive once everything was disposed, with the call stack which created it
+    lines = []
+    for (object_type, name), (byte_size, call_stack) in sorted(_entries.items()):
+        lines.append("{0} {1} ({2} bytes) created at:".format(object_type, name, byte_size))
+        lines.extend(line.rstrip("\n") for line in reversed(call_stack.format()))
+    return "\n".join(lines)
@@ -0,0 +1,86 @@
+# coding: utf8
+
+import importlib
+import os
+import sys
+
+
+RELOAD_POLL_INTERVAL = 0.25
+
+
+def _get_modification_time(path):
+
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.dependencies = None
+        self.modification_times = None
+        self.pending_names = None
+
+    def initialize(self):
+
+        # Resource name to watched paths, sources files or Python modules
+        self.dependencies = {}
+        self.modification_times = {}
+        self.pending_names = set()
+
+    def dispose(self):
+
+        self.dependencies = None
+        self.modification_times = None
+        self.pending_names = None
+
+
+def get_module_path(module):
+
+    return os.path.abspath(module.__file__)
+
+
+def watch(resources, dependencies):
+
+    for name, paths in dependencies.items():
+        paths = set(os.path.abspath(path) for path in paths)
+        resources.dependencies[name] = paths
+        for path in paths:
+            if path not in resources.modification_times:
+                resources.modification_times[path] = _get_modification_time(path)
+
+
+def poll(resources):
+
+    changed_paths = set()
+    for path, modification_time in resources.modification_times.items():
+        next_modification_time = _get_modification_time(path)
+        if next_modification_time != modification_time:
+            resources.modification_times[path] = next_modification_time
+            changed_paths.add(path)
+
+    # Names which failed to reload are retried with the next change
+    for name, paths in resources.dependencies.items():
+        if not paths.isdisjoint(changed_paths):
+            resources.pending_names.add(name)
+
+    return changed_paths
+
+
+def reload_modules(changed_paths, module):
+
+    # Changed modules first, then the main one which may hold names imported from them
+    for other_module in list(sys.modules.values()):
+        if other_module is not module and getattr(other_module, "__file__", None) is not None:
+            if get_module_path(other_module) in changed_paths:
+                importlib.reload(other_module)
+
+    return importlib.reload(module)
+
+
+def is_module_changed(changed_paths):
+
+    return any(path.endswith(".py") for path in changed_paths)
@@ -0,0 +1,201 @@
+# coding: utf8
+
+import os
+
+from argparse import ArgumentParser
+
+import numpy
+
+from Bvh import BVH_NODE_SIZE, build_bvh
+from Config import WORLD_LINE_COUNT
+
+
+SCENE_MAGIC = b"SCN2"
+
+# Every section is 8 bytes aligned, polylines are described by the offset of their first point, the BVH of the lines
+# follows them with the layout of the World BVH buffer
+SCENE_HEADER_DTYPE = numpy.dtype([
+    ("magic", "S4"),
+    ("padding", "<u4"),
+    ("polyline_count", "<u8"),
+    ("point_count", "<u8"),
+    ("bvh_node_count", "<u8")
+])
+
+SCENE_POINT_OFFSET_DTYPE = numpy.dtype("<u8")
+SCENE_FLOAT_DTYPE = numpy.dtype("<f4")
+SCENE_UINT_DTYPE = numpy.dtype("<u4")
+
+
+def _align(offset):
+
+    return (offset + 7) & ~7
+
+
+def _prepare_section_offsets(polyline_count, point_count, bvh_node_count):
+
+    segment_count = point_count - polyline_count
+    point_offsets_offset = SCENE_HEADER_DTYPE.itemsize
+    point_x_offset = _align(point_offsets_offset + (polyline_count + 1) * SCENE_POINT_OFFSET_DTYPE.itemsize)
+    point_y_offset = _align(point_x_offset + point_count * SCENE_FLOAT_DTYPE.itemsize)
+    ior_i_offset = _align(point_y_offset + point_count * SCENE_FLOAT_DTYPE.itemsize)
+    ior_t_offset = _align(ior_i_offset + segment_count * SCENE_FLOAT_DTYPE.itemsize)
+    bvh_lines_offset = _align(ior_t_offset + segment_count * SCENE_FLOAT_DTYPE.itemsize)
+    bvh_nodes_offset = _align(bvh_lines_offset + segment_count * SCENE_UINT_DTYPE.itemsize)
+    end_offset = bvh_nodes_offset + bvh_node_count * BVH_NODE_SIZE * SCENE_UINT_DTYPE.itemsize
+    return point_offsets_offset, point_x_offset, point_y_offset, ior_i_offset, ior_t_offset, bvh_lines_offset, \
+        bvh_nodes_offset, end_offset
+
+
+def _read_header(path):
+
+    header = numpy.fromfile(path, SCENE_HEADER_DTYPE, 1)
+    if len(header) != 1 or header["magic"][0] != SCENE_MAGIC:
+        raise RuntimeError("%s is not a scene file" % path)
+    polyline_count = int(header["polyline_count"][0])
+    point_count = int(header["point_count"][0])
+    if point_count <= polyline_count:
+        raise RuntimeError("%s has no lines, %d polylines for %d points" % (path, polyline_count, point_count))
+    return polyline_count, point_count, int(header["bvh_node_count"][0])
+
+
+def read_line_count(path):
+
+    polyline_count, point_count, _ = _read_header(path)
+    return point_count - polyline_count
+
+
+def save_scene(path, world_data):
+
+    # Same polylines as World.Resources.initialize takes, one segment less than points for each of them
+    int_x, int_y, int_ior_i, int_ior_t = world_data
+    point_counts = numpy.array([len(line_strip) for line_strip in int_x], SCENE_POINT_OFFSET_DTYPE)
+    short_polylines = numpy.nonzero(point_counts < 2)[0]
+    if len(short_polylines):
+        raise RuntimeError("Polyline %d has %d points, polylines need at least 2" % (
+            short_polylines[0], point_counts[short_polylines[0]]
+        ))
+    polyline_count = len(point_counts)
+    point_count = int(point_counts.sum())
+    point_offsets = numpy.concatenate(([0], numpy.cumsum(point_counts))).astype(SCENE_POINT_OFFSET_DTYPE)
+    point_x = numpy.concatenate(int_x).astype(SCENE_FLOAT_DTYPE)
+    point_y = numpy.concatenate(int_y).astype(SCENE_FLOAT_DTYPE)
+
+    # Built once here, loading a scene only uploads it
+    first_points = numpy.delete(numpy.arange(point_count), point_offsets[1:].astype(numpy.int64) - 1)
+    bvh_lines, bvh_nodes, _ = build_bvh(
+        numpy.stack((point_x[first_points], point_x[first_points + 1]), axis=1).ravel(),
+        numpy.stack((point_y[first_points], point_y[first_points + 1]), axis=1).ravel()
+    )
+
+    header = numpy.zeros(1, SCENE_HEADER_DTYPE)
+    header["magic"] = SCENE_MAGIC
+    header["polyline_count"] = polyline_count
+    header["point_count"] = point_count
+    header["bvh_node_count"] = len(bvh_nodes)
+
+    sections = (
+        point_offsets,
+        point_x,
+        point_y,
+        numpy.concatenate(int_ior_i).astype(SCENE_FLOAT_DTYPE),
+        numpy.concatenate(int_ior_t).astype(SCENE_FLOAT_DTYPE),
+        bvh_lines.astype(SCENE_UINT_DTYPE),
+        bvh_nodes.view(numpy.uint32).astype(SCENE_UINT_DTYPE)
+    )
+    section_offsets = _prepare_section_offsets(polyline_count, point_count, len(bvh_nodes))
+
+    with open(path, "wb") as scene_file:
+        header.tofile(scene_file)
+        for section, section_offset in zip(sections, section_offsets):
+            scene_file.write(b"\0" * (section_offset - scene_file.tell()))
+            section.tofile(scene_file)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.polyline_count = 0
+        self.point_count = 0
+        self.line_count = 0
+        self.line_offsets = None
+        self.point_offsets = None
+        self.point_x = None
+        self.point_y = None
+        self.line_ior_i = None
+        self.line_ior_t = None
+        self.bvh_node_count = 0
+        self.bvh_lines = None
+        self.bvh_nodes = None
+
+    def initialize(self, path):
+
+        self.polyline_count, self.point_count, self.bvh_node_count = _read_header(path)
+        self.line_count = self.point_count - self.polyline_count
+
+        point_offsets_offset, point_x_offset, point_y_offset, ior_i_offset, ior_t_offset, bvh_lines_offset, \
+            bvh_nodes_offset, end_offset = _prepare_section_offsets(self.polyline_count, self.point_count, self.bvh_node_count)
+        if os.path.getsize(path) < end_offset:
+            raise RuntimeError("%s is truncated" % path)
+
+        # Pages are only read when lines are requested
+        self.point_offsets = numpy.memmap(path, SCENE_POINT_OFFSET_DTYPE, "r", point_offsets_offset, self.polyline_count + 1)
+        self.point_x = numpy.memmap(path, SCENE_FLOAT_DTYPE, "r", point_x_offset, self.point_count)
+        self.point_y = numpy.memmap(path, SCENE_FLOAT_DTYPE, "r", point_y_offset, self.point_count)
+        self.line_ior_i = numpy.memmap(path, SCENE_FLOAT_DTYPE, "r", ior_i_offset, self.line_count)
+        self.line_ior_t = numpy.memmap(path, SCENE_FLOAT_DTYPE, "r", ior_t_offset, self.line_count)
+        self.bvh_lines = numpy.memmap(path, SCENE_UINT_DTYPE, "r", bvh_lines_offset, self.line_count)
+        self.bvh_nodes = numpy.memmap(path, SCENE_UINT_DTYPE, "r", bvh_nodes_offset, (self.bvh_node_count, BVH_NODE_SIZE))
+
+        # Line counts come from the header, they only hold when every polyline has at least one line
+        point_offsets = self.point_offsets.astype(numpy.int64)
+        if point_offsets[0] != 0 or point_offsets[-1] != self.point_count or numpy.any(numpy.diff(point_offsets) < 2):
+            raise RuntimeError("%s has polylines with less than 2 points" % path)
+
+        # First line of every polyline, the last offset is the line count
+        self.line_offsets = point_offsets - numpy.arange(self.polyline_count + 1)
+
+    def dispose(self):
+
+        self.polyline_count = 0
+        self.point_count = 0
+        self.line_count = 0
+        self.line_offsets = None
+        self.point_offsets = None
+        self.point_x = None
+        self.point_y = None
+        self.line_ior_i = None
+        self.line_ior_t = None
+        self.bvh_node_count = 0
+        self.bvh_lines = None
+        self.bvh_nodes = None
+
+
+def get_world_lines(resources, first_line, last_line):
+
+    # Points are stored in pairs like the World buffer, the first point of a line is its index plus its polyline index
+    lines = numpy.arange(first_line, last_line)
+    first_points = lines + numpy.searchsorted(resources.line_offsets, lines, "right") - 1
+    world_pos_x = numpy.stack((resources.point_x[first_points], resources.point_x[first_points + 1]), axis=1).ravel()
+    world_pos_y = numpy.stack((resources.point_y[first_points], resources.point_y[first_points + 1]), axis=1).ravel()
+    world_ior_i = numpy.asarray(resources.line_ior_i[first_line:last_line])
+    world_ior_t = numpy.asarray(resources.line_ior_t[first_line:last_line])
+    return world_pos_x, world_pos_y, world_ior_i, world_ior_t
+
+
+def main():
+
+    import Pipeline
+
+    parser = ArgumentParser(description="Write the generated world of the pipeline to a scene file")
+    parser.add_argument("output")
+    parser.add_argument("--world-line-count", type=int, default=WORLD_LINE_COUNT)
+    args = parser.parse_args()
+
+    _, world_data = Pipeline.prepare_scene_data(Pipeline.prepare_parameters(world_line_count=args.world_line_count))
+    save_scene(args.output, world_data)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,28 @@
 # coding: utf8
 
-from OpenGL.GL import GL_COMPILE_STATUS, GL_LINK_STATUS,\
+import os
+
+from ctypes import c_ubyte
+from hashlib import sha256
+
+from OpenGL.error import GLError
+
+from OpenGL.GL import GL_COMPILE_STATUS, GL_LINK_STATUS, GL_PROGRAM_BINARY_LENGTH, GL_PROGRAM_BINARY_RETRIEVABLE_HINT,\
+    GL_NUM_PROGRAM_BINARY_FORMATS, GL_PROGRAM_BINARY_FORMATS, GL_VENDOR, GL_RENDERER, GL_VERSION, GL_TRUE, GLenum, GLsizei,\
     glCreateShader, glDeleteShader, glShaderSource, glCompileShader, glGetShaderiv, glGetShaderInfoLog,\
-    glCreateProgram, glDeleteProgram, glAttachShader, glLinkProgram, glGetProgramiv, glGetProgramInfoLog
+    glCreateProgram, glDeleteProgram, glAttachShader, glLinkProgram, glGetProgramiv, glGetProgramInfoLog,\
+    glProgramParameteri, glGetProgramBinary, glProgramBinary, glGetIntegerv, glGetString
+
+import numpy
+
+import Registry
+
+from Config import PROGRAM_BINARY_CACHE_PATH
 
 
 def initialize_shader(shader_type, shader_source):
 
-    shader = glCreateShader(shader_type)
+    shader = Registry.track("shader", glCreateShader(shader_type))
     glShaderSource(shader, shader_source)
     glCompileShader(shader)
     result = glGetShaderiv(shader, GL_COMPILE_STATUS)
@@ -19,14 +34,17 @@ def initialize_shader(shader_type, shader_source):
 def dispose_shader(shader):
 
     if shader is not None:
+        Registry.untrack("shader", shader)
         glDeleteShader(shader)
 
 
-def initialize_program(*shaders):
+def initialize_program(*shaders, retrievable=False):
 
-    program = glCreateProgram()
+    program = Registry.track("program", glCreateProgram())
     for shader in shaders:
         glAttachShader(program, shader)
+    if retrievable:
+        glProgramParameteri(program, GL_PROGRAM_BINARY_RETRIEVABLE_HINT, GL_TRUE)
     glLinkProgram(program)
     for shader in shaders:
         dispose_shader(shader)
@@ -39,4 +57,127 @@ def initialize_program(*shaders):
 def dispose_program(program):
 
     if program is not None:
+        Registry.untrack("program", program)
         glDeleteProgram(program)
+
+
+def _get_program_binary_path(shader_sources):
+
+    # Binaries only load on the driver which produced them, parameters are already formatted in the sources
+    key = sha256()
+    for name in (GL_VENDOR, GL_RENDERER, GL_VERSION):
+        key.update(glGetString(name))
+        key.update(b"\0")
+    for shader_type, shader_source in shader_sources:
+        key.update(b"%d\0" % int(shader_type))
+        key.update(shader_source.encode())
+        key.update(b"\0")
+    return os.path.join(PROGRAM_BINARY_CACHE_PATH, key.hexdigest() + ".bin")
+
+
+def _get_program_binary_formats():
+
+    program_binary_formats = numpy.zeros(glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS), numpy.int32)
+    glGetIntegerv(GL_PROGRAM_BINARY_FORMATS, program_binary_formats)
+    return program_binary_formats.tolist()
+
+
+def _remove_program_binary(program_binary_path):
+
+    try:
+        os.remove(program_binary_path)
+    except OSError:
+        pass
+
+
+def _load_program_binary(program_binary_path):
+
+    try:
+        with open(program_binary_path, "rb") as program_binary_file:
+            data = program_binary_file.read()
+    except OSError:
+        return None
+
+    # Truncated files and binaries of other formats are never handed to the driver
+    binary_format = int.from_bytes(data[:4], "little")
+    if len(data) <= 4 or binary_format not in _get_program_binary_formats():
+        _remove_program_binary(program_binary_path)
+        return None
+
+    # A binary may still be rejected, after a driver update for instance, the program is then built from sources
+    program = Registry.track("program", glCreateProgram())
+    try:
+        glProgramBinary(program, binary_format, data[4:], len(data) - 4)
+        is_linked = glGetProgramiv(program, GL_LINK_STATUS) != 0
+    except GLError:
+        is_linked = False
+    if not is_linked:
+        dispose_program(program)
+        _remove_program_binary(program_binary_path)
+        return None
+    return program
+
+
+def _save_program_binary(program_binary_path, program):
+
+    binary_length = glGetProgramiv(program, GL_PROGRAM_BINARY_LENGTH)
+    if binary_length == 0:
+        return
+
+    binary = (c_ubyte * binary_length)()
+    binary_format = GLenum(0)
+    glGetProgramBinary(program, binary_length, GLsizei(0), binary_format, binary)
+
+    # Written aside then renamed, a concurrent start never reads a partial file
+    os.makedirs(PROGRAM_BINARY_CACHE_PATH, exist_ok=True)
+    temporary_path = "%s.%d" % (program_binary_path, os.getpid())
+    with open(temporary_path, "wb") as program_binary_file:
+        program_binary_file.write(binary_format.value.to_bytes(4, "little"))
+        program_binary_file.write(bytes(binary))
+    os.replace(temporary_path, program_binary_path)
+
+
+def initialize_program_from_sources(*shader_sources):
+
+    if PROGRAM_BINARY_CACHE_PATH is None or glGetIntegerv(GL_NUM_PROGRAM_BINARY_FORMATS) == 0:
+        return initialize_program(*(
+            initialize_shader(shader_type, shader_source) for shader_type, shader_source in shader_sources
+        ))
+
+    program_binary_path = _get_program_binary_path(shader_sources)
+    program = _load_program_binary(program_binary_path)
+    if program is None:
+        program = initialize_program(*(
+            initialize_shader(shader_type, shader_source) for shader_type, shader_source in shader_sources
+        ), retrievable=True)
+        _save_program_binary(program_binary_path, program)
+    return program
+
+
+class ProgramCache(object):
+
+    def __init__(self):
+
+        self.programs = None
+
+    def initialize(self):
+
+        self.programs = {}
+
+    def dispose(self):
+
+        if self.programs is not None:
+            for program in self.programs.values():
+                dispose_program(program)
+
+        self.programs = None
+
+
+def get_program(program_cache, *shader_sources):
+
+    # Sources are final, parameters are already formatted in, so equal sources always give the same program
+    program = program_cache.programs.get(shader_sources)
+    if program is None:
+        program = initialize_program_from_sources(*shader_sources)
+        program_cache.programs[shader_sources] = program
+    return program
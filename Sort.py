@@ -0,0 +1,322 @@
+# coding: utf8
+
+from OpenGL.GL import GL_COMPUTE_SHADER, GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, \
+    GL_COMMAND_BARRIER_BIT, GL_DISPATCH_INDIRECT_BUFFER, \
+    glUseProgram, glUniform1ui, glBindBuffer, glBindBufferBase, glDispatchCompute, glDispatchComputeIndirect, \
+    glMemoryBarrier
+
+import numpy
+
+from Buffer import prepare_uint_buffer_data, prepare_empty_uint_buffer_data, initialize_buffer, dispose_buffer
+from Shader import get_program
+
+
+SORT_RADIX_BIT_COUNT = 4
+SORT_RADIX = 1 << SORT_RADIX_BIT_COUNT
+
+
+# Same layout as a dispatch indirect command followed by the item count, the group count is read by every pass
+COUNT_BUFFER_LAYOUT = """
+layout(std430, binding = 0) buffer SortCountBuffer
+{
+    uint sort_group_count;
+    uint sort_group_count_y;
+    uint sort_group_count_z;
+    uint sort_count;
+};
+"""
+
+
+KEY_VALUE_BUFFER_LAYOUT = """
+layout(std430, binding = {key_binding}) buffer SortKeyBuffer{suffix}
+{{
+    uint sort_keys{suffix}[{item_count}];
+}};
+
+layout(std430, binding = {value_binding}) buffer SortValueBuffer{suffix}
+{{
+    uint sort_values{suffix}[{item_count}];
+}};
+"""
+
+
+def prepare_key_value_buffer_layout(item_count, key_binding, value_binding, suffix):
+
+    return KEY_VALUE_BUFFER_LAYOUT.format(
+        key_binding=key_binding, value_binding=value_binding, suffix=suffix, item_count=item_count
+    )
+
+
+HISTOGRAM_BUFFER_LAYOUT = """
+#define SORT_RADIX {define_sort_radix}
+#define SORT_GROUP_SIZE {define_sort_group_size}
+
+// Digit major, the exclusive scan of this order gives every group its first slot for every digit
+layout(std430, binding = 5) buffer SortHistogramBuffer
+{{
+    uint sort_histogram[];
+}};
+
+layout(location = 0) uniform uint sort_shift;
+"""
+
+
+def prepare_histogram_buffer_layout(group_size):
+
+    return HISTOGRAM_BUFFER_LAYOUT.format(define_sort_radix=SORT_RADIX, define_sort_group_size=group_size)
+
+
+COUNT_COMPUTE_SHADER = """
+#version 430
+
+{include_count_buffer_layout}
+{include_key_value_buffer_layout}
+{include_histogram_buffer_layout}
+
+layout (local_size_x = SORT_GROUP_SIZE, local_size_y = 1) in;
+
+shared uint group_histogram[SORT_RADIX];
+
+void main()
+{{
+    uint local_index = gl_LocalInvocationID.x;
+    uint item_index = gl_GlobalInvocationID.x;
+
+    if (local_index < SORT_RADIX)
+    {{
+        group_histogram[local_index] = 0;
+    }}
+    barrier();
+
+    if (item_index < sort_count)
+    {{
+        atomicAdd(group_histogram[(sort_keys0[item_index] >> sort_shift) & (SORT_RADIX - 1)], 1u);
+    }}
+    barrier();
+
+    if (local_index < SORT_RADIX)
+    {{
+        sort_histogram[local_index * sort_group_count + gl_WorkGroupID.x] = group_histogram[local_index];
+    }}
+}}
+"""
+
+
+SCAN_COMPUTE_SHADER = """
+#version 430
+
+{include_count_buffer_layout}
+{include_histogram_buffer_layout}
+
+layout (local_size_x = SORT_GROUP_SIZE, local_size_y = 1) in;
+
+shared uint group_sums[SORT_GROUP_SIZE];
+
+void main()
+{{
+    // A single group, each invocation scans a contiguous chunk and offsets it by the sums of the previous chunks
+    uint local_index = gl_LocalInvocationID.x;
+    uint histogram_size = SORT_RADIX * sort_group_count;
+    uint chunk_size = (histogram_size + SORT_GROUP_SIZE - 1) / SORT_GROUP_SIZE;
+    uint chunk_begin = min(local_index * chunk_size, histogram_size);
+    uint chunk_end = min(chunk_begin + chunk_size, histogram_size);
+
+    uint sum = 0;
+    for (uint i = chunk_begin; i < chunk_end; ++i)
+    {{
+        sum += sort_histogram[i];
+    }}
+    group_sums[local_index] = sum;
+    barrier();
+
+    if (local_index == 0)
+    {{
+        uint offset = 0;
+        for (uint i = 0; i < SORT_GROUP_SIZE; ++i)
+        {{
+            uint group_sum = group_sums[i];
+            group_sums[i] = offset;
+            offset += group_sum;
+        }}
+    }}
+    barrier();
+
+    uint offset = group_sums[local_index];
+    for (uint i = chunk_begin; i < chunk_end; ++i)
+    {{
+        uint count = sort_histogram[i];
+        sort_histogram[i] = offset;
+        offset += count;
+    }}
+}}
+"""
+
+
+SCATTER_COMPUTE_SHADER = """
+#version 430
+
+{include_count_buffer_layout}
+{include_key_value_buffer0_layout}
+{include_key_value_buffer1_layout}
+{include_histogram_buffer_layout}
+
+layout (local_size_x = SORT_GROUP_SIZE, local_size_y = 1) in;
+
+shared uint group_digits[SORT_GROUP_SIZE];
+
+void main()
+{{
+    uint local_index = gl_LocalInvocationID.x;
+    uint item_index = gl_GlobalInvocationID.x;
+
+    uint key = item_index < sort_count ? sort_keys0[item_index] : 0;
+    uint digit = item_index < sort_count ? (key >> sort_shift) & (SORT_RADIX - 1) : SORT_RADIX;
+    group_digits[local_index] = digit;
+    barrier();
+
+    // Items of the group with the same digit keep their order, which keeps the sort stable across passes
+    if (item_index < sort_count)
+    {{
+        uint rank = 0;
+        for (uint i = 0; i < local_index; ++i)
+        {{
+            rank += uint(group_digits[i] == digit);
+        }}
+        uint slot = sort_histogram[digit * sort_group_count + gl_WorkGroupID.x] + rank;
+        sort_keys1[slot] = key;
+        sort_values1[slot] = sort_values0[item_index];
+    }}
+}}
+"""
+
+
+def prepare_count_compute_shader(item_count, group_size):
+
+    return COUNT_COMPUTE_SHADER.format(
+        include_count_buffer_layout=COUNT_BUFFER_LAYOUT,
+        include_key_value_buffer_layout=prepare_key_value_buffer_layout(item_count, 1, 2, 0),
+        include_histogram_buffer_layout=prepare_histogram_buffer_layout(group_size)
+    )
+
+
+def prepare_scan_compute_shader(group_size):
+
+    return SCAN_COMPUTE_SHADER.format(
+        include_count_buffer_layout=COUNT_BUFFER_LAYOUT,
+        include_histogram_buffer_layout=prepare_histogram_buffer_layout(group_size)
+    )
+
+
+def prepare_scatter_compute_shader(item_count, group_size):
+
+    return SCATTER_COMPUTE_SHADER.format(
+        include_count_buffer_layout=COUNT_BUFFER_LAYOUT,
+        include_key_value_buffer0_layout=prepare_key_value_buffer_layout(item_count, 1, 2, 0),
+        include_key_value_buffer1_layout=prepare_key_value_buffer_layout(item_count, 3, 4, 1),
+        include_histogram_buffer_layout=prepare_histogram_buffer_layout(group_size)
+    )
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.item_count = 0
+        self.group_size = 0
+        self.key_bit_count = 0
+        self.count_program = None
+        self.scan_program = None
+        self.scatter_program = None
+        self.count_buffer = None
+        self.key_buffers = None
+        self.value_buffers = None
+        self.histogram_buffer = None
+
+    def initialize(self, item_count, group_size, key_bit_count, program_cache):
+
+        if group_size < SORT_RADIX:
+            raise RuntimeError("Sort group size must be at least %d" % SORT_RADIX)
+
+        self.item_count = item_count
+        self.group_size = group_size
+        self.key_bit_count = key_bit_count
+
+        self.count_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_count_compute_shader(item_count, group_size))
+        )
+
+        self.scan_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_scan_compute_shader(group_size))
+        )
+
+        self.scatter_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_scatter_compute_shader(item_count, group_size))
+        )
+
+        group_count = (item_count + group_size - 1) // group_size
+        self.count_buffer = initialize_buffer(prepare_uint_buffer_data(numpy.array([group_count, 1, 1, item_count], numpy.uint32)))
+        self.key_buffers = [initialize_buffer(prepare_empty_uint_buffer_data(item_count)) for _ in range(2)]
+        self.value_buffers = [initialize_buffer(prepare_empty_uint_buffer_data(item_count)) for _ in range(2)]
+        self.histogram_buffer = initialize_buffer(prepare_empty_uint_buffer_data(SORT_RADIX * group_count))
+
+    def dispose(self):
+
+        # Programs belong to the program cache
+        self.item_count = 0
+        self.group_size = 0
+        self.key_bit_count = 0
+        self.count_program = None
+        self.scan_program = None
+        self.scatter_program = None
+        self.count_buffer = dispose_buffer(self.count_buffer)
+        if self.key_buffers is not None:
+            for key_buffer in self.key_buffers:
+                dispose_buffer(key_buffer)
+        if self.value_buffers is not None:
+            for value_buffer in self.value_buffers:
+                dispose_buffer(value_buffer)
+        self.key_buffers = None
+        self.value_buffers = None
+        self.histogram_buffer = dispose_buffer(self.histogram_buffer)
+
+
+def sort(resources):
+
+    # Least significant digit first, pairs are read from the first key and value buffers and the count buffer,
+    # whichever buffers hold the sorted pairs are returned
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.count_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, resources.histogram_buffer)
+    glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, resources.count_buffer)
+
+    for sort_shift in range(0, resources.key_bit_count, SORT_RADIX_BIT_COUNT):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, resources.key_buffers[0])
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.value_buffers[0])
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, resources.key_buffers[1])
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, resources.value_buffers[1])
+
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT | GL_COMMAND_BARRIER_BIT)
+        glUseProgram(resources.count_program)
+        glUniform1ui(0, sort_shift)
+        glDispatchComputeIndirect(0)
+
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        glUseProgram(resources.scan_program)
+        glDispatchCompute(1, 1, 1)
+
+        glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+        glUseProgram(resources.scatter_program)
+        glUniform1ui(0, sort_shift)
+        glDispatchComputeIndirect(0)
+
+        resources.key_buffers.reverse()
+        resources.value_buffers.reverse()
+
+    glUseProgram(0)
+    glBindBuffer(GL_DISPATCH_INDIRECT_BUFFER, 0)
+    for binding in range(6):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, 0)
+
+    return resources.key_buffers[0], resources.value_buffers[0]
@@ -0,0 +1,110 @@
+# coding: utf8
+
+from ctypes import c_ubyte
+
+from OpenGL.GL import GL_COPY_WRITE_BUFFER, GL_COPY_READ_BUFFER, GL_SHADER_STORAGE_BUFFER_OFFSET_ALIGNMENT, \
+    GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT, GL_MAP_WRITE_BIT, GL_MAP_PERSISTENT_BIT, GL_MAP_COHERENT_BIT, \
+    GL_SYNC_GPU_COMMANDS_COMPLETE, GL_SYNC_FLUSH_COMMANDS_BIT, GL_TIMEOUT_EXPIRED, GLuint, \
+    glGenBuffers, glDeleteBuffers, glBindBuffer, glBufferStorage, glMapBufferRange, glUnmapBuffer, \
+    glCopyBufferSubData, glFenceSync, glClientWaitSync, glDeleteSync, glGetIntegerv
+
+import numpy
+
+import Registry
+
+from Config import STREAM_REGION_COUNT, STREAM_WAIT_TIMEOUT
+
+
+STREAM_MAP_FLAGS = GL_MAP_WRITE_BIT | GL_MAP_PERSISTENT_BIT | GL_MAP_COHERENT_BIT
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.buffer = None
+        self.mapping = None
+        self.region_size = 0
+        self.region_stride = 0
+        self.region_index = 0
+        self.region_fences = None
+
+    def initialize(self, region_size, region_count=STREAM_REGION_COUNT):
+
+        # Regions start on offsets aligned like storage and uniform ranges
+        alignment = max(
+            glGetIntegerv(GL_SHADER_STORAGE_BUFFER_OFFSET_ALIGNMENT),
+            glGetIntegerv(GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT)
+        )
+        self.region_size = region_size
+        self.region_stride = (region_size + alignment - 1) // alignment * alignment
+        buffer_size = self.region_stride * region_count
+
+        # The buffer stays mapped for its whole life, coherent writes are seen by the next commands
+        self.buffer = GLuint(0)
+        glGenBuffers(1, self.buffer)
+        Registry.track("buffer", self.buffer, buffer_size)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, self.buffer)
+        glBufferStorage(GL_COPY_WRITE_BUFFER, buffer_size, None, STREAM_MAP_FLAGS)
+        address = glMapBufferRange(GL_COPY_WRITE_BUFFER, 0, buffer_size, STREAM_MAP_FLAGS)
+        glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+
+        self.mapping = numpy.frombuffer((c_ubyte * buffer_size).from_address(address), numpy.uint8)
+        self.region_index = 0
+        self.region_fences = [None] * region_count
+
+    def dispose(self):
+
+        if self.region_fences is not None:
+            for fence in self.region_fences:
+                if fence is not None:
+                    glDeleteSync(fence)
+
+        if self.buffer is not None:
+            glBindBuffer(GL_COPY_WRITE_BUFFER, self.buffer)
+            glUnmapBuffer(GL_COPY_WRITE_BUFFER)
+            glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+            Registry.untrack("buffer", self.buffer)
+            glDeleteBuffers(1, self.buffer)
+
+        self.buffer = None
+        self.mapping = None
+        self.region_size = 0
+        self.region_stride = 0
+        self.region_index = 0
+        self.region_fences = None
+
+
+def _get_region_offset(resources):
+
+    return resources.region_index * resources.region_stride
+
+
+def map_region(resources, data_type=numpy.uint8):
+
+    # Only waits when the GPU is still reading this region from STREAM_REGION_COUNT frames ago
+    fence = resources.region_fences[resources.region_index]
+    if fence is not None:
+        while glClientWaitSync(fence, GL_SYNC_FLUSH_COMMANDS_BIT, STREAM_WAIT_TIMEOUT) == GL_TIMEOUT_EXPIRED:
+            pass
+        glDeleteSync(fence)
+        resources.region_fences[resources.region_index] = None
+
+    region_offset = _get_region_offset(resources)
+    return resources.mapping[region_offset:region_offset + resources.region_size].view(data_type)
+
+
+def copy_region(resources, buffer, buffer_offset=0):
+
+    glBindBuffer(GL_COPY_READ_BUFFER, resources.buffer)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, buffer)
+    glCopyBufferSubData(GL_COPY_READ_BUFFER, GL_COPY_WRITE_BUFFER, _get_region_offset(resources), buffer_offset, resources.region_size)
+    glBindBuffer(GL_COPY_WRITE_BUFFER, 0)
+    glBindBuffer(GL_COPY_READ_BUFFER, 0)
+
+
+def fence_region(resources):
+
+    # Called once the commands reading the region are issued, the next write goes to the next region
+    resources.region_fences[resources.region_index] = glFenceSync(GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+    resources.region_index = (resources.region_index + 1) % len(resources.region_fences)
@@ -0,0 +1,155 @@
+# coding: utf8
+
+from collections import deque
+from contextlib import contextmanager
+
+from OpenGL.GL import GL_TIMESTAMP, GL_QUERY_RESULT, GL_QUERY_RESULT_AVAILABLE, GLuint, GLuint64, \
+    glGenQueries, glDeleteQueries, glQueryCounter, glGetQueryObjectuiv, glGetQueryObjectui64v
+
+import numpy
+
+import Registry
+
+from Config import TIMER_FRAME_COUNT, TIMER_SAMPLE_COUNT
+
+
+def _initialize_query():
+
+    query = GLuint(0)
+    glGenQueries(1, query)
+    return Registry.track("query", query)
+
+
+def _is_query_available(query):
+
+    available = GLuint(0)
+    glGetQueryObjectuiv(query, GL_QUERY_RESULT_AVAILABLE, available)
+    return bool(available.value)
+
+
+def _get_query_result(query):
+
+    result = GLuint64(0)
+    glGetQueryObjectui64v(query, GL_QUERY_RESULT, result)
+    return result.value
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.frame_index = 0
+        self.frame_names = None
+        self.frame_queries = None
+        self.samples = None
+        self.dropped_frame_count = 0
+
+    def initialize(self):
+
+        # Each frame of the ring keeps its queries, two timestamps per pass, and reuses them once read back
+        self.frame_index = 0
+        self.frame_names = [[] for _ in range(TIMER_FRAME_COUNT)]
+        self.frame_queries = [[] for _ in range(TIMER_FRAME_COUNT)]
+        self.samples = {}
+        self.dropped_frame_count = 0
+
+    def dispose(self):
+
+        if self.frame_queries is not None:
+            for queries in self.frame_queries:
+                for query in queries:
+                    Registry.untrack("query", query)
+                    glDeleteQueries(1, query)
+
+        self.frame_index = 0
+        self.frame_names = None
+        self.frame_queries = None
+        self.samples = None
+        self.dropped_frame_count = 0
+
+
+def _collect_frame(resources, frame_index):
+
+    names = resources.frame_names[frame_index]
+    queries = resources.frame_queries[frame_index]
+
+    # Timestamps are written in order, the frame is done when its last one is
+    if not names or not _is_query_available(queries[(len(names) << 1) - 1]):
+        return
+
+    for name_index, name in enumerate(names):
+        begin_time = _get_query_result(queries[(name_index << 1) + 0])
+        end_time = _get_query_result(queries[(name_index << 1) + 1])
+        if name not in resources.samples:
+            resources.samples[name] = deque(maxlen=TIMER_SAMPLE_COUNT)
+        resources.samples[name].append((end_time - begin_time) * 1e-6)
+
+    del names[:]
+
+
+def begin_frame(resources):
+
+    resources.frame_index = (resources.frame_index + 1) % TIMER_FRAME_COUNT
+
+    for frame_index in range(TIMER_FRAME_COUNT):
+        _collect_frame(resources, frame_index)
+
+    # Never wait for the GPU, a frame which is still in flight when its queries are needed again is lost
+    if resources.frame_names[resources.frame_index]:
+        del resources.frame_names[resources.frame_index][:]
+        resources.dropped_frame_count += 1
+
+
+def begin(resources, name):
+
+    names = resources.frame_names[resources.frame_index]
+    queries = resources.frame_queries[resources.frame_index]
+
+    query_index = len(names) << 1
+    if query_index == len(queries):
+        queries.append(_initialize_query())
+        queries.append(_initialize_query())
+
+    names.append(name)
+    glQueryCounter(queries[query_index], GL_TIMESTAMP)
+
+
+def end(resources):
+
+    names = resources.frame_names[resources.frame_index]
+    queries = resources.frame_queries[resources.frame_index]
+    glQueryCounter(queries[(len(names) << 1) - 1], GL_TIMESTAMP)
+
+
+@contextmanager
+def measure(resources, name):
+
+    begin(resources, name)
+    try:
+        yield
+    finally:
+        end(resources)
+
+
+def get_statistics(resources):
+
+    # Milliseconds per pass: min, mean and 99th percentile over the last samples
+    statistics = {}
+    for name, samples in resources.samples.items():
+        samples = numpy.array(samples)
+        statistics[name] = (samples.min(), samples.mean(), numpy.percentile(samples, 99.0))
+    return statistics
+
+
+def format_statistics(resources):
+
+    statistics = get_statistics(resources)
+    name_width = max((len(name) for name in statistics), default=0)
+    lines = []
+    for name, (time_min, time_mean, time_p99) in statistics.items():
+        lines.append("{0:<{1}} min {2:7.3f} ms  mean {3:7.3f} ms  p99 {4:7.3f} ms".format(
+            name, name_width, time_min, time_mean, time_p99
+        ))
+    if resources.dropped_frame_count > 0:
+        lines.append("{0} frames dropped".format(resources.dropped_frame_count))
+    return "\n".join(lines)
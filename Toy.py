@@ -4,8 +4,12 @@ import importlib
 import Helpers
 importlib.reload(Helpers)
 
-from Helpers import compile_shader, link_program, create_program_attribute_layout, create_vertex_array_and_draw_call,\
+import Registry
+import Shader
+
+from Helpers import create_program_attribute_layout, create_vertex_array_and_draw_call,\
     flatten_vertex_data, validate_vertex_data, validate_attribute_bindings
+from Shader import initialize_program_from_sources
 
 
 def create_cube(s):
@@ -119,42 +123,84 @@ class Resources(object):
         if resources is None:
             self.cube_vertex_array = 0
             self.cube_draw_call = None
+            self.cube_layout = None
             self.program = 0
         else:
             self.cube_vertex_array = resources.cube_vertex_array
             self.cube_draw_call = resources.cube_draw_call
+            self.cube_layout = resources.cube_layout
             self.program = resources.program
 
-    def initialize(self, _frame_size):
+    def initialize(self, frame_size):
+
+        self.initialize_program(frame_size)
+        self.initialize_cube(frame_size)
+        self.validate()
+
+    def initialize_program(self, _frame_size):
 
-        # Program
+        # Program, loaded from the binary cache unless a source changed
         with open("Dummy.vert") as vertex_shader_file:
-            vertex_shader = compile_shader(vertex_shader_file.readlines(), GL.GL_VERTEX_SHADER)
+            vertex_shader_source = vertex_shader_file.read()
 
         with open("Dummy.frag") as pixel_shader_file:
-            pixel_shader = compile_shader(pixel_shader_file.readlines(), GL.GL_FRAGMENT_SHADER)
+            pixel_shader_source = pixel_shader_file.read()
 
-        program = link_program(vertex_shader, pixel_shader)
+        program = initialize_program_from_sources(
+            (GL.GL_VERTEX_SHADER, vertex_shader_source),
+            (GL.GL_FRAGMENT_SHADER, pixel_shader_source)
+        )
         self.program = program
 
-        # Cube
+    def initialize_cube(self, _frame_size):
+
         flat_vertex_data = flatten_vertex_data(validate_vertex_data(create_cube(0.5)))
         cube_vertex_array, cube_draw_call = create_vertex_array_and_draw_call(*flat_vertex_data)
         self.cube_vertex_array = cube_vertex_array
         self.cube_draw_call = cube_draw_call
+        self.cube_layout = flat_vertex_data[:2]
+
+    def validate(self):
 
-        # Validate both
-        validate_attribute_bindings(*create_program_attribute_layout(program), *flat_vertex_data[:2])
+        validate_attribute_bindings(*create_program_attribute_layout(self.program), *self.cube_layout)
 
     def dispose(self):
 
+        self.dispose_cube()
+        self.dispose_program()
+
+    def dispose_program(self):
+
+        Registry.untrack("program", self.program)
+        GL.glDeleteProgram(self.program)
+        self.program = 0
+
+    def dispose_cube(self):
+
+        Registry.untrack("vertex_array", self.cube_vertex_array)
         GL.glDeleteVertexArrays(1, [self.cube_vertex_array])
         self.cube_vertex_array = 0
 
         self.cube_draw_call = None
+        self.cube_layout = None
 
-        GL.glDeleteProgram(self.program)
-        self.program = 0
+
+def list_dependencies():
+
+    # Files and modules each resource is built from, a change only rebuilds the resources depending on it
+    return {
+        "program": (__file__, Shader.__file__, "Dummy.vert", "Dummy.frag"),
+        "cube": (__file__, Helpers.__file__)
+    }
+
+
+def reload(resources, names, frame_size):
+
+    for name in names:
+        getattr(resources, "dispose_" + name)()
+    for name in names:
+        getattr(resources, "initialize_" + name)(frame_size)
+    resources.validate()
 
 
 def render(resources, frame_size, elapsed_time):
@@ -0,0 +1,552 @@
+# coding: utf8
+
+from OpenGL.GL import GL_COMPUTE_SHADER, GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, \
+    glUseProgram, glUniform1ui, glUniform1f, glBindBufferBase, glDispatchCompute, glMemoryBarrier, GLfloat, GLuint, sizeof
+
+import numpy
+
+import Random
+import Ray
+import World
+
+from Buffer import prepare_empty_float_buffer_data, prepare_empty_uint_buffer_data, initialize_buffer, update_buffer, \
+    read_buffer, clear_uint_buffer, dispose_buffer
+from Shader import get_program
+from Bvh import NODE_LAYOUT as BVH_NODE_LAYOUT, BVH_NODE_SIZE, build_bvh, get_bvh_node_count, prepare_bvh_buffer_data
+from Config import RAY_DIR_SHARED_HISTOGRAM_MAX_COUNT, VARIANT_COUNT
+
+
+# Every buffer holds one block per variant, laid out like the buffer of a single scene, dispatches run the
+# variants along y and the shared shaders reach the block of their variant through these names
+VARIANT_BASE_LOCATION = 8
+
+VARIANT_LAYOUT = """
+layout(location = {define_variant_base_location}) uniform uint variant_base;
+
+#define world_variant (variant_base + gl_GlobalInvocationID.y)
+""".format(define_variant_base_location=VARIANT_BASE_LOCATION)
+
+
+WORLD_BUFFER_LAYOUT = """
+#define WORLD_LINE_COUNT {define_world_line_count}
+
+struct WorldVariant
+{{
+    float pos_x[WORLD_LINE_COUNT << 1];
+    float pos_y[WORLD_LINE_COUNT << 1];
+    float ior_i[WORLD_LINE_COUNT];
+    float ior_t[WORLD_LINE_COUNT];
+}};
+
+layout(std430, binding = 0) readonly buffer World
+{{
+    WorldVariant world_variants[];
+}};
+
+#define world_pos_x world_variants[world_variant].pos_x
+#define world_pos_y world_variants[world_variant].pos_y
+#define world_ior_i world_variants[world_variant].ior_i
+#define world_ior_t world_variants[world_variant].ior_t
+"""
+
+
+def prepare_world_buffer_layout(parameters):
+
+    return WORLD_BUFFER_LAYOUT.format(define_world_line_count=World.get_line_slot_count(parameters)) + World.LINE_SHADER
+
+
+WORLD_BVH_BUFFER_LAYOUT = """
+struct WorldBvhVariant
+{{
+    uint lines[WORLD_LINE_COUNT];
+    BvhNode nodes[{bvh_node_count}];
+}};
+
+layout(std430, binding = 4) readonly buffer WorldBvh
+{{
+    WorldBvhVariant bvh_variants[];
+}};
+
+#define bvh_lines bvh_variants[world_variant].lines
+#define bvh_nodes bvh_variants[world_variant].nodes
+"""
+
+
+def prepare_world_bvh_buffer_layout(parameters):
+
+    return BVH_NODE_LAYOUT + WORLD_BVH_BUFFER_LAYOUT.format(
+        bvh_node_count=get_bvh_node_count(World.get_line_slot_count(parameters))
+    )
+
+
+RAY_BUFFER_LAYOUT = """
+struct RayVariant
+{{
+    float ox[{ray_count}];
+    float oy[{ray_count}];
+    float dx[{ray_count}];
+    float dy[{ray_count}];
+}};
+
+layout(std430, binding = 1) readonly buffer RayBuffer0
+{{
+    RayVariant ray0_variants[];
+}};
+
+#define ray0_ox ray0_variants[world_variant].ox
+#define ray0_oy ray0_variants[world_variant].oy
+#define ray0_dx ray0_variants[world_variant].dx
+#define ray0_dy ray0_variants[world_variant].dy
+"""
+
+
+def prepare_ray_buffer_layout(parameters):
+
+    return RAY_BUFFER_LAYOUT.format(ray_count=parameters.ray_count)
+
+
+# Same slices as the path buffer of Ray, directions are gathered from the slice of the last traced bounce
+PATH_BUFFER_LAYOUT = """
+#define RAY_BOUNCE_COUNT {define_ray_bounce_count}
+
+struct PathSlice
+{{
+    float ox[{ray_count}];
+    float oy[{ray_count}];
+    float dx[{ray_count}];
+    float dy[{ray_count}];
+}};
+
+struct PathVariant
+{{
+    PathSlice slices[RAY_BOUNCE_COUNT + 1];
+}};
+
+layout(std430, binding = 2) buffer PathBuffer
+{{
+    PathVariant path_variants[];
+}};
+
+void set_path_vertex(uint bounce, uint ray_index, vec2 ray_o, vec2 ray_d)
+{{
+    path_variants[world_variant].slices[bounce].ox[ray_index] = ray_o.x;
+    path_variants[world_variant].slices[bounce].oy[ray_index] = ray_o.y;
+    path_variants[world_variant].slices[bounce].dx[ray_index] = ray_d.x;
+    path_variants[world_variant].slices[bounce].dy[ray_index] = ray_d.y;
+}}
+"""
+
+
+def prepare_path_buffer_layout(parameters):
+
+    return PATH_BUFFER_LAYOUT.format(
+        define_ray_bounce_count=parameters.ray_bounce_count,
+        ray_count=parameters.ray_count
+    )
+
+
+PATH_DIRECTION_LAYOUT = """
+#define ray0_dx path_variants[world_variant].slices[RAY_BOUNCE_COUNT - 1].dx
+#define ray0_dy path_variants[world_variant].slices[RAY_BOUNCE_COUNT - 1].dy
+"""
+
+
+RANDOM_BUFFER_LAYOUT = """
+#define MERSENNE_TWISTER_COUNT {mersenne_twister_count}
+
+struct MersenneTwisterVariant
+{{
+    uvec4 status[MERSENNE_TWISTER_COUNT];
+    uint m1[MERSENNE_TWISTER_COUNT];
+    uint m2[MERSENNE_TWISTER_COUNT];
+    uint tmat[MERSENNE_TWISTER_COUNT];
+}};
+
+layout(std430, binding = 3) buffer MersenneTwister
+{{
+    MersenneTwisterVariant mt_variants[];
+}};
+
+#define mt_status mt_variants[world_variant].status
+#define mt_m1 mt_variants[world_variant].m1
+#define mt_m2 mt_variants[world_variant].m2
+#define mt_tmat mt_variants[world_variant].tmat
+"""
+
+
+RANDOM_COUNTER_BUFFER_LAYOUT = """
+struct RandomKey
+{
+    uint seed;
+    uint frame;
+};
+
+layout(std430, binding = 3) readonly buffer RandomKeys
+{
+    RandomKey random_keys[];
+};
+
+#define random_seed random_keys[world_variant].seed
+#define random_frame random_keys[world_variant].frame
+"""
+
+
+def prepare_random_buffer_layout(parameters):
+
+    if parameters.random_counter:
+        return RANDOM_COUNTER_BUFFER_LAYOUT
+    return RANDOM_BUFFER_LAYOUT.format(mersenne_twister_count=parameters.ray_count)
+
+
+RAY_DIR_BUFFER_LAYOUT = """
+#define RAY_DIR_COUNT {define_ray_dir_count}
+
+struct RayDirVariant
+{{
+    float weights[RAY_DIR_COUNT];
+}};
+
+layout(std430, binding = 0) buffer RayDirBuffer
+{{
+    RayDirVariant ray_dir_variants[];
+}};
+
+#define ray_dir_weights ray_dir_variants[world_variant].weights
+"""
+
+
+def prepare_ray_dir_buffer_layout(parameters):
+
+    return RAY_DIR_BUFFER_LAYOUT.format(define_ray_dir_count=parameters.ray_dir_count)
+
+
+RAY_DIR_COUNT_BUFFER_LAYOUT = """
+struct RayDirCountVariant
+{
+    uint counts[RAY_DIR_COUNT];
+};
+
+layout(std430, binding = 5) buffer RayDirCountBuffer
+{
+    RayDirCountVariant ray_dir_count_variants[];
+};
+
+#define ray_dir_counts ray_dir_count_variants[world_variant].counts
+"""
+
+
+TRACE_PATH_COMPUTE_SHADER = """
+#version 430
+
+{include_variant_layout}
+{world_buffer_layout}
+{world_bvh_buffer_layout}
+{ray_buffer_layout}
+{path_buffer_layout}
+{include_random_layout}
+{include_random}
+
+{include_trace}
+
+layout (local_size_x = {ray_group_size}, local_size_y = 1) in;
+
+void main()
+{{
+    // Same paths as Ray, generators belong to the variant like every other buffer
+    uint ray_index = gl_GlobalInvocationID.x;
+
+    vec2 ray_o = vec2(ray0_ox[ray_index], ray0_oy[ray_index]);
+    vec2 ray_d = vec2(ray0_dx[ray_index], ray0_dy[ray_index]);
+
+    set_path_vertex(0, ray_index, ray_o, ray_d);
+
+    bool is_alive = true;
+    for (uint bounce = 1; bounce <= RAY_BOUNCE_COUNT; ++bounce)
+    {{
+        if (is_alive)
+        {{
+            set_random_bounce(bounce - 1);
+            is_alive = trace_ray(ray_index, ray_o, ray_d);
+        }}
+        set_path_vertex(bounce, ray_index, ray_o, ray_d);
+    }}
+}}
+"""
+
+
+def prepare_trace_path_compute_shader(parameters):
+
+    return TRACE_PATH_COMPUTE_SHADER.format(
+        include_variant_layout=VARIANT_LAYOUT,
+        world_buffer_layout=prepare_world_buffer_layout(parameters),
+        world_bvh_buffer_layout=prepare_world_bvh_buffer_layout(parameters) if parameters.world_bvh else "",
+        ray_buffer_layout=prepare_ray_buffer_layout(parameters),
+        path_buffer_layout=prepare_path_buffer_layout(parameters),
+        include_random_layout=prepare_random_buffer_layout(parameters),
+        include_random=Random.prepare_shader(parameters),
+        include_trace=Ray.prepare_trace_shader(parameters),
+        ray_group_size=parameters.ray_group_size
+    )
+
+
+def prepare_init_random_compute_shader(parameters):
+
+    return Random.INIT_SHADER.format(
+        include_rand_buffer_layout=VARIANT_LAYOUT + prepare_random_buffer_layout(parameters),
+        include_rand_shader=Random.SHADER,
+        define_seed_location=Random.SEED_LOCATION
+    )
+
+
+def prepare_scatter_compute_shader(parameters):
+
+    return Ray.SCATTER_COMPUTE_SHADER.format(
+        define_ray_group_size=parameters.ray_group_size,
+        define_ray_dir_shared_histogram=int(parameters.ray_dir_count <= RAY_DIR_SHARED_HISTOGRAM_MAX_COUNT),
+        include_ray_buffer0_layout=VARIANT_LAYOUT + prepare_path_buffer_layout(parameters) + PATH_DIRECTION_LAYOUT,
+        include_ray_dir_buffer_layout=prepare_ray_dir_buffer_layout(parameters),
+        include_ray_dir_count_buffer_layout=RAY_DIR_COUNT_BUFFER_LAYOUT
+    )
+
+
+def prepare_normalize_dir_compute_shader(parameters):
+
+    return Ray.NORMALIZE_DIR_COMPUTE_SHADER.format(
+        define_ray_dir_group_size=parameters.ray_dir_group_size,
+        include_ray_dir_buffer_layout=VARIANT_LAYOUT + prepare_ray_dir_buffer_layout(parameters),
+        include_ray_dir_count_buffer_layout=RAY_DIR_COUNT_BUFFER_LAYOUT
+    )
+
+
+def get_world_variant_size(parameters):
+
+    return 6 * World.get_line_slot_count(parameters) * sizeof(GLfloat)
+
+
+def get_world_bvh_variant_size(parameters):
+
+    line_slot_count = World.get_line_slot_count(parameters)
+    bvh_node_count = get_bvh_node_count(line_slot_count)
+    return (line_slot_count + line_slot_count % 2) * sizeof(GLuint) + bvh_node_count * BVH_NODE_SIZE * sizeof(GLfloat)
+
+
+def get_random_variant_size(parameters):
+
+    if parameters.random_counter:
+        return 2 * sizeof(GLuint)
+    return 7 * parameters.ray_count * sizeof(GLuint)
+
+
+class Resources(object):
+
+    def __init__(self):
+
+        self.parameters = None
+        self.variant_count = 0
+        self.trace_variant_count = 0
+        self.trace_path_program = None
+        self.init_random_program = None
+        self.scatter_dir_program = None
+        self.normalize_dir_program = None
+        self.world_buffer = None
+        self.world_bvh_buffer = None
+        self.ray_buffer = None
+        self.path_buffer = None
+        self.random_buffer = None
+        self.random_seeds = None
+        self.random_frame = 0
+        self.dir_buffer = None
+        self.dir_count_buffer = None
+        self.dir_sample_count = 0
+
+    def initialize(self, parameters, program_cache, variant_count=VARIANT_COUNT):
+
+        self.parameters = parameters
+        self.variant_count = variant_count
+        self.trace_variant_count = 0
+
+        self.trace_path_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_trace_path_compute_shader(parameters))
+        )
+
+        if not parameters.random_counter:
+            self.init_random_program = get_program(
+                program_cache,
+                (GL_COMPUTE_SHADER, prepare_init_random_compute_shader(parameters))
+            )
+
+        self.scatter_dir_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_scatter_compute_shader(parameters))
+        )
+
+        self.normalize_dir_program = get_program(
+            program_cache,
+            (GL_COMPUTE_SHADER, prepare_normalize_dir_compute_shader(parameters))
+        )
+
+        # Variants are written one at a time before they are traced, nothing needs initial data
+        ray_float_count = 4 * parameters.ray_count
+        self.world_buffer = initialize_buffer(prepare_empty_float_buffer_data(
+            variant_count * get_world_variant_size(parameters) // sizeof(GLfloat)
+        ))
+        if parameters.world_bvh:
+            self.world_bvh_buffer = initialize_buffer(prepare_empty_uint_buffer_data(
+                variant_count * get_world_bvh_variant_size(parameters) // sizeof(GLuint)
+            ))
+        self.ray_buffer = initialize_buffer(prepare_empty_float_buffer_data(variant_count * ray_float_count))
+        self.path_buffer = initialize_buffer(prepare_empty_float_buffer_data(
+            variant_count * (parameters.ray_bounce_count + 1) * ray_float_count
+        ))
+        self.random_buffer = initialize_buffer(prepare_empty_uint_buffer_data(
+            variant_count * get_random_variant_size(parameters) // sizeof(GLuint)
+        ))
+        self.random_seeds = None
+        self.random_frame = 0
+        self.dir_buffer = initialize_buffer(prepare_empty_float_buffer_data(variant_count * parameters.ray_dir_count))
+        self.dir_count_buffer = initialize_buffer(prepare_empty_uint_buffer_data(variant_count * parameters.ray_dir_count))
+        self.dir_sample_count = 0
+
+    def dispose(self):
+
+        # Programs belong to the program cache
+        self.parameters = None
+        self.variant_count = 0
+        self.trace_variant_count = 0
+        self.trace_path_program = None
+        self.init_random_program = None
+        self.scatter_dir_program = None
+        self.normalize_dir_program = None
+        self.world_buffer = dispose_buffer(self.world_buffer)
+        self.world_bvh_buffer = dispose_buffer(self.world_bvh_buffer)
+        self.ray_buffer = dispose_buffer(self.ray_buffer)
+        self.path_buffer = dispose_buffer(self.path_buffer)
+        self.random_buffer = dispose_buffer(self.random_buffer)
+        self.random_seeds = None
+        self.random_frame = 0
+        self.dir_buffer = dispose_buffer(self.dir_buffer)
+        self.dir_count_buffer = dispose_buffer(self.dir_count_buffer)
+        self.dir_sample_count = 0
+
+
+def update_world(resources, variant, world_data):
+
+    parameters = resources.parameters
+    if parameters.world_scene_path is not None:
+        raise RuntimeError("World lines come from %s, they are not replaced by world data" % parameters.world_scene_path)
+
+    world_pos_x, world_pos_y, world_ior_i, world_ior_t, _ = World.prepare_world_lines(parameters, world_data)
+    update_buffer(
+        resources.world_buffer, variant * get_world_variant_size(parameters),
+        numpy.concatenate((world_pos_x, world_pos_y, world_ior_i, world_ior_t))
+    )
+
+    if resources.world_bvh_buffer is not None:
+        bvh_lines, bvh_nodes, _ = build_bvh(world_pos_x, world_pos_y)
+        _, bvh_buffer_data = prepare_bvh_buffer_data(bvh_lines, bvh_nodes)
+        update_buffer(resources.world_bvh_buffer, variant * get_world_bvh_variant_size(parameters), bvh_buffer_data)
+
+
+def update_rays(resources, variant, ray_data):
+
+    ray_variant_size = 4 * resources.parameters.ray_count * sizeof(GLfloat)
+    update_buffer(resources.ray_buffer, variant * ray_variant_size, numpy.concatenate(ray_data).astype(numpy.float32))
+
+
+def _update_random_keys(resources):
+
+    random_keys = numpy.array([(seed, resources.random_frame) for seed in resources.random_seeds], numpy.uint32)
+    update_buffer(resources.random_buffer, 0, random_keys)
+
+
+def init_random(resources, random_seeds):
+
+    # One seed per variant, only the first variants are traced when there are less seeds than variants
+    if len(random_seeds) > resources.variant_count:
+        raise RuntimeError("%d random seeds for %d variants" % (len(random_seeds), resources.variant_count))
+    resources.random_seeds = list(random_seeds)
+    resources.random_frame = 0
+    resources.trace_variant_count = len(random_seeds)
+
+    if resources.parameters.random_counter:
+        _update_random_keys(resources)
+        return
+
+    # Same generators as Random for every variant, each variant has its own seed
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.init_random_program)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, resources.random_buffer)
+    for variant, random_seed in enumerate(resources.random_seeds):
+        glUniform1ui(VARIANT_BASE_LOCATION, variant)
+        glUniform1ui(Random.SEED_LOCATION, random_seed)
+        glDispatchCompute(resources.parameters.ray_count // 16, 1, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, 0)
+    glUseProgram(0)
+
+
+def advance_random(resources):
+
+    resources.random_frame += 1
+    if resources.parameters.random_counter:
+        _update_random_keys(resources)
+
+
+def trace_paths(resources):
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.trace_path_program)
+    glUniform1ui(VARIANT_BASE_LOCATION, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.world_buffer)
+    if resources.world_bvh_buffer is not None:
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 4, resources.world_bvh_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 1, resources.ray_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.path_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 3, resources.random_buffer)
+    glDispatchCompute(resources.parameters.ray_count // resources.parameters.ray_group_size, resources.trace_variant_count, 1)
+    for binding in range(5):
+        glBindBufferBase(GL_SHADER_STORAGE_BUFFER, binding, 0)
+    glUseProgram(0)
+
+
+def reset_directions(resources):
+
+    clear_uint_buffer(resources.dir_count_buffer)
+    resources.dir_sample_count = 0
+
+
+def accumulate_path_directions(resources):
+
+    # Same histograms as Ray.accumulate_path_directions for the last bounce, every variant is counted on its own
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.scatter_dir_program)
+    glUniform1ui(VARIANT_BASE_LOCATION, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, resources.path_buffer)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, resources.dir_count_buffer)
+    glDispatchCompute(resources.parameters.ray_count // resources.parameters.ray_group_size, resources.trace_variant_count, 1)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 2, 0)
+    glUseProgram(0)
+
+    resources.dir_sample_count += resources.parameters.ray_count
+
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+    glUseProgram(resources.normalize_dir_program)
+    glUniform1ui(VARIANT_BASE_LOCATION, 0)
+    glUniform1f(0, 1.0 / resources.dir_sample_count)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, resources.dir_buffer)
+    glDispatchCompute(
+        resources.parameters.ray_dir_count // resources.parameters.ray_dir_group_size, resources.trace_variant_count, 1
+    )
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 5, 0)
+    glBindBufferBase(GL_SHADER_STORAGE_BUFFER, 0, 0)
+    glUseProgram(0)
+
+
+def read_directions(resources):
+
+    # Waits for the GPU, one row of weights per traced variant
+    ray_dir_count = resources.parameters.ray_dir_count
+    ray_dir_weights = read_buffer(
+        resources.dir_buffer, numpy.float32, 0, resources.trace_variant_count * ray_dir_count * sizeof(GLfloat)
+    )
+    return ray_dir_weights.reshape(resources.trace_variant_count, ray_dir_count)
@@ -2,15 +2,18 @@
 
 from OpenGL.GL import GLuint, glGenVertexArrays, glDeleteVertexArrays
 
+import Registry
+
 
 def initialize_vertex_array():
 
     vertex_array = GLuint(0)
     glGenVertexArrays(1, vertex_array)
-    return vertex_array
+    return Registry.track("vertex_array", vertex_array)
 
 
 def dispose_vertex_array(vertex_array):
 
     if vertex_array is not None:
-        glDeleteVertexArrays(1, (vertex_array,))
+        Registry.untrack("vertex_array", vertex_array)
+        glDeleteVertexArrays(1, vertex_array)
@@ -1,28 +1,30 @@
 # coding: utf8
 
-from itertools import islice
+from itertools import count
 
-from OpenGL.GL import GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_SHADER_STORAGE_BUFFER, GL_LINES, \
+from OpenGL.GL import GL_VERTEX_SHADER, GL_FRAGMENT_SHADER, GL_SHADER_STORAGE_BUFFER, GL_LINES, GLfloat, GLuint, sizeof, \
     glBindVertexArray, glUseProgram, glDrawArrays, glBindBufferBase
 
 from glm import mat3
 
-from Shader import initialize_shader, initialize_program, dispose_program
-from Buffer import prepare_float_buffer_data, initialize_buffer, dispose_buffer
-from Vertex import initialize_vertex_array, dispose_vertex_array
+import numpy
+
+import Scene
 
-from Config import WORLD_LINE_COUNT, INT_X, INT_Y, INT_IOR_I, INT_IOR_T
+from Shader import get_program
+from Buffer import prepare_float_buffer_data, prepare_empty_float_buffer_data, prepare_empty_uint_buffer_data, \
+    initialize_buffer, update_buffer, read_buffer, dispose_buffer
+from Vertex import initialize_vertex_array, dispose_vertex_array
+from Bvh import BVH_NODE_SIZE, build_bvh, get_bvh_node_depth, prepare_bvh_links, refit_bvh_lines, prepare_bvh_buffer_data
 
 from View import update_view_projection, DATA_LAYOUT as VIEW_DATA_LAYOUT
+from Config import WORLD_SCENE_CHUNK_LINE_COUNT, WORLD_EDIT_MERGE_DISTANCE
 
 
 def prepare_lines(line_strip):
 
-    lines = []
-    for data0, data1 in zip(islice(line_strip, 0, len(line_strip) - 1), islice(line_strip, 1, None)):
-        lines.append(data0)
-        lines.append(data1)
-    return lines
+    line_strip = numpy.asarray(line_strip, numpy.float32)
+    return numpy.stack((line_strip[:-1], line_strip[1:]), axis=1).ravel()
 
 
 BUFFER_LAYOUT = """
@@ -35,18 +37,25 @@ layout(std430, binding = 0) buffer World
     float world_ior_i[WORLD_LINE_COUNT];
     float world_ior_t[WORLD_LINE_COUNT];
 }};
+"""
+
 
+# Only needs the world arrays by name, whichever block declares them
+LINE_SHADER = """
 void get_world_line(uint line_index, out vec2 p0, out vec2 p1, out float ior_i, out float ior_t)
-{{
+{
     uint first_point_index = line_index << 1;
     p0 = vec2(world_pos_x[first_point_index + 0], world_pos_y[first_point_index + 0]);
     p1 = vec2(world_pos_x[first_point_index + 1], world_pos_y[first_point_index + 1]);
     ior_i = world_ior_i[line_index];
     ior_t = world_ior_t[line_index];
-}}
-""".format(
-    define_world_line_count=WORLD_LINE_COUNT
-)
+}
+"""
+
+
+def prepare_buffer_layout(parameters):
+
+    return BUFFER_LAYOUT.format(define_world_line_count=get_line_slot_count(parameters)) + LINE_SHADER
 
 
 DISPLAY_NORMAL_VERTEX_SHADER = """
@@ -66,10 +75,15 @@ void main()
     
     gl_Position = vec4(position.xy / position.z, 0.0, 1.0);
 }}
-""".format(
-    include_world_buffer_layout=BUFFER_LAYOUT,
-    include_view_data_layout=VIEW_DATA_LAYOUT
-)
+"""
+
+
+def prepare_display_normal_vertex_shader(parameters):
+
+    return DISPLAY_NORMAL_VERTEX_SHADER.format(
+        include_world_buffer_layout=prepare_buffer_layout(parameters),
+        include_view_data_layout=VIEW_DATA_LAYOUT
+    )
 
 
 DISPLAY_NORMAL_FRAGMENT_SHADER = """
@@ -95,10 +109,16 @@ void main()
     vec3 position = view_projection * vec3(world_pos_x[gl_VertexID], world_pos_y[gl_VertexID], 1.0);
     gl_Position = vec4(position.xy / position.z, 0.0, 1.0);
 }}
-""".format(
-    include_world_buffer_layout=BUFFER_LAYOUT,
-    include_view_data_layout=VIEW_DATA_LAYOUT
-)
+"""
+
+
+def prepare_display_line_vertex_shader(parameters):
+
+    return DISPLAY_LINE_VERTEX_SHADER.format(
+        include_world_buffer_layout=prepare_buffer_layout(parameters),
+        include_view_data_layout=VIEW_DATA_LAYOUT
+    )
+
 
 DISPLAY_LINE_FRAGMENT_SHADER = """
 #version 430
@@ -112,46 +132,337 @@ void main()
 """
 
 
+def get_line_slot_count(parameters):
+
+    # Spare lines are degenerate until polylines are inserted in them
+    return parameters.world_line_count + parameters.world_spare_line_count
+
+
+def prepare_world_lines(parameters, world_data):
+
+    int_x, int_y, int_ior_i, int_ior_t = world_data
+
+    world_pos_x = numpy.concatenate([prepare_lines(line_strip) for line_strip in int_x])
+    world_pos_y = numpy.concatenate([prepare_lines(line_strip) for line_strip in int_y])
+    if len(world_pos_x) != parameters.world_line_count * 2:
+        raise RuntimeError("World data has %d lines instead of %d" % (len(world_pos_x) >> 1, parameters.world_line_count))
+
+    spare_line_count = parameters.world_spare_line_count
+    world_pos_x = numpy.concatenate((world_pos_x, numpy.zeros(spare_line_count * 2, numpy.float32)))
+    world_pos_y = numpy.concatenate((world_pos_y, numpy.zeros(spare_line_count * 2, numpy.float32)))
+    world_ior_i = numpy.concatenate(list(int_ior_i) + [numpy.ones(spare_line_count, numpy.float32)])
+    world_ior_t = numpy.concatenate(list(int_ior_t) + [numpy.ones(spare_line_count, numpy.float32)])
+
+    polyline_line_counts = [len(line_strip) - 1 for line_strip in int_x]
+    return world_pos_x, world_pos_y, world_ior_i, world_ior_t, polyline_line_counts
+
+
+def _initialize_buffer(parameters, world_data):
+
+    world_pos_x, world_pos_y, world_ior_i, world_ior_t, polyline_line_counts = prepare_world_lines(parameters, world_data)
+    buffer = initialize_buffer(prepare_float_buffer_data(numpy.concatenate((world_pos_x, world_pos_y, world_ior_i, world_ior_t))))
+    return buffer, None, world_pos_x, world_pos_y, polyline_line_counts
+
+
+def _update_lines(buffer, line_slot_count, first_line, world_pos_x, world_pos_y, world_ior_i, world_ior_t):
+
+    float_size = sizeof(GLfloat)
+    update_buffer(buffer, float_size * 2 * first_line, world_pos_x)
+    update_buffer(buffer, float_size * (2 * line_slot_count + 2 * first_line), world_pos_y)
+    update_buffer(buffer, float_size * (4 * line_slot_count + first_line), world_ior_i)
+    update_buffer(buffer, float_size * (5 * line_slot_count + first_line), world_ior_t)
+
+
+def _initialize_scene_bvh_buffer(scene):
+
+    # Same layout as prepare_bvh_buffer_data, copied from the scene file a bounded number of lines at a time
+    line_count = scene.line_count
+    nodes_offset = line_count + line_count % 2
+    buffer = initialize_buffer(prepare_empty_uint_buffer_data(nodes_offset + BVH_NODE_SIZE * scene.bvh_node_count))
+    uint_size = sizeof(GLuint)
+    for first_line in range(0, line_count, WORLD_SCENE_CHUNK_LINE_COUNT):
+        last_line = min(first_line + WORLD_SCENE_CHUNK_LINE_COUNT, line_count)
+        update_buffer(buffer, uint_size * first_line, scene.bvh_lines[first_line:last_line])
+    for first_node in range(0, scene.bvh_node_count, WORLD_SCENE_CHUNK_LINE_COUNT):
+        last_node = min(first_node + WORLD_SCENE_CHUNK_LINE_COUNT, scene.bvh_node_count)
+        update_buffer(buffer, uint_size * (nodes_offset + BVH_NODE_SIZE * first_node), scene.bvh_nodes[first_node:last_node])
+    return buffer
+
+
+def _initialize_scene_buffer(parameters):
+
+    scene = Scene.Resources()
+    scene.initialize(parameters.world_scene_path)
+
+    try:
+        line_count = scene.line_count
+        if line_count != parameters.world_line_count:
+            raise RuntimeError("Scene has %d lines instead of %d" % (line_count, parameters.world_line_count))
+
+        # Same layout as the buffer built from world data, filled a bounded number of lines at a time
+        line_slot_count = get_line_slot_count(parameters)
+        buffer = initialize_buffer(prepare_empty_float_buffer_data(6 * line_slot_count))
+        for first_line in range(0, line_count, WORLD_SCENE_CHUNK_LINE_COUNT):
+            last_line = min(first_line + WORLD_SCENE_CHUNK_LINE_COUNT, line_count)
+            _update_lines(buffer, line_slot_count, first_line, *Scene.get_world_lines(scene, first_line, last_line))
+        for first_line in range(line_count, line_slot_count, WORLD_SCENE_CHUNK_LINE_COUNT):
+            last_line = min(first_line + WORLD_SCENE_CHUNK_LINE_COUNT, line_slot_count)
+            spare_pos = numpy.zeros(2 * (last_line - first_line), numpy.float32)
+            spare_ior = numpy.ones(last_line - first_line, numpy.float32)
+            _update_lines(buffer, line_slot_count, first_line, spare_pos, spare_pos, spare_ior, spare_ior)
+
+        polyline_line_counts = numpy.diff(scene.line_offsets).tolist()
+
+        # The scene BVH only holds scene lines, spare lines need a BVH built over every line at once
+        if parameters.world_bvh and parameters.world_spare_line_count == 0:
+            return buffer, _initialize_scene_bvh_buffer(scene), None, None, polyline_line_counts
+        if parameters.world_bvh:
+            world_pos_x, world_pos_y, _, _ = Scene.get_world_lines(scene, 0, line_count)
+            spare_pos = numpy.zeros(2 * parameters.world_spare_line_count, numpy.float32)
+            return buffer, None, numpy.concatenate((world_pos_x, spare_pos)), numpy.concatenate((world_pos_y, spare_pos)), \
+                polyline_line_counts
+        return buffer, None, None, None, polyline_line_counts
+
+    finally:
+        scene.dispose()
+
+
+# Changes whenever world lines are initialized again or edits are uploaded
+_VERSIONS = count(1)
+
+
 class Resources(object):
 
     def __init__(self):
 
+        self.version = None
+        self.parameters = None
         self.display_line_program = None
         self.display_normal_program = None
         self.display_buffer = None
         self.display_vertex_array = None
         self.display_vertex_count = None
-
-    def initialize(self):
-
-        self.display_vertex_count = WORLD_LINE_COUNT * 2
-
-        self.display_line_program = initialize_program(
-            initialize_shader(GL_VERTEX_SHADER, DISPLAY_LINE_VERTEX_SHADER),
-            initialize_shader(GL_FRAGMENT_SHADER, DISPLAY_LINE_FRAGMENT_SHADER)
+        self.bvh_buffer = None
+        self.bvh_lines = None
+        self.bvh_nodes = None
+        self.bvh_node_depth = None
+        self.polylines = None
+        self.free_lines = None
+        self.edit_pos_x = None
+        self.edit_pos_y = None
+        self.edit_ior_i = None
+        self.edit_ior_t = None
+        self.edit_dirty_lines = None
+        self.edit_bvh_node_parents = None
+        self.edit_bvh_line_leaves = None
+
+    def initialize(self, parameters, program_cache, world_data):
+
+        self.version = next(_VERSIONS)
+        self.parameters = parameters
+        self.display_vertex_count = get_line_slot_count(parameters) * 2
+
+        self.display_line_program = get_program(
+            program_cache,
+            (GL_VERTEX_SHADER, prepare_display_line_vertex_shader(parameters)),
+            (GL_FRAGMENT_SHADER, DISPLAY_LINE_FRAGMENT_SHADER)
         )
 
-        self.display_normal_program = initialize_program(
-            initialize_shader(GL_VERTEX_SHADER, DISPLAY_NORMAL_VERTEX_SHADER),
-            initialize_shader(GL_FRAGMENT_SHADER, DISPLAY_NORMAL_FRAGMENT_SHADER)
+        self.display_normal_program = get_program(
+            program_cache,
+            (GL_VERTEX_SHADER, prepare_display_normal_vertex_shader(parameters)),
+            (GL_FRAGMENT_SHADER, DISPLAY_NORMAL_FRAGMENT_SHADER)
         )
 
-        self.display_buffer = initialize_buffer(prepare_float_buffer_data(
-            sum([prepare_lines(line_strip) for line_strip in INT_X], []) +
-            sum([prepare_lines(line_strip) for line_strip in INT_Y], []) +
-            sum(INT_IOR_I, []) +
-            sum(INT_IOR_T, [])
-        ))
+        if parameters.world_scene_path is not None:
+            self.display_buffer, self.bvh_buffer, world_pos_x, world_pos_y, polyline_line_counts = \
+                _initialize_scene_buffer(parameters)
+        else:
+            self.display_buffer, self.bvh_buffer, world_pos_x, world_pos_y, polyline_line_counts = \
+                _initialize_buffer(parameters, world_data)
+
+        if parameters.world_bvh and self.bvh_buffer is None:
+            # Kept for refits after edits, scene BVHs are read back by the first edit
+            self.bvh_lines, self.bvh_nodes, self.bvh_node_depth = build_bvh(world_pos_x, world_pos_y)
+            self.bvh_buffer = initialize_buffer(prepare_bvh_buffer_data(self.bvh_lines, self.bvh_nodes))
+
+        _reset_edits(self, polyline_line_counts)
 
         self.display_vertex_array = initialize_vertex_array()
 
     def dispose(self):
 
-        self.display_line_program = dispose_program(self.display_line_program)
-        self.display_normal_program = dispose_program(self.display_normal_program)
+        # Programs belong to the program cache
+        self.version = None
+        self.parameters = None
+        self.display_line_program = None
+        self.display_normal_program = None
         self.display_buffer = dispose_buffer(self.display_buffer)
         self.display_vertex_array = dispose_vertex_array(self.display_vertex_array)
         self.display_vertex_count = None
+        self.bvh_buffer = dispose_buffer(self.bvh_buffer)
+        self.bvh_lines = None
+        self.bvh_nodes = None
+        self.bvh_node_depth = None
+        self.polylines = None
+        self.free_lines = None
+        self.edit_pos_x = None
+        self.edit_pos_y = None
+        self.edit_ior_i = None
+        self.edit_ior_t = None
+        self.edit_dirty_lines = None
+        self.edit_bvh_node_parents = None
+        self.edit_bvh_line_leaves = None
+
+
+def _reset_edits(resources, polyline_line_counts):
+
+    # Polylines are lists of line slots, inserted polylines take free slots wherever they are
+    parameters = resources.parameters
+    resources.polylines = numpy.split(numpy.arange(parameters.world_line_count), numpy.cumsum(polyline_line_counts)[:-1])
+    resources.free_lines = list(range(parameters.world_line_count, get_line_slot_count(parameters)))
+    resources.edit_pos_x = None
+    resources.edit_pos_y = None
+    resources.edit_ior_i = None
+    resources.edit_ior_t = None
+    resources.edit_dirty_lines = None
+    resources.edit_bvh_node_parents = None
+    resources.edit_bvh_line_leaves = None
+
+
+def _begin_edit(resources):
+
+    # Lines are only read back from the buffer by the first edit, scenes are never kept in memory otherwise
+    if resources.edit_pos_x is None:
+        line_slot_count = get_line_slot_count(resources.parameters)
+        world_data = read_buffer(resources.display_buffer, numpy.float32)
+        resources.edit_pos_x = world_data[:2 * line_slot_count].copy()
+        resources.edit_pos_y = world_data[2 * line_slot_count:4 * line_slot_count].copy()
+        resources.edit_ior_i = world_data[4 * line_slot_count:5 * line_slot_count].copy()
+        resources.edit_ior_t = world_data[5 * line_slot_count:].copy()
+        resources.edit_dirty_lines = numpy.zeros(line_slot_count, bool)
+        if resources.bvh_buffer is not None and resources.bvh_nodes is None:
+            bvh_data = read_buffer(resources.bvh_buffer, numpy.uint32)
+            resources.bvh_lines = bvh_data[:line_slot_count].copy()
+            resources.bvh_nodes = bvh_data[line_slot_count + line_slot_count % 2:].view(numpy.float32).reshape(-1, BVH_NODE_SIZE)
+            resources.bvh_node_depth = get_bvh_node_depth(resources.bvh_nodes)
+        if resources.bvh_buffer is not None:
+            resources.edit_bvh_node_parents, resources.edit_bvh_line_leaves = prepare_bvh_links(
+                resources.bvh_nodes, resources.bvh_lines
+            )
+
+
+def move_point(resources, polyline, point, x, y):
+
+    # A point ends the line before it and starts the line after it
+    _begin_edit(resources)
+    lines = resources.polylines[polyline]
+    if point > 0:
+        line = lines[point - 1]
+        resources.edit_pos_x[2 * line + 1] = x
+        resources.edit_pos_y[2 * line + 1] = y
+        resources.edit_dirty_lines[line] = True
+    if point < len(lines):
+        line = lines[point]
+        resources.edit_pos_x[2 * line] = x
+        resources.edit_pos_y[2 * line] = y
+        resources.edit_dirty_lines[line] = True
+
+
+def set_line_ior(resources, polyline, line, ior_i, ior_t):
+
+    _begin_edit(resources)
+    line = resources.polylines[polyline][line]
+    resources.edit_ior_i[line] = ior_i
+    resources.edit_ior_t[line] = ior_t
+    resources.edit_dirty_lines[line] = True
+
+
+def insert_polyline(resources, line_strip_x, line_strip_y, line_ior_i, line_ior_t):
+
+    # Same polylines as scene files, nothing is changed before the strip is known to fit
+    line_count = len(line_strip_x) - 1
+    if line_count < 1 or len(line_strip_y) != len(line_strip_x):
+        raise RuntimeError("Polyline has %d x and %d y points, polylines need at least 2" % (
+            len(line_strip_x), len(line_strip_y)
+        ))
+    if len(line_ior_i) != line_count or len(line_ior_t) != line_count:
+        raise RuntimeError("Polyline has %d and %d IORs instead of %d" % (len(line_ior_i), len(line_ior_t), line_count))
+
+    _begin_edit(resources)
+    if line_count > len(resources.free_lines):
+        raise RuntimeError("World has %d free lines instead of %d, increase the spare line count" % (
+            len(resources.free_lines), line_count
+        ))
+
+    # Lowest slots first, nearby polylines tend to share upload ranges
+    resources.free_lines.sort()
+    lines = numpy.array(resources.free_lines[:line_count], numpy.int64)
+    del resources.free_lines[:line_count]
+
+    resources.edit_pos_x.reshape(-1, 2)[lines] = prepare_lines(line_strip_x).reshape(-1, 2)
+    resources.edit_pos_y.reshape(-1, 2)[lines] = prepare_lines(line_strip_y).reshape(-1, 2)
+    resources.edit_ior_i[lines] = line_ior_i
+    resources.edit_ior_t[lines] = line_ior_t
+    resources.edit_dirty_lines[lines] = True
+
+    resources.polylines.append(lines)
+    return len(resources.polylines) - 1
+
+
+def delete_polyline(resources, polyline):
+
+    # Deleted lines collapse on their first point, degenerate lines are never hit and keep BVH boxes tight
+    _begin_edit(resources)
+    lines = resources.polylines[polyline]
+    resources.edit_pos_x[2 * lines + 1] = resources.edit_pos_x[2 * lines]
+    resources.edit_pos_y[2 * lines + 1] = resources.edit_pos_y[2 * lines]
+    resources.edit_dirty_lines[lines] = True
+
+    resources.free_lines.extend(lines.tolist())
+    resources.polylines[polyline] = numpy.zeros(0, numpy.int64)
+
+
+def _get_dirty_ranges(dirty_items):
+
+    # Runs of sorted dirty items, runs separated by a few clean items are merged to save calls
+    if len(dirty_items) == 0:
+        return []
+    breaks = numpy.flatnonzero(numpy.diff(dirty_items) > WORLD_EDIT_MERGE_DISTANCE)
+    firsts = dirty_items[numpy.concatenate(([0], breaks + 1))]
+    lasts = dirty_items[numpy.concatenate((breaks, [len(dirty_items) - 1]))] + 1
+    return list(zip(firsts.tolist(), lasts.tolist()))
+
+
+def upload_edits(resources):
+
+    if resources.edit_dirty_lines is None or not resources.edit_dirty_lines.any():
+        return
+
+    line_slot_count = get_line_slot_count(resources.parameters)
+    dirty_lines = numpy.flatnonzero(resources.edit_dirty_lines)
+    for first_line, last_line in _get_dirty_ranges(dirty_lines):
+        _update_lines(
+            resources.display_buffer, line_slot_count, first_line,
+            resources.edit_pos_x[2 * first_line:2 * last_line],
+            resources.edit_pos_y[2 * first_line:2 * last_line],
+            resources.edit_ior_i[first_line:last_line],
+            resources.edit_ior_t[first_line:last_line]
+        )
+    resources.edit_dirty_lines[:] = False
+
+    if resources.bvh_buffer is not None:
+        # Same tree, only the boxes above dirty lines move, their nodes are uploaded after the line indices
+        refit_nodes = refit_bvh_lines(
+            resources.bvh_nodes, resources.bvh_node_depth, resources.edit_bvh_node_parents, resources.edit_bvh_line_leaves,
+            resources.bvh_lines, resources.edit_pos_x, resources.edit_pos_y, dirty_lines
+        )
+        nodes_offset = sizeof(GLuint) * (line_slot_count + line_slot_count % 2)
+        node_size = resources.bvh_nodes.itemsize * BVH_NODE_SIZE
+        for first_node, last_node in _get_dirty_ranges(refit_nodes):
+            update_buffer(resources.bvh_buffer, nodes_offset + node_size * first_node, resources.bvh_nodes[first_node:last_node])
+
+    resources.version = next(_VERSIONS)
 
 
 def bind_buffer(resources):